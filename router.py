@@ -36,23 +36,37 @@ CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
+from __future__ import annotations
+
+import array
+import bisect
+import contextlib
+import functools
+import importlib
+import itertools
 import json
 import logging
+import mmap
 import os
+import random
 import re
 import signal
+import struct
 import sys
+import threading
 import time
 import traceback
 import types
+import typing
+import zlib
 
-import jmespath
-import jsonschema
 import redmx
-import sentry_sdk
 from confluent_kafka import (Consumer, KafkaError, KafkaException, Message,
-                             Producer)
-from prometheus_client import Counter, Info, Summary, start_http_server
+                             Producer, TopicPartition)
+
+if typing.TYPE_CHECKING:
+    import concurrent.futures
+    import multiprocessing
 
 __version__ = '0.4.5'
 PROG = os.path.basename(sys.argv[0]).removesuffix('.py')
@@ -62,21 +76,157 @@ log_level = os.getenv('LOG_LEVEL', 'WARN')
 logger.setLevel(log_level)
 logger.info(f'Log level has been set to "{log_level}".')
 
+
+class LazyModule:
+    """
+    A module that is only imported when one of its attributes is first used.
+
+    Keeps the start up of short-lived jobs (e.g. a DLQ replay) from paying for
+    dependencies that they do not use.
+
+    Parameters
+    ----------
+    name : str
+        The name of the module.
+    """
+
+    def __init__(self, name: str) -> None:
+        self._module = None
+        self._name = name
+
+    def __getattr__(self, attribute: str) -> object:
+        """Import the module (if it has not been already) and get one of its attributes."""
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+
+        return getattr(self._module, attribute)
+
+
+class LazyMetric:
+    """
+    A Prometheus metric that is only created when it is first used.
+
+    Keeps prometheus_client out of the import of the module, so that only
+    the processes that record a metric pay for it.
+
+    Parameters
+    ----------
+    kind : str
+        The name of the metric class in prometheus_client (e.g. "Counter").
+    *args : typing.Any
+        The positional arguments for the metric.
+    **kwargs : typing.Any
+        The keyword arguments for the metric.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, kind: str, *args: typing.Any, **kwargs: typing.Any) -> None:
+        self._args = args
+        self._kind = kind
+        self._kwargs = kwargs
+        self._metric = None
+
+    def __getattr__(self, attribute: str) -> object:
+        """Create the metric (if it has not been already) and get one of its attributes."""
+        value = getattr(self.metric(), attribute)
+
+        if callable(value):
+            # Cache bound methods (e.g. inc) so that later calls skip this lookup.
+            setattr(self, attribute, value)
+
+        return value
+
+    def metric(self) -> object:
+        """
+        Get the metric, creating it on the first call.
+
+        Returns
+        -------
+        object
+            The prometheus_client metric.
+        """
+        if self._metric is None:
+            with self._lock:
+                if self._metric is None:
+                    self._metric = getattr(prometheus_client, self._kind)(*self._args, **self._kwargs)
+
+        return self._metric
+
+    def time(self) -> typing.Callable:
+        """
+        Get a decorator that observes the time taken by each call of a function.
+
+        Unlike the time method of a Summary, the metric is not created until
+        the decorated function is first called.
+
+        Returns
+        -------
+        typing.Callable
+            The decorator.
+        """
+        def decorator(function: typing.Callable) -> typing.Callable:
+            @functools.wraps(function)
+            def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+                with self.metric().time():
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+
+jmespath = LazyModule('jmespath')
+jsonschema = LazyModule('jsonschema')
+multiprocess = LazyModule('prometheus_client.multiprocess')
+prometheus_client = LazyModule('prometheus_client')
+sentry_sdk = LazyModule('sentry_sdk')
+
 """ Prometheus Metrics. """
 kafka_prefix = os.getenv('KAFKA_ROUTER_PROMETHEUS_PREFIX', '')
-PROCESS_TIME = Summary(f'{kafka_prefix}processing_time_seconds', 'Time spent processing message.')
-VERSION_INFO = Info(f'{kafka_prefix}run_version', 'The currently running version.')
-VERSION_INFO.info({f'{kafka_prefix}version': __version__})
-prom_consumer_message_count = Counter(f'{kafka_prefix}consumer_message_count', 'The count of messages consumed.')
+PROCESS_TIME = LazyMetric('Summary', f'{kafka_prefix}processing_time_seconds', 'Time spent processing message.')
+BATCH_PROCESS_TIME = LazyMetric('Summary', f'{kafka_prefix}batch_processing_time_seconds',
+                                'Time spent processing a batch of messages.')
+VERSION_INFO = LazyMetric('Info', f'{kafka_prefix}run_version', 'The currently running version.')
+prom_consumer_message_count = LazyMetric('Counter', f'{kafka_prefix}consumer_message_count',
+                                         'The count of messages consumed.')
+consumer_batch_size = LazyMetric('Summary', f'{kafka_prefix}consumer_batch_size',
+                                 'The number of messages in each batch consumed.')
 consumer_message_count = redmx.RateErrorDuration()
-consumer_message_committed_count = Counter(f'{kafka_prefix}consumer_message_committed_count',
-                                           'The count of messages consumed and committed.')
-non_routed_error_count = Counter(f'{kafka_prefix}non_routed_error_count',
-                                 'The count of messages that could not be routed.')
-prom_producer_message_count = Counter(f'{kafka_prefix}producer_message_count', 'The count of messages produced.')
+consumer_message_committed_count = LazyMetric('Counter', f'{kafka_prefix}consumer_message_committed_count',
+                                              'The count of messages consumed and committed.')
+consumer_commit_latency_seconds = LazyMetric('Summary', f'{kafka_prefix}consumer_commit_latency_seconds',
+                                             'Time taken for the consumer to commit offsets.')
+consumer_commit_batch_size = LazyMetric('Summary', f'{kafka_prefix}consumer_commit_batch_size',
+                                        'The number of messages committed by each commit.')
+non_routed_error_count = LazyMetric('Counter', f'{kafka_prefix}non_routed_error_count',
+                                    'The count of messages that could not be routed.')
+prom_producer_message_count = LazyMetric('Counter', f'{kafka_prefix}producer_message_count',
+                                         'The count of messages produced.')
 producer_message_count = redmx.RateErrorDuration()
-prom_dropped_message_count = Counter(f'{kafka_prefix}dropped_message_count', 'The count of valid messages dropped.')
+prom_dropped_message_count = LazyMetric('Counter', f'{kafka_prefix}dropped_message_count',
+                                        'The count of valid messages dropped.')
 dropped_message_count = redmx.RateErrorDuration()
+rule_evaluation_count = LazyMetric('Counter', f'{kafka_prefix}rule_evaluation_count',
+                                   'The count of messages checked against a rule.', ['rule'])
+rule_match_count = LazyMetric('Counter', f'{kafka_prefix}rule_match_count',
+                              'The count of messages that matched a rule.', ['rule'])
+rule_json_decode_error_count = LazyMetric('Counter', f'{kafka_prefix}rule_json_decode_error_count',
+                                          'The count of messages that were not valid JSON for a rule.', ['rule'])
+rule_check_time_seconds = LazyMetric('Summary', f'{kafka_prefix}rule_check_time_seconds',
+                                     'Time spent in each stage of checking a message against a rule (sampled).',
+                                     ['rule', 'stage'])
+producer_backpressure_paused = LazyMetric('Gauge', f'{kafka_prefix}producer_backpressure_paused',
+                                          'Set to 1 while the source partitions are paused for producer backpressure.',
+                                          multiprocess_mode='livemax')
+producer_backpressure_pause_count = LazyMetric('Counter', f'{kafka_prefix}producer_backpressure_pause_count',
+                                               'The count of times the source partitions were paused for backpressure.')
+producer_buffer_full_count = LazyMetric('Counter', f'{kafka_prefix}producer_buffer_full_count',
+                                        'The count of times the producer queue was full (BufferError) when producing.')
+rule_count = LazyMetric('Gauge', f'{kafka_prefix}rule_count', 'The number of rules loaded.',
+                        multiprocess_mode='livemax')
+rule_load_time_seconds = LazyMetric('Gauge', f'{kafka_prefix}rule_load_time_seconds',
+                                    'Time taken to load, validate and compile the rules.', multiprocess_mode='livemax')
 
 
 class EnvironmentConfig:
@@ -186,6 +336,48 @@ class EnvironmentConfig:
 
         return response
 
+    def get_integer(self, key: str) -> int:
+        """
+        Get an integer value from an environment variable.
+
+        Parameters
+        ----------
+        key : str
+            The name of the environment variable.
+
+        Returns
+        -------
+        int
+            The value or None if the environment variable is not set (or is
+            blank).
+        """
+        value = os.getenv(key, '')
+
+        if not value:
+            return None
+
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f'Unknown value ("{value}") for integer set in "{key}".')
+
+    def get_list(self, key: str) -> list:
+        """
+        Get a list of comma separated values from an environment variable.
+
+        Parameters
+        ----------
+        key : str
+            The name of the environment variable.
+
+        Returns
+        -------
+        list
+            The values (with surrounding white space removed).  An empty list
+            if the environment variable is not set.
+        """
+        return [value.strip() for value in os.getenv(key, '').split(',') if value.strip()]
+
     def parse_value(self, value: str) -> object:
         """
         Parse the value (if enabled).
@@ -223,529 +415,4315 @@ class EnvironmentConfig:
         return value
 
 
-class KafkaRouterRule:
+class MessageContext:
     """
-    A rule for the Kafka router.
+    A parse-once view of a consumed message that is shared across the rules.
+
+    The decoded value, the parsed JSON and the decoded header values are
+    only worked out when a rule first asks for them and are then reused by
+    every other rule that the message is checked against.  Rules that match
+    on bytes use the raw value and header values, which are never decoded.
 
     Parameters
     ----------
-    name : str
-        The name of the rule as found in the environment variables.
-    rule : str
-        The rule itself as a JSON string.
+    message : Message
+        The consumed message.
     """
 
-    def __init__(self, name: str, rule: str) -> None:
-        with open('rule-schema.json', 'r') as stream:
-            schema = json.load(stream)
+    def __init__(self, message: Message) -> None:
+        self.message = message
+        self._data = None
+        self._data_error = None
+        self._data_parsed = False
+        self._header_values = {}
+        self._raw_headers = None
+        self._raw_value = None
+        self._searches = {}
+        self._value = None
+        self._value_error = None
+
+    def data(self) -> object:
+        """
+        Get the message value parsed from JSON.
 
-        try:
-            instance = json.loads(rule)
-            jsonschema.validate(instance=instance, schema=schema)
-        except json.decoder.JSONDecodeError:
-            logger.error(f'{name} ("{rule}") is not valid JSON.')
-            sys.exit(2)
-        except jsonschema.exceptions.ValidationError as ex:
-            logger.error(f'{name} is not valid {ex}')
-            sys.exit(2)
+        The value is only parsed once.  If it is not valid JSON, the same
+        JSONDecodeError is raised to every caller without parsing it again.
 
-        self.name = name.removeprefix('KAFKA_ROUTER_RULE_')
-        self.destination_topics = instance['destination_topics']
-        self.header = instance.get('header', None)
-        self.header_regexp = instance.get('header_regexp', None)
-        self.jmespath = instance.get('jmespath', None)
-        self.regexp = instance.get('regexp', None)
-        self.source_topic = instance['source_topic']
+        Returns
+        -------
+        object
+            The parsed JSON document.
 
-    def get_data(self, message: Message) -> str:
+        Raises
+        ------
+        json.decoder.JSONDecodeError
+            If the message value is not valid JSON.
         """
-        Return the data specific to how the message will be matched.
+        if not self._data_parsed:
+            self._data_parsed = True
+
+            try:
+                self._data = json.loads(self.value())
+            except json.decoder.JSONDecodeError as ex:
+                self._data_error = ex
+
+        if self._data_error is not None:
+            raise self._data_error
+
+        return self._data
+
+    def header_values(self, key: str) -> list:
+        """
+        Get the decoded values of all the headers with the given key.
 
         Parameters
         ----------
-        message : Message
-            The message to be parsed.
+        key : str
+            The key of the headers.
 
         Returns
         -------
-        str
-            The data to be matched against.  If the rule is that no jmespath is specified,
-            this will be the decoded message.  If a jmespath is required, then the
-            message will be parsed from JSON and the relevant path will be
-            returned.
+        list
+            The decoded header values, in the order they appear in the message.
         """
-        raw_message = message.value().decode('utf-8')
-
-        if self.jmespath:
-            data = json.loads(raw_message)
-            return jmespath.search(self.jmespath, data)
+        if key not in self._header_values:
+            self._header_values[key] = [value.decode() for value in self.raw_header_values(key)]
 
-        return raw_message
+        return self._header_values[key]
 
-    def is_match(self, message: Message) -> bool:
+    def raw_header_values(self, key: str) -> list:
         """
-        Check if the provided message is a match for this rule.
+        Get the raw values of all the headers with the given key.
 
         Parameters
         ----------
-        message : Message
-            The Confluent Kafka message.
+        key : str
+            The key of the headers.
 
         Returns
         -------
-        bool
-            True if the message is a match against the rule, False otherwise.
+        list
+            The header values as they were consumed.
         """
-        source_topic = message.topic()
-        headers = message.headers()
+        if self._raw_headers is None:
+            self._raw_headers = {}
 
-        if source_topic != self.source_topic:
-            return False
-        if not self.match_header(headers):
-            return False
-        if not self.match_message(message):
-            return False
+            for header_key, header_value in self.message.headers() or []:
+                self._raw_headers.setdefault(header_key, []).append(header_value)
 
-        log_message = f'Message on topic "{message.topic()}" ({message.partition()}/{message.offset()}) '
-        log_message += f'matches rule "{self.name}" ({self.destination_topics}).'
-        logger.debug(log_message)
-        return True
+        return self._raw_headers.get(key, [])
 
-    def match_header(self, headers: list) -> bool:
+    def raw_value(self) -> bytes:
         """
-        Match the headers against the specified rule.
+        Get the message value as it was consumed.
+
+        Returns
+        -------
+        bytes
+            The message value.
+        """
+        if self._raw_value is None:
+            self._raw_value = self.message.value()
+
+        return self._raw_value
+
+    def search(self, expression: jmespath.parser.ParsedResult) -> object:
+        """
+        Get the result of a JMESPath expression against the parsed message.
+
+        Each distinct expression is only evaluated once, so rules that share
+        a JMESPath expression reuse the result.
 
         Parameters
         ----------
-        headers : list
-            The message headers.
+        expression : jmespath.parser.ParsedResult
+            The compiled expression.
 
         Returns
         -------
-        bool
-            True if no headers rules provided, or the header matches the regexp.
-            False otherwise.
-        """
-        if not self.header:
-            return True
+        object
+            The result of the search.
 
-        for header in headers:
-            key, value = header
+        Raises
+        ------
+        json.decoder.JSONDecodeError
+            If the message value is not valid JSON.
+        """
+        key = expression.expression
 
-            if key == self.header and re.search(self.header_regexp, value.decode()):
-                return True
+        if key not in self._searches:
+            self._searches[key] = expression.search(self.data())
 
-        return False
+        return self._searches[key]
 
-    def match_message(self, message: Message) -> bool:
+    def value(self) -> str:
         """
-        Check if the provided message matches this rule.
+        Get the message value decoded as UTF-8.
 
-        Parameters
-        ----------
-        message : Message
-            The message to be matched against.
+        The value is only decoded once.  If it is not valid UTF-8, the same
+        UnicodeDecodeError is raised to every caller without decoding it
+        again.
 
         Returns
         -------
-        bool
-            True if the message matches the rule, false otherwise,
-        """
-        if not self.regexp:
-            return True
+        str
+            The decoded message value.
 
-        data = self.get_data(message)
+        Raises
+        ------
+        UnicodeDecodeError
+            If the message value is not valid UTF-8.
+        """
+        if self._value is None and self._value_error is None:
+            try:
+                self._value = self.raw_value().decode('utf-8')
+            except UnicodeDecodeError as ex:
+                self._value_error = ex
 
-        if data and re.search(self.regexp, data):
-            return True
+        if self._value_error is not None:
+            raise self._value_error
 
-        return False
+        return self._value
 
 
-class KafkaRouter:
+class KafkaRouterRuleMetrics:
     """
-    A class for routing Kafka traffic to/from topics according to configurable rule.
+    The Prometheus metrics of one or more rules, labelled by rule name.
+
+    The evaluations, matches and JSON decode failures are always counted.
+    The time spent matching the header, extracting the data and searching
+    with the regular expression is only observed for a sample of the
+    evaluations, as timing each stage costs more than most of the stages.
 
     Parameters
     ----------
-    DLQ_topic_name : str, optional
-        The name of the dead letter queue topic, by default None
+    label : str
+        The value of the rule label (the rule name or "other").
+    sample_rate : float
+        The fraction of evaluations that are timed.
     """
 
-    def __init__(self, DLQ_topic_name: str = None) -> None:
-        env_config = EnvironmentConfig()
-        self._headers = []
-        self.consumer_conf = env_config.get_config('KAFKA_CONSUMER_')
-        self.producer_conf = env_config.get_config('KAFKA_PRODUCER_')
-        self.DLQ_topic_name = DLQ_topic_name
-        self.source_topics = []
-        self.rules = []
-        self.get_rules()
-        signal.signal(signal.SIGINT, self.handler)
-        signal.signal(signal.SIGTERM, self.handler)
-        self.running(True)
-        self.dlq_mode(env_config.get_boolean('KAFKA_ROUTER_DLQ_MODE'))
-        logger.info(f'DLQ mode - {self.dlq_mode()}')
-        self.dry_run_mode(env_config.get_boolean('KAFKA_ROUTER_DRY_RUN_MODE'))
-        logger.info(f'Dry run mode - {self.dry_run_mode()}')
-
-        if self.dlq_mode():
-            self.timeout_ms = int(os.getenv('KAFKA_ROUTER_TIMEOUT_MS', '500'))
-            logger.debug(f'Timeout - {self.timeout_ms}ms.')
-        else:
-            self.timeout_ms = 0
-
-        self.consumer = None
-        self.producer = None
+    def __init__(self, label: str, sample_rate: float) -> None:
+        self.evaluations = rule_evaluation_count.labels(label)
+        self.json_decode_errors = rule_json_decode_error_count.labels(label)
+        self.matches = rule_match_count.labels(label)
+        self.sample_rate = sample_rate
+        self.timers = {stage: rule_check_time_seconds.labels(label, stage) for stage in ['data', 'header', 'regexp']}
 
-    def add_rule(self, rule: KafkaRouterRule) -> None:
+    def run_checks(self, rule: 'KafkaRouterRule', context: MessageContext) -> bool:
         """
-        Append the KafkaRouterRule to the rules.
-
-        Also append the source topic to the source topics if it's not already there.
+        Run the checks of a rule against a message and record the metrics.
 
         Parameters
         ----------
         rule : KafkaRouterRule
-            The KafkaRouterRule to be added.
+            The rule being evaluated.
+        context : MessageContext
+            The shared context of the message.
+
+        Returns
+        -------
+        bool
+            True if the message passed all the checks of the rule.
+
+        Raises
+        ------
+        json.decoder.JSONDecodeError
+            If the rule needs the message value as JSON and it is not valid.
         """
-        self.rules.append(rule)
+        self.evaluations.inc()
 
-        source_topic = rule.source_topic
+        try:
+            if random.random() < self.sample_rate:
+                matched = self.run_timed_checks(rule, context)
+            else:
+                matched = rule.run_checks(context)
+        except json.decoder.JSONDecodeError:
+            self.json_decode_errors.inc()
+            raise
 
-        if source_topic not in self.source_topics:
-            self.source_topics.append(source_topic)
+        if matched:
+            self.matches.inc()
 
-    def check_for_timeout(self, time_of_last_message: int) -> None:
+        return matched
+
+    def run_timed_checks(self, rule: 'KafkaRouterRule', context: MessageContext) -> bool:
         """
-        Check if we have exceeded the timeout_ms.
+        Run the checks of a rule, timing each stage.
 
-        Only does anything significant is DLQ mode is enabled.
+        Has the same outcome as KafkaRouterRule.run_checks.
 
         Parameters
         ----------
-        time_of_last_message : int
-            The timestamp (in ms) of when the last message was processed.
+        rule : KafkaRouterRule
+            The rule being evaluated.
+        context : MessageContext
+            The shared context of the message.
+
+        Returns
+        -------
+        bool
+            True if the message passed all the checks of the rule.
         """
-        if not self.dlq_mode():
-            return
+        if rule.header and not self.time('header', rule.match_header, context):
+            return False
 
-        time_now = time.time() * 1000
+        if not rule.regexp:
+            return True
 
-        if time_now - time_of_last_message >= self.timeout_ms:
-            logger.warning(f'Timeout ({self.timeout_ms}ms) since last message consumed.')
-            self.running(False)
+        data = self.time('data', rule.get_data, context)
+        return bool(data) and self.time('regexp', rule.pattern.search, data) is not None
 
-    def commit(self, message: Message) -> None:
+    def time(self, stage: str, function: callable, argument: object) -> object:
         """
-        Commit the consumer unless DLQ mode is enabled.
+        Call a function and observe how long it took.
 
         Parameters
         ----------
-        message : Message
-            The message to be committed.
-        """
-        if not self.dlq_mode():
-            self.consumer.commit(message)
-            logger.debug('Successfully committed consumer.')
-            consumer_message_committed_count.inc()
-
-    def delivery_report(self, err: KafkaError, message: Message) -> None:
-        """
-        Get the delivery result for the producer.
+        stage : str
+            The stage label of the observation.
+        function : callable
+            The function to be called.
+        argument : object
+            The argument to the function.
 
-        Parameters
-        ----------
-        err : KafkaError
-            Will be None if no error happened.
-        message : Message
-            The message being produced.
+        Returns
+        -------
+        object
+            The result of the function.
         """
-        if err is not None:
-            error_message = f'Message delivery failed: "{err}".'
-            logger.error(error_message)
-            raise KafkaException(error_message)
+        start = time.perf_counter()
+
+        try:
+            return function(argument)
+        finally:
+            self.timers[stage].observe(time.perf_counter() - start)
+
+
+class KafkaRouterRule:
+    """
+    A rule for the Kafka router.
+
+    Parameters
+    ----------
+    name : str
+        The name of the rule as found in the environment variables.
+    rule : str
+        The rule itself as a JSON string (or as a dict that has already been
+        decoded, e.g. when rules are loaded in bulk from a file).
+    """
+
+    LITERAL = re.compile(r'\^([^\\.^$*+?{}\[\]|()\n]*)\$')
+    LITERALS = re.compile(r'\^\((?:\?:)?([^\\.^$*+?{}\[\]()\n]*)\)\$')
+    UNCOMBINABLE = re.compile(r'\\[1-9g]|\(\?P|\(\?\(|\(\?[aiLmsux]+\)')
+    SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rule-schema.json')
+    validator = None
+
+    def __init__(self, name: str, rule: str) -> None:
+        try:
+            instance = rule if isinstance(rule, dict) else json.loads(rule)
+            self.validate(instance)
+        except json.decoder.JSONDecodeError:
+            logger.error(f'{name} ("{rule}") is not valid JSON.')
+            sys.exit(2)
+        except jsonschema.exceptions.ValidationError as ex:
+            logger.error(f'{name} is not valid {ex}')
+            sys.exit(2)
+
+        self.name = name.removeprefix('KAFKA_ROUTER_RULE_')
+        self.bytes = instance.get('bytes', False)
+        self.destination_topics = instance['destination_topics']
+        self.header = instance.get('header', None)
+        self.header_regexp = instance.get('header_regexp', None)
+        self.jmespath = instance.get('jmespath', None)
+        self.regexp = instance.get('regexp', None)
+        self.source_topic = instance['source_topic']
+        self.header_pattern = self.compile_regexp(name, self.header_regexp)
+        self.pattern = self.compile_regexp(name, self.regexp)
+        self.expression = self.compile_jmespath(name, self.jmespath)
+        self.checks = self.get_checks()
+        self.dispatch = self.get_dispatch()
+        self.metrics = None
+
+    def compile_jmespath(self, name: str, expression: str) -> jmespath.parser.ParsedResult:
+        """
+        Compile a JMESPath expression from the rule.
+
+        Parameters
+        ----------
+        name : str
+            The name of the rule (for error reporting).
+        expression : str
+            The JMESPath expression.  Can be None.
+
+        Returns
+        -------
+        jmespath.parser.ParsedResult
+            The compiled expression or None if no expression was provided.
+        """
+        if expression is None:
+            return None
+
+        try:
+            return jmespath.compile(expression)
+        except jmespath.exceptions.JMESPathError as ex:
+            logger.error(f'{name} has an invalid jmespath ("{expression}") {ex}')
+            sys.exit(2)
+
+    def compile_regexp(self, name: str, regexp: str) -> re.Pattern:
+        """
+        Compile a regular expression from the rule.
+
+        Parameters
+        ----------
+        name : str
+            The name of the rule (for error reporting).
+        regexp : str
+            The regular expression.  Can be None.
+
+        Returns
+        -------
+        re.Pattern
+            The compiled regular expression or None if no regular expression
+            was provided.  A bytes pattern (of the regexp encoded as UTF-8)
+            if the rule matches on bytes.
+        """
+        if regexp is None:
+            return None
+
+        try:
+            return re.compile(regexp.encode('utf-8') if self.bytes else regexp)
+        except re.error as ex:
+            logger.error(f'{name} has an invalid regular expression ("{regexp}") {ex}')
+            sys.exit(2)
+
+    def get_data(self, context: MessageContext) -> object:
+        """
+        Return the data specific to how the message will be matched.
+
+        Parameters
+        ----------
+        context : MessageContext
+            The shared context of the message to be parsed.
+
+        Returns
+        -------
+        object
+            The data to be matched against.  If the rule is that no jmespath is specified,
+            this will be the decoded message (or the raw message if the rule
+            matches on bytes).  If a jmespath is required, then the
+            message will be parsed from JSON and the relevant path will be
+            returned.
+        """
+        if self.expression:
+            return context.search(self.expression)
+
+        if self.bytes:
+            return context.raw_value()
+
+        return context.value()
+
+    def get_anchored_literals(self, regexp: str) -> list:
+        """
+        Get the literals of an alternation of anchored literals (e.g. "^GB$|^IE$").
+
+        Parameters
+        ----------
+        regexp : str
+            The regular expression.
+
+        Returns
+        -------
+        list
+            The literals or None if any of the alternatives is not an anchored
+            literal.
+        """
+        matches = [self.LITERAL.fullmatch(part) for part in regexp.split('|')]
+
+        if all(matches):
+            return [match.group(1) for match in matches]
+
+        return None
+
+    def get_checks(self) -> list:
+        """
+        Get the checks that a message must pass to match this rule.
+
+        Checks that the rule has no configuration for are left out so that
+        they are not evaluated for every message.
+
+        Returns
+        -------
+        list
+            The methods to be called (in order) with the message context.
+        """
+        checks = []
+
+        if self.header:
+            checks.append(self.match_header)
+
+        if self.regexp:
+            checks.append(self.match_message)
+
+        return checks
+
+    def get_dimension(self, kind: str, name: str, literals: list) -> tuple:
+        """
+        Get the dispatch of the rule for a dimension.
+
+        Rules that match on bytes are dispatched on the raw values, so they
+        have a dimension of their own and their literals are encoded.
+
+        Parameters
+        ----------
+        kind : str
+            The kind of dimension (data or header).
+        name : str
+            The jmespath or the header key.
+        literals : list
+            The literal values.
+
+        Returns
+        -------
+        tuple
+            The dimension and the literal values.
+        """
+        if self.bytes:
+            return ((f'raw-{kind}', name), [literal.encode('utf-8') for literal in literals])
+
+        return ((kind, name), literals)
+
+    def get_dispatch(self) -> tuple:
+        """
+        Get the values that this rule tests for equality with (if any).
+
+        Returns
+        -------
+        tuple
+            The dimension (the message data for the rule's jmespath, or a
+            header) and the list of literal values that it must be equal to
+            one of.  None if the rule does not test for equality.
+        """
+        literals = self.get_literals(self.regexp)
+
+        if literals is not None:
+            return self.get_dimension('data', self.jmespath, literals)
+
+        literals = self.get_literals(self.header_regexp)
+
+        if literals is not None:
+            return self.get_dimension('header', self.header, literals)
+
+        return None
+
+    def get_dispatch_values(self, context: MessageContext) -> list:
+        """
+        Get the values of a message that the rule's dispatch is tested against.
+
+        Parameters
+        ----------
+        context : MessageContext
+            The shared context of the message.
+
+        Returns
+        -------
+        list
+            The header values or a list of the data to be matched.
+        """
+        (kind, _), _ = self.dispatch
+
+        if kind == 'header':
+            return context.header_values(self.header)
+
+        if kind == 'raw-header':
+            return context.raw_header_values(self.header)
+
+        return [self.get_data(context)]
+
+    def get_header_values(self, context: MessageContext) -> list:
+        """
+        Get the values of the header of the rule to be matched against.
+
+        Parameters
+        ----------
+        context : MessageContext
+            The shared context of the message.
+
+        Returns
+        -------
+        list
+            The decoded header values, or the raw header values (less any
+            that are None) if the rule matches on bytes.
+        """
+        if self.bytes:
+            return [value for value in context.raw_header_values(self.header) if value is not None]
+
+        return context.header_values(self.header)
+
+    def get_literals(self, regexp: str) -> list:
+        """
+        Get the literals that an anchored regular expression matches.
+
+        Parameters
+        ----------
+        regexp : str
+            The regular expression.  Can be None.
+
+        Returns
+        -------
+        list
+            The literals for an expression such as "^GB$", "^(GB|IE)$",
+            "^(?:GB|IE)$" or "^GB$|^IE$".  None if the expression is not an
+            anchored literal or alternation of anchored literals.
+        """
+        if regexp is None:
+            return None
+
+        match = self.LITERALS.fullmatch(regexp)
+
+        if match:
+            return match.group(1).split('|')
+
+        return self.get_anchored_literals(regexp)
+
+    @classmethod
+    def get_validator(cls) -> jsonschema.protocols.Validator:
+        """
+        Get the validator of the rule schema.
+
+        The schema is read (from beside this module, not the current working
+        directory) and checked when the first rule is created, so that it is
+        not re-read and re-checked for every rule.
+
+        Returns
+        -------
+        jsonschema.protocols.Validator
+            The validator of the rule schema.
+        """
+        if cls.validator is None:
+            with open(cls.SCHEMA_PATH, 'r') as stream:
+                schema = json.load(stream)
+
+            validator_class = jsonschema.validators.validator_for(schema)
+            validator_class.check_schema(schema)
+            cls.validator = validator_class(schema)
+
+        return cls.validator
+
+    def is_match(self, message: Message, context: MessageContext = None) -> bool:
+        """
+        Check if the provided message is a match for this rule.
+
+        Parameters
+        ----------
+        message : Message
+            The Confluent Kafka message.
+        context : MessageContext, optional
+            The context shared by all the rules that the message is checked
+            against.  If not provided, one is created for this check.
+
+        Returns
+        -------
+        bool
+            True if the message is a match against the rule, False otherwise.
+        """
+        if context is None:
+            context = MessageContext(message)
+
+        if message.topic() != self.source_topic:
+            return False
+
+        if self.metrics is None:
+            matched = self.run_checks(context)
+        else:
+            matched = self.metrics.run_checks(self, context)
+
+        if not matched:
+            return False
+
+        log_message = f'Message on topic "{message.topic()}" ({message.partition()}/{message.offset()}) '
+        log_message += f'matches rule "{self.name}" ({self.destination_topics}).'
+        logger.debug(log_message)
+        return True
+
+    def is_combinable(self) -> bool:
+        """
+        Check if the regexp of this rule can be combined with other rules.
+
+        Only a regexp that is matched against the whole message value can be
+        combined.  Patterns that use group numbers or names (back references,
+        named groups and conditionals) or global inline flags are not
+        combined, as they would change meaning in a combined pattern.
+
+        Returns
+        -------
+        bool
+            True if the regexp can be combined.
+        """
+        return bool(self.regexp) and self.jmespath is None and not self.UNCOMBINABLE.search(self.regexp)
+
+    def match_header(self, context: MessageContext) -> bool:
+        """
+        Match the headers against the specified rule.
+
+        Parameters
+        ----------
+        context : MessageContext
+            The shared context of the message.
+
+        Returns
+        -------
+        bool
+            True if no headers rules provided, or the header matches the regexp.
+            False otherwise.
+        """
+        if not self.header:
+            return True
+
+        for value in self.get_header_values(context):
+            if self.header_pattern.search(value):
+                return True
+
+        return False
+
+    def match_message(self, context: MessageContext) -> bool:
+        """
+        Check if the provided message matches this rule.
+
+        Parameters
+        ----------
+        context : MessageContext
+            The shared context of the message to be matched against.
+
+        Returns
+        -------
+        bool
+            True if the message matches the rule, false otherwise,
+        """
+        if not self.regexp:
+            return True
+
+        data = self.get_data(context)
+
+        if data and self.pattern.search(data):
+            return True
+
+        return False
+
+    def run_checks(self, context: MessageContext) -> bool:
+        """
+        Run the checks of this rule against a message.
+
+        Parameters
+        ----------
+        context : MessageContext
+            The shared context of the message.
+
+        Returns
+        -------
+        bool
+            True if the message passed all the checks.
+        """
+        for check in self.checks:
+            if not check(context):
+                return False
+
+        return True
+
+    def validate(self, instance: dict) -> None:
+        """
+        Validate a rule against the rule schema.
+
+        Parameters
+        ----------
+        instance : dict
+            The decoded rule.
+
+        Raises
+        ------
+        jsonschema.exceptions.ValidationError
+            The most relevant error if the rule is not valid.
+        """
+        error = jsonschema.exceptions.best_match(self.get_validator().iter_errors(instance))
+
+        if error is not None:
+            raise error
+
+
+class KafkaRouterRuleSet:
+    """
+    The rules for a source topic, in the order that they are to be evaluated.
+
+    Rules that test for equality (a regexp or header_regexp that is an
+    anchored literal such as ``^GB$`` or an alternation of them such as
+    ``^(FR|DE)$``) are also indexed by the values that they match, so that
+    the equality rules that can match a message are found with one
+    dictionary lookup instead of a regular expression for each rule.  How
+    often each of those rules matches makes no difference to the cost of
+    finding them.  The other rules are always checked and the candidates are
+    still checked (with KafkaRouterRule.is_match) in the original order, so
+    the first match is the same as checking every rule in turn.
+
+    The regular expressions of the rules that match against the whole
+    message value are also combined into a single pattern (one for the rules
+    that match on the decoded value and one for those that match on bytes).
+    If one search with that pattern finds nothing, none of those rules can
+    match and they are not checked at all.  Patterns that cannot be safely
+    combined are left to be checked on their own.
+    """
+
+    def __init__(self) -> None:
+        self._combined = {}
+        self.always = []
+        self.combinable = {False: [], True: []}
+        self.dispatchers = {}
+        self.rules = []
+        self.tables = {}
+
+    def __len__(self) -> int:
+        """Get the number of rules."""
+        return len(self.rules)
+
+    def add(self, rule: KafkaRouterRule) -> None:
+        """
+        Append a rule to the set.
+
+        Parameters
+        ----------
+        rule : KafkaRouterRule
+            The rule to be appended.
+        """
+        index = len(self.rules)
+        self.rules.append(rule)
+
+        if rule.dispatch is None:
+            self.always.append(index)
+
+            if rule.is_combinable():
+                self.combinable[rule.bytes].append(index)
+                self._combined.pop(rule.bytes, None)
+
+            return
+
+        dimension, literals = rule.dispatch
+        self.dispatchers.setdefault(dimension, rule)
+        table = self.tables.setdefault(dimension, {})
+
+        for literal in literals:
+            table.setdefault(literal, []).append(index)
+
+    def get_candidates(self, context: MessageContext) -> list:
+        """
+        Get the rules that could match a message.
+
+        Parameters
+        ----------
+        context : MessageContext
+            The shared context of the message.
+
+        Returns
+        -------
+        list
+            The rules that are to be checked against the message, in the
+            order that they are to be checked.
+        """
+        if not self.tables and not self.get_combined():
+            return self.rules
+
+        indices = set(self.always) - self.scan(context)
+
+        for dimension, table in self.tables.items():
+            indices.update(self.lookup(table, self.dispatchers[dimension], context))
+
+        return [self.rules[index] for index in sorted(indices)]
+
+    def combine(self, matches_bytes: bool) -> None:
+        """
+        Compile the combined pattern of the rules that match the whole message.
+
+        The pattern is an alternation of the patterns of the rules, each in a
+        non-capturing group (a capturing group stops re from skipping ahead
+        to the characters that the patterns can start with).  If they cannot
+        be combined, the rules are checked on their own.
+
+        Parameters
+        ----------
+        matches_bytes : bool
+            Combine the rules that match on bytes (or those that match on the
+            decoded value).
+        """
+        pattern = '|'.join(f'(?:{self.rules[index].regexp})' for index in self.combinable[matches_bytes])
+
+        try:
+            self._combined[matches_bytes] = re.compile(pattern.encode('utf-8') if matches_bytes else pattern)
+        except re.error as ex:
+            logger.warning(f'Unable to combine the patterns of {len(self.combinable[matches_bytes])} rules ({ex}).')
+            self.combinable[matches_bytes] = []
+
+    def get_combined(self) -> dict:
+        """
+        Get the combined patterns of the rules that match the whole message.
+
+        The patterns are compiled when they are first needed, as the rules
+        are added one at a time.  A reloaded rule set compiles them before it
+        is swapped in (see KafkaRouter.build_rules).
+
+        Returns
+        -------
+        dict
+            The combined patterns (see combine) keyed on whether they match
+            on bytes.  Patterns are left out if there are fewer than two to
+            combine or they could not be combined.
+        """
+        for matches_bytes, indices in self.combinable.items():
+            if matches_bytes not in self._combined and len(indices) > 1:
+                self.combine(matches_bytes)
+
+        return self._combined
+
+    def get_values(self, dispatcher: KafkaRouterRule, context: MessageContext) -> list:
+        """
+        Get the values of a message that a table of equality rules is keyed on.
+
+        Parameters
+        ----------
+        dispatcher : KafkaRouterRule
+            A rule that extracts the values for the table.
+        context : MessageContext
+            The shared context of the message.
+
+        Returns
+        -------
+        list
+            The values or None if they cannot be extracted or are not all
+            strings (or bytes).
+        """
+        try:
+            values = dispatcher.get_dispatch_values(context)
+        except Exception:
+            return None
+
+        if all(isinstance(value, (str, bytes)) for value in values):
+            return values
+
+        return None
+
+    def lookup(self, table: dict, dispatcher: KafkaRouterRule, context: MessageContext) -> typing.Iterable:
+        """
+        Look up the equality rules that could match the values of a message.
+
+        A regular expression ending in "$" also matches a value with one
+        trailing newline, so that is looked up too.  If the values cannot be
+        extracted or are not strings, every rule in the table is a candidate
+        so that checking the rule reports the same outcome (or exception) as
+        before.
+
+        Parameters
+        ----------
+        table : dict
+            The indices of the rules keyed by the literal that they match.
+        dispatcher : KafkaRouterRule
+            A rule that extracts the values for the table.
+        context : MessageContext
+            The shared context of the message.
+
+        Returns
+        -------
+        iterable
+            The indices of the candidate rules.
+        """
+        values = self.get_values(dispatcher, context)
+
+        if values is None:
+            return itertools.chain.from_iterable(table.values())
+
+        keys = set(values) | {value[:-1] for value in values if value[-1:] in ('\n', b'\n')}
+        return itertools.chain.from_iterable(table.get(key, []) for key in keys)
+
+    def scan(self, context: MessageContext) -> set:
+        """
+        Scan the message value once with each combined pattern.
+
+        Parameters
+        ----------
+        context : MessageContext
+            The shared context of the message.
+
+        Returns
+        -------
+        set
+            The indices of the rules that cannot match the message.  The
+            rules of a combined pattern that matched (they are then checked
+            on their own) or that could not scan the value are left out.
+        """
+        excluded = set()
+
+        for matches_bytes, combined in self.get_combined().items():
+            try:
+                match = combined.search(context.raw_value() if matches_bytes else context.value())
+            except Exception:
+                continue
+
+            if not match:
+                excluded.update(self.combinable[matches_bytes])
+
+        return excluded
+
+
+class OffsetTracker:
+    """
+    Track consumed messages until all of the work for them has completed.
+
+    Each consumed message holds a count of outstanding work (the routing
+    of the message and each copy of it that is awaiting a delivery report).
+    Once the count for a message and for every message before it on the
+    same partition has dropped to zero, the offset after it can be committed.
+    Once any work for a message has failed, the committable position of its
+    partition is held before it (until the partition is revoked), so that it
+    is consumed again by the next consumer of the partition.
+    The tracker can be safely updated from more than one thread.
+    """
+
+    def __init__(self) -> None:
+        self._completed = 0
+        self._failed = {}
+        self._lock = threading.Lock()
+        self._partitions = {}
+        self._positions = {}
+
+    def add(self, message: Message, count: int = 1) -> None:
+        """
+        Add outstanding work to a message.
+
+        Parameters
+        ----------
+        message : Message
+            The consumed message.
+        count : int, optional
+            The amount of work to be added, by default 1
+        """
+        with self._lock:
+            pending = self._partitions.setdefault((message.topic(), message.partition()), {})
+            pending[message.offset()] = pending.get(message.offset(), 0) + count
+
+    def advance(self, key: tuple) -> None:
+        """
+        Move the committable position of a partition past completed messages.
+
+        Must be called with the lock held.
+
+        Parameters
+        ----------
+        key : tuple
+            The topic name and partition number.
+        """
+        pending = self._partitions[key]
+        failed = self._failed.get(key)
+
+        while pending:
+            offset = next(iter(pending))
+
+            if pending[offset] > 0:
+                break
+
+            del pending[offset]
+            self._completed += 1
+
+            if failed is None or offset < failed:
+                self._positions[key] = offset + 1
+
+    def completed(self) -> int:
+        """
+        Get the number of messages completed since the positions were last popped.
+
+        Returns
+        -------
+        int
+            The number of completed messages.
+        """
+        return self._completed
+
+    def done(self, message: Message, count: int = 1) -> None:
+        """
+        Mark units of work against a message as complete.
+
+        Messages that are not being tracked are ignored.
+
+        Parameters
+        ----------
+        message : Message
+            The consumed message.
+        count : int, optional
+            The amount of work that has been completed, by default 1
+        """
+        key = (message.topic(), message.partition())
+
+        with self._lock:
+            pending = self._partitions.get(key, {})
+
+            if message.offset() in pending:
+                pending[message.offset()] -= count
+                self.advance(key)
+
+    def fail(self, message: Message) -> None:
+        """
+        Record that some of the work for a message has failed.
+
+        The committable position of the partition never moves past the
+        message.  Messages that are not being tracked are ignored.
+
+        Parameters
+        ----------
+        message : Message
+            The consumed message.
+        """
+        key = (message.topic(), message.partition())
+
+        with self._lock:
+            if message.offset() in self._partitions.get(key, {}):
+                self._failed[key] = min(self._failed.get(key, message.offset()), message.offset())
+
+    def pop_positions(self) -> tuple:
+        """
+        Get (and reset) the positions that have advanced since the last call.
+
+        Returns
+        -------
+        tuple
+            A list of TopicPartition objects with the offsets to be committed and
+            the number of messages that have been completed.
+        """
+        with self._lock:
+            positions = self._positions
+            completed = self._completed
+            self._completed = 0
+            self._positions = {}
+
+        offsets = [TopicPartition(topic, partition, offset) for (topic, partition), offset in positions.items()]
+        return offsets, completed
+
+    def revoke(self, partitions: list) -> None:
+        """
+        Stop tracking messages on partitions that are no longer assigned.
+
+        Parameters
+        ----------
+        partitions : list
+            A list of TopicPartition objects.
+        """
+        with self._lock:
+            for partition in partitions:
+                key = (partition.topic, partition.partition)
+                self._failed.pop(key, None)
+                self._partitions.pop(key, None)
+                self._positions.pop(key, None)
+
+
+class DlqIndex:
+    """
+    A memory-mapped index of DLQ header values to the offsets of the messages.
+
+    The file starts with HEADER (MAGIC and the position and length of a JSON
+    directory), followed by the postings: a POSTING (partition, offset) pair
+    for each indexed message, grouped by topic, header key and header value.
+    Only the directory is read into memory.  The postings of a header value
+    are read from the mapped file when they are looked up.
+
+    The directory is an object with two keys.  "values" maps each topic,
+    header key and header value to the position and number of its postings.
+    "ends" maps each topic and partition to the offset that the topic had
+    been indexed up to.
+
+    Parameters
+    ----------
+    path : str
+        The path of the index file.
+    """
+
+    HEADER = struct.Struct('<8sQQ')
+    MAGIC = b'KRDLQIX1'
+    POSTING = struct.Struct('<qq')
+
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as stream:
+            self._map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, position, length = self.HEADER.unpack_from(self._map)
+
+        if magic != self.MAGIC:
+            raise ValueError(f'{path} is not a DLQ index.')
+
+        directory = json.loads(self._map[position:position + length])
+        self.ends = directory['ends']
+        self.values = directory['values']
+
+    def get_postings(self, position: int, count: int) -> typing.Iterator:
+        """
+        Read postings from the mapped file.
+
+        Parameters
+        ----------
+        position : int
+            The position of the first posting in the file.
+        count : int
+            The number of postings.
+
+        Returns
+        -------
+        typing.Iterator
+            The (partition, offset) tuples.
+        """
+        return self.POSTING.iter_unpack(memoryview(self._map)[position:position + count * self.POSTING.size])
+
+    def is_match(self, rule: KafkaRouterRule, value: str) -> bool:
+        """
+        Check if an indexed header value matches the header_regexp of a rule.
+
+        Parameters
+        ----------
+        rule : KafkaRouterRule
+            The rule.
+        value : str
+            The indexed header value.  The bytes of header values that are
+            not valid UTF-8 are kept as surrogates, so they can be encoded
+            back to the original bytes for rules that match on bytes.
+
+        Returns
+        -------
+        bool
+            True if the value matches.
+        """
+        if rule.bytes:
+            value = value.encode('utf-8', 'surrogateescape')
+
+        return rule.header_pattern.search(value) is not None
+
+    def lookup(self, topic: str, rules: list) -> dict:
+        """
+        Get the offsets of the messages with a header value that matches any of a set of rules.
+
+        Parameters
+        ----------
+        topic : str
+            The topic name.
+        rules : list
+            The KafkaRouterRule objects to search the header values with.
+
+        Returns
+        -------
+        dict
+            Sets of offsets keyed on the partition number.
+        """
+        offsets = {}
+
+        for rule in rules:
+            for value, (position, count) in self.values[topic][rule.header].items():
+                if self.is_match(rule, value):
+                    for partition, offset in self.get_postings(position, count):
+                        offsets.setdefault(partition, set()).add(offset)
+
+        return offsets
+
+    def select(self, topic: str, rules: list) -> dict:
+        """
+        Select the offsets of a topic that a set of rules could match.
+
+        The index can only be used if every rule for the topic matches on a
+        header that has been indexed.  Otherwise, every message of the topic
+        must be read.
+
+        Parameters
+        ----------
+        topic : str
+            The topic name.
+        rules : list
+            The KafkaRouterRule objects for the topic.
+
+        Returns
+        -------
+        dict
+            Keyed on (topic, partition), a tuple of the sorted offsets and the
+            offset that the partition had been indexed up to (anything from
+            there onwards must be read).  None if the index can not be used.
+        """
+        headers = self.values.get(topic, {})
+
+        if not rules or not all(rule.header in headers for rule in rules):
+            return None
+
+        offsets = self.lookup(topic, rules)
+        return {(topic, int(partition)): (sorted(offsets.get(int(partition), [])), end)
+                for partition, end in self.ends.get(topic, {}).items()}
+
+
+class DlqIndexWriter:
+    """
+    Build a DlqIndex by scanning DLQ topics (KAFKA_ROUTER_DLQ_INDEX_MODE).
+
+    Parameters
+    ----------
+    path : str
+        The path of the index file to be written.
+    headers : list
+        The header keys to be indexed.  If empty, every header with a key
+        ending in one of DEFAULT_SUFFIXES is indexed.
+    """
+
+    DEFAULT_SUFFIXES = ('.message', '.topic')
+
+    def __init__(self, path: str, headers: list) -> None:
+        self.headers = set(headers)
+        self.path = path
+        self.postings = {}
+
+    def add(self, message: Message) -> None:
+        """
+        Add the indexed headers of a message to the index.
+
+        Parameters
+        ----------
+        message : Message
+            The consumed message.
+        """
+        for key, value in message.headers() or []:
+            if self.is_indexed(key):
+                value = value.decode('utf-8', 'surrogateescape') if isinstance(value, bytes) else str(value)
+                postings = self.postings.setdefault((message.topic(), key, value), array.array('q'))
+                postings.extend((message.partition(), message.offset()))
+
+    def add_messages(self, messages: list) -> None:
+        """
+        Add the indexed headers of consumed messages to the index.
+
+        Parameters
+        ----------
+        messages : list
+            The consumed messages.
+        """
+        for message in messages:
+            self.add(message)
+
+    def is_indexed(self, key: str) -> bool:
+        """
+        Check if a header is to be indexed.
+
+        Parameters
+        ----------
+        key : str
+            The header key.
+
+        Returns
+        -------
+        bool
+            True if the header is to be indexed.
+        """
+        if self.headers:
+            return key in self.headers
+
+        return key.endswith(self.DEFAULT_SUFFIXES)
+
+    def write(self, ends: dict) -> None:
+        """
+        Write the index file (replacing any previous one).
+
+        Parameters
+        ----------
+        ends : dict
+            The offset that each (topic, partition) has been indexed up to.
+        """
+        directory = {'ends': {}, 'values': {}}
+
+        for (topic, partition), end in ends.items():
+            directory['ends'].setdefault(topic, {})[str(partition)] = end
+
+        with open(f'{self.path}.tmp', 'wb') as stream:
+            position = stream.write(bytes(DlqIndex.HEADER.size))
+
+            for (topic, key, value), postings in sorted(self.postings.items()):
+                directory['values'].setdefault(topic, {}).setdefault(key, {})[value] = [position, len(postings) // 2]
+
+                if sys.byteorder != 'little':
+                    postings.byteswap()
+
+                position += stream.write(postings.tobytes())
+
+            length = stream.write(json.dumps(directory).encode())
+            stream.seek(0)
+            stream.write(DlqIndex.HEADER.pack(DlqIndex.MAGIC, position, length))
+
+        os.replace(f'{self.path}.tmp', self.path)
+
+
+class ReplayWindow:
+    """
+    The offsets of each partition that a DLQ replay starts and stops at.
+
+    When partitions are assigned, their high watermarks are fetched so that
+    the replay can stop as soon as every assigned partition has been read up
+    to where it was when the replay started, rather than after
+    KAFKA_ROUTER_TIMEOUT_MS of idle time.  The replay can also be limited to
+    a range of offsets or of timestamps (resolved with offsets_for_times).
+    Ranges include the start and exclude the end.  Partitions can also be
+    limited to the offsets selected from a DlqIndex, seeking over the gaps
+    between them.
+
+    Parameters
+    ----------
+    start_offset : int, optional
+        The offset to start each partition at, by default None (the committed
+        offset of the consumer group).
+    end_offset : int, optional
+        The offset to stop each partition at, by default None (the high
+        watermark).
+    start_timestamp_ms : int, optional
+        Start each partition at the first message at or after this time (in
+        milliseconds since the epoch), by default None
+    end_timestamp_ms : int, optional
+        Stop each partition at the first message at or after this time, by
+        default None
+    timeout : float, optional
+        The timeout (in seconds) of the offset queries, by default 10.0
+    """
+
+    SEEK_GAP = 1000
+
+    def __init__(self, start_offset: int = None, end_offset: int = None, start_timestamp_ms: int = None,
+                 end_timestamp_ms: int = None, timeout: float = 10.0) -> None:
+        self.end_offset = end_offset
+        self.end_timestamp_ms = end_timestamp_ms
+        self.ends = {}
+        self.finished = set()
+        self.selections = {}
+        self.start_offset = start_offset
+        self.start_timestamp_ms = start_timestamp_ms
+        self.timeout = timeout
+
+    def assign(self, consumer: Consumer, partitions: list, selections: dict = None) -> list:
+        """
+        Resolve the start and end offsets of newly assigned partitions.
+
+        Parameters
+        ----------
+        consumer : Consumer
+            The consumer that the partitions have been assigned to.
+        partitions : list
+            The assigned TopicPartition objects.
+        selections : dict, optional
+            The offsets selected from a DlqIndex (see DlqIndex.select) keyed
+            on (topic, partition), by default None (read every offset).
+
+        Returns
+        -------
+        list
+            The TopicPartition objects, with the start offsets set (if a
+            start has been configured).
+        """
+        starts = self.get_offsets(consumer, partitions, self.start_offset, self.start_timestamp_ms)
+        ends = self.get_offsets(consumer, partitions, self.end_offset, self.end_timestamp_ms)
+        ends = [-1 if end is None else end for end in ends]
+
+        for partition, start, end in zip(partitions, starts, ends):
+            self.assign_partition(consumer, partition, start, end)
+            self.select(partition, (selections or {}).get((partition.topic, partition.partition)))
+
+        return partitions
+
+    def assign_partition(self, consumer: Consumer, partition: TopicPartition, start: int, end: int) -> None:
+        """
+        Resolve the start and end offsets of a newly assigned partition.
+
+        Parameters
+        ----------
+        consumer : Consumer
+            The consumer that the partition has been assigned to.
+        partition : TopicPartition
+            The partition.  Its offset is set to the start offset (if any).
+        start : int
+            The start offset, None to start from the committed offset or
+            negative to start after the last message.
+        end : int
+            The end offset, negative to stop at the high watermark.
+        """
+        low, high = consumer.get_watermark_offsets(partition, timeout=self.timeout, cached=False)
+        key = (partition.topic, partition.partition)
+        self.ends[key] = high if end < 0 else min(end, high)
+
+        if start is not None:
+            partition.offset = high if start < 0 else max(start, low)
+            low = partition.offset
+
+        if low >= self.ends[key]:
+            self.finished.add(key)
+
+        logger.info(f'Replaying {key} up to offset {self.ends[key]}.')
+
+    def complete(self) -> bool:
+        """
+        Check if every assigned partition has been replayed.
+
+        Returns
+        -------
+        bool
+            True if partitions have been assigned and all of them have been
+            read up to their end offsets.
+        """
+        return bool(self.ends) and self.finished.issuperset(self.ends)
+
+    def filter(self, messages: list) -> list:
+        """
+        Drop messages at or after the end of their partition.
+
+        Also notes the partitions that have been read up to their end offsets.
+
+        Parameters
+        ----------
+        messages : list
+            The consumed messages.
+
+        Returns
+        -------
+        list
+            The messages that are within the replay.
+        """
+        replayed = []
+
+        for message in messages:
+            key = (message.topic(), message.partition())
+            end = self.ends.get(key, float('inf'))
+
+            if message.offset() + 1 >= end:
+                self.finished.add(key)
+
+            if message.offset() < end and self.is_selected(key, message.offset()):
+                replayed.append(message)
+
+        return replayed
+
+    def get_next(self, key: tuple, offset: int) -> int:
+        """
+        Get the next selected offset of a partition after an offset.
+
+        Parameters
+        ----------
+        key : tuple
+            The (topic, partition) tuple.
+        offset : int
+            The offset.
+
+        Returns
+        -------
+        int
+            The next selected offset.
+        """
+        offsets, indexed_end = self.selections[key]
+        index = bisect.bisect_right(offsets, offset)
+        return offsets[index] if index < len(offsets) else max(indexed_end, offset + 1)
+
+    def get_offsets(self, consumer: Consumer, partitions: list, offset: int, timestamp_ms: int) -> list:
+        """
+        Get an offset of each partition from an offset or a timestamp.
+
+        Parameters
+        ----------
+        consumer : Consumer
+            The consumer to query the offsets with.
+        partitions : list
+            The TopicPartition objects.
+        offset : int
+            The offset.  Can be None.
+        timestamp_ms : int
+            The timestamp, which takes precedence over the offset.  Can be None.
+
+        Returns
+        -------
+        list
+            The offset of each partition.  None if neither an offset nor a
+            timestamp has been given, negative if there is no message at or
+            after the timestamp.
+        """
+        if timestamp_ms is None:
+            return [offset] * len(partitions)
+
+        query = [TopicPartition(partition.topic, partition.partition, timestamp_ms) for partition in partitions]
+        return [partition.offset for partition in consumer.offsets_for_times(query, timeout=self.timeout)]
+
+    def is_selected(self, key: tuple, offset: int) -> bool:
+        """
+        Check if an offset of a partition is to be replayed.
+
+        Parameters
+        ----------
+        key : tuple
+            The (topic, partition) tuple.
+        offset : int
+            The offset.
+
+        Returns
+        -------
+        bool
+            False if the offset was not selected from the index.
+        """
+        return key not in self.selections or self.get_next(key, offset - 1) == offset
+
+    def revoke(self, partitions: list) -> None:
+        """
+        Stop tracking partitions that are no longer assigned.
+
+        Parameters
+        ----------
+        partitions : list
+            A list of TopicPartition objects.
+        """
+        for partition in partitions:
+            key = (partition.topic, partition.partition)
+            self.ends.pop(key, None)
+            self.finished.discard(key)
+            self.selections.pop(key, None)
+
+    def select(self, partition: TopicPartition, selection: tuple) -> None:
+        """
+        Limit a newly assigned partition to the offsets selected from a DlqIndex.
+
+        Parameters
+        ----------
+        partition : TopicPartition
+            The partition, whose offset is moved to the first selected offset.
+        selection : tuple
+            The sorted offsets and the offset that the partition had been
+            indexed up to.  Can be None to read every offset.
+        """
+        if selection is None:
+            return
+
+        key = (partition.topic, partition.partition)
+        self.selections[key] = selection
+        partition.offset = self.get_next(key, max(partition.offset, 0) - 1)
+
+        if partition.offset >= self.ends[key]:
+            self.finished.add(key)
+
+    def skip_ahead(self, messages: list) -> list:
+        """
+        Get where to seek to over gaps between the selected offsets.
+
+        Partitions with no selected offsets left are noted as replayed.
+
+        Parameters
+        ----------
+        messages : list
+            The consumed messages.
+
+        Returns
+        -------
+        list
+            TopicPartition objects with the offsets to seek to.
+        """
+        consumed = {(message.topic(), message.partition()): message.offset() for message in messages}
+        seeks = []
+
+        for key in consumed.keys() & self.selections.keys() - self.finished:
+            following = self.get_next(key, consumed[key])
+
+            if following >= self.ends[key]:
+                self.finished.add(key)
+            elif following - consumed[key] > self.SEEK_GAP:
+                seeks.append(TopicPartition(*key, following))
+
+        return seeks
+
+    def update_positions(self, consumer: Consumer) -> None:
+        """
+        Note partitions whose position has reached their end offset.
+
+        Catches up partitions that end in records that are never returned to
+        the consumer (e.g. transaction markers).
+
+        Parameters
+        ----------
+        consumer : Consumer
+            The consumer that the partitions are assigned to.
+        """
+        pending = [TopicPartition(*key) for key in self.ends if key not in self.finished]
+
+        for partition in consumer.position(pending):
+            if partition.offset >= self.ends[(partition.topic, partition.partition)]:
+                self.finished.add((partition.topic, partition.partition))
+
+
+class StackTraceSampler:
+    """
+    Format the stack traces of exceptions for the DLQ headers, deduplicating repeats.
+
+    The stack of an exception is identified by a reference made from its type
+    and the code and line number of each frame of its traceback, which is
+    much cheaper than formatting it.  The first of every `interval`
+    exceptions with the same reference is formatted in full and the others
+    only refer to it.
+
+    Parameters
+    ----------
+    interval : int
+        How often a repeated stack trace is sampled in full.  If 1, every
+        stack trace is formatted and no reference is made.
+    """
+
+    MAX_REFERENCES = 1000
+
+    def __init__(self, interval: int) -> None:
+        self.counts = {}
+        self.interval = max(interval, 1)
+
+    def format(self, ex: BaseException) -> tuple:
+        """
+        Format the stack trace of an exception (or refer to an earlier sample of it).
+
+        Parameters
+        ----------
+        ex : BaseException
+            The exception.
+
+        Returns
+        -------
+        tuple
+            The reference of the stack (None if sampling is off) and either the
+            formatted stack trace or a note that it has been sampled on an
+            earlier message.
+        """
+        if self.interval == 1:
+            return None, ''.join(traceback.format_exception(type(ex), ex, ex.__traceback__))
+
+        reference = self.get_reference(ex)
+
+        if len(self.counts) >= self.MAX_REFERENCES and reference not in self.counts:
+            self.counts.clear()
+
+        count = self.counts.get(reference, 0)
+        self.counts[reference] = count + 1
+
+        if count % self.interval == 0:
+            return reference, ''.join(traceback.format_exception(type(ex), ex, ex.__traceback__))
+
+        return reference, f'Repeated stack trace {reference} ({count + 1} so far), sampled every {self.interval}.'
+
+    @staticmethod
+    def get_reference(ex: BaseException) -> str:
+        """
+        Get the reference of the stack of an exception.
+
+        Parameters
+        ----------
+        ex : BaseException
+            The exception.
+
+        Returns
+        -------
+        str
+            A CRC32 of the exception type and of the frames of its traceback
+            as 8 hex digits.
+        """
+        frames = [type(ex).__qualname__]
+        frame = ex.__traceback__
+
+        while frame is not None:
+            frames.append(f'{frame.tb_frame.f_code.co_filename}:{frame.tb_frame.f_code.co_name}:{frame.tb_lineno}')
+            frame = frame.tb_next
+
+        return f'{zlib.crc32(chr(10).join(frames).encode()):08x}'
+
+
+class KafkaRouter:
+    """
+    A class for routing Kafka traffic to/from topics according to configurable rule.
+
+    Parameters
+    ----------
+    DLQ_topic_name : str, optional
+        The name of the dead letter queue topic, by default None
+    """
+
+    DLQ_HEADER_NAMES = ('topic', 'partition', 'offset', 'message', 'stacktrace', 'stacktrace.reference')
+    NO_RULES = KafkaRouterRuleSet()
+
+    def __init__(self, DLQ_topic_name: str = None) -> None:
+        env_config = EnvironmentConfig()
+        self._local = threading.local()
+        self._headers = []
+        self.consumer_conf = env_config.get_config('KAFKA_CONSUMER_')
+        self.producer_conf = env_config.get_config('KAFKA_PRODUCER_')
+        self.prometheus_disabled = env_config.get_boolean('KAFKA_ROUTER_PROMETHEUS_DISABLED')
+        self.DLQ_topic_name = DLQ_topic_name
+        self.source_topics = []
+        self.expressions = {}
+        self.rule_metrics = {}
+        self.rule_metrics_mode = env_config.get_boolean('KAFKA_ROUTER_PER_RULE_METRICS')
+        self.rule_metrics_max_rules = int(os.getenv('KAFKA_ROUTER_PER_RULE_METRICS_MAX_RULES', '100'))
+        self.rule_metrics_sample_rate = float(os.getenv('KAFKA_ROUTER_PER_RULE_METRICS_SAMPLE_RATE', '0.01'))
+        self.rules = []
+        self.rules_by_topic = {}
+        self.sentry_enabled = bool(os.getenv('SENTRY_DSN'))
+        self.rules_path = os.getenv('KAFKA_ROUTER_RULES_PATH')
+        self.rules_reload_interval_ms = int(os.getenv('KAFKA_ROUTER_RULES_RELOAD_INTERVAL_MS', '5000'))
+        self._pending_rules = None
+        self._reload_requested = threading.Event()
+        self._rules_lock = threading.Lock()
+        self._rules_signature = None
+        self.get_rules()
+        signal.signal(signal.SIGINT, self.handler)
+        signal.signal(signal.SIGTERM, self.handler)
+
+        if self.rules_path:
+            signal.signal(signal.SIGHUP, self.reload_handler)
+
+        self.running(True)
+        self.dlq_mode(env_config.get_boolean('KAFKA_ROUTER_DLQ_MODE'))
+        logger.info(f'DLQ mode - {self.dlq_mode()}')
+        self.dry_run_mode(env_config.get_boolean('KAFKA_ROUTER_DRY_RUN_MODE'))
+        logger.info(f'Dry run mode - {self.dry_run_mode()}')
+        self.pipelined_mode(env_config.get_boolean('KAFKA_ROUTER_PIPELINED_MODE'))
+        logger.info(f'Pipelined mode - {self.pipelined_mode()}')
+        self.max_in_flight = int(os.getenv('KAFKA_ROUTER_MAX_IN_FLIGHT', '10000'))
+        self.backpressure_max_messages = int(os.getenv('KAFKA_ROUTER_BACKPRESSURE_MAX_MESSAGES', self.max_in_flight))
+        self.backpressure_max_bytes = int(os.getenv('KAFKA_ROUTER_BACKPRESSURE_MAX_BYTES', 256 * 1024 ** 2))
+        self.backpressure_resume_ratio = float(os.getenv('KAFKA_ROUTER_BACKPRESSURE_RESUME_RATIO', '0.5'))
+        self._backpressure_paused = []
+        self._in_flight_bytes = 0
+        self._in_flight_lock = threading.Lock()
+        self.batch_size = int(os.getenv('KAFKA_ROUTER_BATCH_SIZE', '1'))
+        self.batch_timeout_ms = int(os.getenv('KAFKA_ROUTER_BATCH_TIMEOUT_MS', '1000'))
+        logger.info(f'Batch mode - {self.batch_mode()}')
+        self.commit_count = int(os.getenv('KAFKA_ROUTER_COMMIT_COUNT', '0'))
+        self.commit_interval_ms = int(os.getenv('KAFKA_ROUTER_COMMIT_INTERVAL_MS', '0'))
+        logger.info(f'Coalesced commits - {self.coalesced_commits()}')
+        self.concurrency = int(os.getenv('KAFKA_ROUTER_CONCURRENCY', '1'))
+        logger.info(f'Concurrent mode - {self.concurrent_mode()}')
+        self.offset_tracker = OffsetTracker()
+        self._lanes = []
+        self._lane_errors = []
+        self._lane_futures = set()
+        self._lane_slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._commit_start_times = {}
+        self._last_commit_time = time.time()
+
+        self.replay = ReplayWindow(
+            env_config.get_integer('KAFKA_ROUTER_DLQ_START_OFFSET'),
+            env_config.get_integer('KAFKA_ROUTER_DLQ_END_OFFSET'),
+            env_config.get_integer('KAFKA_ROUTER_DLQ_START_TIMESTAMP_MS'),
+            env_config.get_integer('KAFKA_ROUTER_DLQ_END_TIMESTAMP_MS')
+        )
+        self.init_dlq_index(env_config)
+        self.dlq_batch_size = int(os.getenv('KAFKA_ROUTER_DLQ_BATCH_SIZE', '1'))
+        self.stack_traces = StackTraceSampler(int(os.getenv('KAFKA_ROUTER_DLQ_STACKTRACE_SAMPLE_INTERVAL', '1')))
+        self._dlq_header_keys = None
+        self._dlq_held = []
+
+        if self.dlq_mode():
+            self.timeout_ms = int(os.getenv('KAFKA_ROUTER_TIMEOUT_MS', '500'))
+            logger.debug(f'Timeout - {self.timeout_ms}ms.')
+        else:
+            self.timeout_ms = 0
+
+        self.consumer = None
+        self.producer = None
+
+    def add_exception_headers(self, message: Message, ex: Exception) -> None:
+        """
+        Add the DLQ headers explaining why a message could not be matched.
+
+        Must be called while the exception is being handled so that the
+        stack trace is available.
+
+        Parameters
+        ----------
+        message : Message
+            The message that could not be matched.
+        ex : Exception
+            The exception that was raised when matching the message.
+        """
+        keys = self.get_dlq_header_keys()
+        reference, stacktrace = self.stack_traces.format(ex)
+        headers = {
+            keys['topic']: message.topic(),
+            keys['partition']: message.partition(),
+            keys['offset']: message.offset(),
+            keys['message']: ex,
+            keys['stacktrace']: stacktrace
+        }
+
+        if reference is not None:
+            headers[keys['stacktrace.reference']] = reference
+
+        self.upsert_headers(headers)
+
+    def add_rule(self, rule: KafkaRouterRule, target: object = None) -> None:
+        """
+        Append the KafkaRouterRule to the rules.
+
+        Also append the source topic to the source topics if it's not already there
+        and index the rule against its source topic.  Rules are kept in the order
+        they were added within each topic, so the first-match order is preserved.
+        Rules with the same JMESPath expression share a single compiled
+        expression, which is only evaluated once per message.
+
+        Parameters
+        ----------
+        rule : KafkaRouterRule
+            The KafkaRouterRule to be added.
+        target : object, optional
+            The holder of the expressions, rules, rules_by_topic and
+            source_topics to add the rule to, by default the router itself.
+            A rule set that is being reloaded is built up on a separate target.
+        """
+        target = target or self
+
+        if rule.expression:
+            rule.expression = target.expressions.setdefault(rule.jmespath, rule.expression)
+
+        if self.rule_metrics_mode:
+            rule.metrics = self.get_rule_metrics(rule)
+
+        target.rules.append(rule)
+
+        source_topic = rule.source_topic
+        target.rules_by_topic.setdefault(source_topic, KafkaRouterRuleSet()).add(rule)
+
+        if source_topic not in target.source_topics:
+            target.source_topics.append(source_topic)
+
+    def apply_backpressure(self) -> None:
+        """
+        Pause or resume the source partitions according to the producer queue.
+
+        The assigned partitions are paused once the producer has
+        KAFKA_ROUTER_BACKPRESSURE_MAX_MESSAGES messages or
+        KAFKA_ROUTER_BACKPRESSURE_MAX_BYTES bytes in flight.  They are resumed
+        once both have fallen below KAFKA_ROUTER_BACKPRESSURE_RESUME_RATIO of
+        those limits.
+        """
+        if not self._backpressure_paused and self.producer_over_limit(1.0):
+            self.pause_for_backpressure()
+        elif self._backpressure_paused and not self.producer_over_limit(self.backpressure_resume_ratio):
+            self.resume_from_backpressure()
+
+    def apply_pending_rules(self) -> None:
+        """
+        Swap in a rule set that has been reloaded (if any).
+
+        Called from the router loop between messages.  Messages that are
+        already being routed keep the rule set that they started with.  If
+        the source topics have changed, the consumer is re-subscribed.
+        """
+        with self._rules_lock:
+            staged, self._pending_rules = self._pending_rules, None
+
+        if staged is None:
+            return
+
+        topics_changed = sorted(staged.source_topics) != sorted(self.source_topics)
+        self.expressions = staged.expressions
+        self.rules_by_topic = staged.rules_by_topic
+        self.rules = staged.rules
+        self.source_topics = staged.source_topics
+        logger.info(f'Swapped in {len(self.rules)} reloaded rules.')
+
+        if topics_changed:
+            logger.info(f'Re-subscribing to {self.source_topics}.')
+            self.subscribe()
+
+    def batch_mode(self) -> bool:
+        """
+        Check if messages are to be consumed and processed in batches.
+
+        Returns
+        -------
+        bool
+            True if KAFKA_ROUTER_BATCH_SIZE is greater than one.
+        """
+        return self.batch_size > 1
+
+    def build_rules(self, sources: dict) -> types.SimpleNamespace:
+        """
+        Validate and compile a new rule set without changing the running one.
+
+        Parameters
+        ----------
+        sources : dict
+            The rules as JSON strings keyed on their names.
+
+        Returns
+        -------
+        types.SimpleNamespace
+            The expressions, rules, rules_by_topic and source_topics of the
+            new rule set.
+
+        Raises
+        ------
+        SystemExit
+            If any of the rules are invalid.
+        """
+        target = types.SimpleNamespace(expressions={}, rules=[], rules_by_topic={}, source_topics=[])
+
+        for name in sorted(sources):
+            self.add_rule(KafkaRouterRule(name, sources[name]), target)
+
+        # Compile the combined patterns here, off the hot path, not on the first message after the swap.
+        for rule_set in target.rules_by_topic.values():
+            rule_set.get_combined()
+
+        return target
+
+    def check_for_timeout(self, time_of_last_message: int) -> None:
+        """
+        Check if we have exceeded the timeout_ms (or the replay is complete).
+
+        Only does anything significant is DLQ mode is enabled.  The timeout is
+        a fallback for a replay that never has partitions assigned to it.
+
+        Parameters
+        ----------
+        time_of_last_message : int
+            The timestamp (in ms) of when the last message was processed.
+        """
+        if not self.dlq_mode() or self._backpressure_paused:
+            return
+
+        self.replay.update_positions(self.consumer)
+
+        if self.replay.complete():
+            logger.info('Every assigned partition has been replayed.')
+            self.running(False)
+            return
+
+        time_now = time.time() * 1000
+
+        if time_now - time_of_last_message >= self.timeout_ms:
+            logger.warning(f'Timeout ({self.timeout_ms}ms) since last message consumed.')
+            self.running(False)
+
+    def close(self) -> None:
+        """Wait for any messages in flight and close the consumer."""
+        try:
+            self.drain()
+            self.write_dlq_index()
+        finally:
+            for lane in self._lanes:
+                lane.shutdown()
+
+            logger.info('Closing the consumer.')
+            self.consumer.close()
+
+    def coalesced_commits(self) -> bool:
+        """
+        Check if commits are to be coalesced.
+
+        Returns
+        -------
+        bool
+            True if either KAFKA_ROUTER_COMMIT_COUNT or KAFKA_ROUTER_COMMIT_INTERVAL_MS
+            have been set.
+        """
+        return self.commit_count > 0 or self.commit_interval_ms > 0
+
+    def commit(self, message: Message) -> None:
+        """
+        Commit the consumer unless DLQ mode is enabled.
+
+        If offsets are being tracked (pipelined mode or coalesced commits),
+        the message is marked as processed and the offsets of completed
+        messages are committed when a commit is due.
+
+        Parameters
+        ----------
+        message : Message
+            The message to be committed.
+        """
+        if self.tracking_offsets():
+            self.offset_tracker.done(message)
+            self.commit_offsets()
+        elif self._dlq_held:
+            self.commit_dlq_batch(message)
+        elif not self.dlq_mode():
+            start_time = time.time()
+            self.consumer.commit(message)
+            consumer_commit_latency_seconds.observe(time.time() - start_time)
+            logger.debug('Successfully committed consumer.')
+            consumer_commit_batch_size.observe(1)
+            consumer_message_committed_count.inc()
+
+    def commit_batch(self, messages: list) -> None:
+        """
+        Commit a batch of messages as a unit unless DLQ mode is enabled.
+
+        Parameters
+        ----------
+        messages : list
+            The messages in the batch.
+        """
+        if self.tracking_offsets():
+            for message in messages:
+                self.offset_tracker.done(message)
+
+            self.commit_offsets()
+        elif not self.dlq_mode():
+            offsets = self.get_batch_offsets(messages)
+            self.commit_positions(offsets, len(messages), False)
+
+    def commit_dlq_batch(self, message: Message = None) -> None:
+        """
+        Flush the DLQ messages being held and commit them.
+
+        Until KAFKA_ROUTER_DLQ_BATCH_SIZE are held, nothing is done when the
+        message being committed is the last one held.  Only called when DLQ
+        messages are being held.
+
+        Parameters
+        ----------
+        message : Message, optional
+            A message to be committed along with them, by default None
+        """
+        if message is self._dlq_held[-1] and len(self._dlq_held) < self.dlq_batch_size:
+            return
+
+        messages, self._dlq_held = self._dlq_held, []
+
+        if message is not None and message is not messages[-1]:
+            messages.append(message)
+
+        self.producer.flush()
+        logger.debug(f'Flushed a batch of {len(messages)} messages, including DLQ messages.')
+        self.commit_positions(self.get_batch_offsets(messages), len(messages), False)
+
+    def commit_due(self) -> bool:
+        """
+        Check if the tracked offsets are due to be committed.
+
+        Returns
+        -------
+        bool
+            If commits are not coalesced, True if any messages have been
+            completed.  Otherwise True if KAFKA_ROUTER_COMMIT_COUNT messages have
+            been completed or KAFKA_ROUTER_COMMIT_INTERVAL_MS has passed since
+            the last commit.
+        """
+        completed = self.offset_tracker.completed()
+
+        if not self.coalesced_commits():
+            return completed > 0
+        elif self.commit_count and completed >= self.commit_count:
+            return True
+
+        elapsed_ms = (time.time() - self._last_commit_time) * 1000
+        return self.commit_interval_ms > 0 and elapsed_ms >= self.commit_interval_ms
+
+    def commit_offsets(self, force: bool = False) -> None:
+        """
+        Commit the offsets of completed messages.
+
+        Coalesced commits are made asynchronously unless forced.
+
+        Parameters
+        ----------
+        force : bool, optional
+            Commit synchronously, even if a commit is not due, by default False
+        """
+        if not (force or self.commit_due()):
+            return
+
+        offsets, completed = self.offset_tracker.pop_positions()
+        self._last_commit_time = time.time()
+
+        if offsets:
+            self.commit_positions(offsets, completed, self.coalesced_commits() and not force)
+
+    def commit_positions(self, offsets: list, completed: int, asynchronous: bool) -> None:
+        """
+        Commit offsets on the consumer and record the commit metrics.
+
+        Parameters
+        ----------
+        offsets : list
+            A list of TopicPartition objects to be committed.
+        completed : int
+            The number of messages being committed.
+        asynchronous : bool
+            If True, the commit latency is recorded by commit_report.
+        """
+        start_time = time.time()
+
+        if asynchronous:
+            for offset in offsets:
+                self._commit_start_times[(offset.topic, offset.partition, offset.offset)] = start_time
+
+        self.consumer.commit(offsets=offsets, asynchronous=asynchronous)
+
+        if not asynchronous:
+            consumer_commit_latency_seconds.observe(time.time() - start_time)
+
+        logger.debug(f'Successfully committed {completed} message(s) on the consumer.')
+        consumer_commit_batch_size.observe(completed)
+        consumer_message_committed_count.inc(completed)
+
+    def commit_report(self, err: KafkaError, partitions: list) -> None:
+        """
+        Get the result of an asynchronous commit.
+
+        Parameters
+        ----------
+        err : KafkaError
+            Will be None if no error happened.
+        partitions : list
+            The TopicPartition objects that were committed.
+        """
+        start_time = self.pop_commit_start_time(partitions)
+
+        if err is not None:
+            logger.error(f'Failed to commit offsets: "{err}".')
+        elif start_time is not None:
+            consumer_commit_latency_seconds.observe(time.time() - start_time)
+
+    def concurrent_mode(self) -> bool:
+        """
+        Check if messages are to be processed concurrently.
+
+        Returns
+        -------
+        bool
+            True if KAFKA_ROUTER_CONCURRENCY is greater than one.
+        """
+        return self.concurrency > 1
+
+    def consume(self) -> list:
+        """
+        Consume the next message (or batch of messages in batch mode).
+
+        Returns
+        -------
+        list
+            The messages consumed.  Empty if there were no messages to consume.
+        """
+        if self.batch_mode():
+            timeout = self.get_poll_timeout(self.batch_timeout_ms / 1000)
+            return self.consumer.consume(num_messages=self.batch_size, timeout=timeout)
+
+        message = self.consumer.poll(timeout=self.get_poll_timeout(1.0))
+        return [] if message is None else [message]
+
+    def create_clients(self, consumer_factory: callable = Consumer, producer_factory: callable = Producer) -> None:
+        """
+        Create the consumer and the producer.
+
+        Parameters
+        ----------
+        consumer_factory : callable, optional
+            Called with the consumer config to create the consumer, by default Consumer
+        producer_factory : callable, optional
+            Called with the producer config to create the producer, by default Producer
+        """
+        if self.coalesced_commits():
+            self.consumer_conf['on_commit'] = self.commit_report
+
+        self.consumer = consumer_factory(self.consumer_conf)
+        self.producer = producer_factory(self.producer_conf)
+
+    def decode_rules(self, stream: typing.TextIO, json_lines: bool) -> dict:
+        """
+        Decode the rules from a JSON or JSON Lines stream.
+
+        Parameters
+        ----------
+        stream : typing.TextIO
+            The stream to be read.
+        json_lines : bool
+            If True, each (non-blank) line is an object of rules keyed on
+            their names, otherwise the whole stream is a single such object.
+
+        Returns
+        -------
+        dict
+            The rules keyed on their names.
+        """
+        if not json_lines:
+            return dict(json.load(stream))
+
+        rules = {}
+
+        for line in stream:
+            if line.strip():
+                rules.update(json.loads(line))
+
+        return rules
+
+    def delivery_report(self, err: KafkaError, message: Message) -> None:
+        """
+        Get the delivery result for the producer.
+
+        Parameters
+        ----------
+        err : KafkaError
+            Will be None if no error happened.
+        message : Message
+            The message being produced.
+        """
+        with self._in_flight_lock:
+            self._in_flight_bytes -= len(message.value() or b'') + len(message.key() or b'')
+
+        if err is not None:
+            error_message = f'Message delivery failed: "{err}".'
+            logger.error(error_message)
+            raise KafkaException(error_message)
+
+    def dlq_batching(self) -> bool:
+        """
+        Check if messages produced to the DLQ topic are flushed and committed in batches.
+
+        Returns
+        -------
+        bool
+            True if KAFKA_ROUTER_DLQ_BATCH_SIZE is greater than one and the
+            producer would otherwise be flushed (and the consumer committed)
+            after each message.
+        """
+        return self.dlq_batch_size > 1 and not (self.tracking_offsets() or self.batch_mode() or self.dlq_mode())
 
     def dlq_mode(self, dlq_mode: bool = None) -> bool:
         """
-        Get or set the DLQ mode.
+        Get or set the DLQ mode.
+
+        Parameters
+        ----------
+        dlq_mode : bool, optional
+            Set the DLQ mode, by default None
+
+        Returns
+        -------
+        bool
+            Get the DLQ mode.
+        """
+        if dlq_mode is not None:
+            self._dlq_mode = dlq_mode
+
+        return self._dlq_mode
+
+    def drain(self) -> None:
+        """Wait for messages in flight to be processed and delivered and commit the offsets being tracked."""
+        import concurrent.futures
+
+        concurrent.futures.wait(list(self._lane_futures))
+
+        if self.pipelined_mode() and self.producer is not None:
+            self.producer.flush()
+
+        if self.tracking_offsets():
+            self.commit_offsets(force=True)
+        elif self._dlq_held:
+            self.commit_dlq_batch()
+
+    def dry_run_mode(self, dry_run_mode: bool = None) -> bool:
+        """
+        Get or set dry run mode.
+
+        When set to true, no messages are produced.
+
+        Parameters
+        ----------
+        dry_run_mode : bool, optional
+            Set the dry-run mode, by default None
+
+        Returns
+        -------
+        bool
+            Get dry-run mode.
+        """
+        if dry_run_mode is not None:
+            self._dry_run_mode = dry_run_mode
+
+        return self._dry_run_mode
+
+    def filter_replay(self, messages: list) -> list:
+        """
+        Drop consumed messages that are past the end of a DLQ replay.
+
+        Partitions that have been replayed are paused and, once every
+        assigned partition has been replayed, the router stops (after the
+        messages returned have been processed).  Outside of DLQ mode, the
+        messages are returned as they are.
+
+        Parameters
+        ----------
+        messages : list
+            The consumed messages.
+
+        Returns
+        -------
+        list
+            The messages to be processed.
+        """
+        if not self.dlq_mode():
+            return messages
+
+        finished = set(self.replay.finished)
+        seeks = self.replay.skip_ahead(messages)
+        messages = self.replay.filter(messages)
+        self.pause(self.replay.finished - finished)
+
+        for partition in seeks:
+            logger.debug(f'Seeking to the next indexed offset {partition}.')
+            self.consumer.seek(partition)
+
+        if self.replay.complete():
+            logger.info('Every assigned partition has been replayed.')
+            self.running(False)
+
+        return messages
+
+    def flush_due(self, topic: str, message: Message) -> bool:
+        """
+        Check if the producer is to be flushed after producing a message (outside of pipelined mode).
+
+        Parameters
+        ----------
+        topic : str
+            The topic that the message has been produced to.
+        message : Message
+            The consumed message that is being routed.  Can be None.
+
+        Returns
+        -------
+        bool
+            False in batch mode (unless also in concurrent mode) or if the
+            message is being held for a batch of DLQ messages.
+        """
+        if self.hold_dlq_message(topic, message):
+            return False
+
+        return self.concurrent_mode() or not self.batch_mode()
+
+    def get_batch_offsets(self, messages: list) -> list:
+        """
+        Get the offsets to commit for a batch of messages.
+
+        Parameters
+        ----------
+        messages : list
+            The messages in the batch.
+
+        Returns
+        -------
+        list
+            TopicPartition objects with the offset after the last message in
+            the batch for each partition.
+        """
+        positions = {}
+
+        for message in messages:
+            if not message.error():
+                positions[(message.topic(), message.partition())] = message.offset() + 1
+
+        return [TopicPartition(topic, partition, offset) for (topic, partition), offset in positions.items()]
+
+    def get_delivery_callback(self, message: Message) -> callable:
+        """
+        Get a delivery callback for a copy of a consumed message.
+
+        Parameters
+        ----------
+        message : Message
+            The consumed message that is being produced.
+
+        Returns
+        -------
+        callable
+            A callback that reports the delivery and then marks the produced
+            copy of the consumed message as complete.  A failed delivery is
+            logged and recorded against the consumed message (so that its
+            offset is never committed) rather than raised, so that the other
+            deliveries in flight are still served.
+        """
+        def callback(err: KafkaError, produced_message: Message) -> None:
+            try:
+                self.delivery_report(err, produced_message)
+            except KafkaException:
+                self.offset_tracker.fail(message)
+
+            self.offset_tracker.done(message)
+
+        return callback
+
+    def get_dlq_id(self):
+        """
+        Get the ID for the DLQ headers.
+
+        Returns
+        -------
+        str
+            If KAFKA_ROUTER_DLQ_ID is provided. If not provided will be set
+            to KAFKA_CONSUMER_CLIENT_ID (if present) or KAFKA_CONSUMER_GROUP_ID.
+        """
+        if os.getenv('KAFKA_ROUTER_DLQ_ID', None):
+            return os.environ['KAFKA_ROUTER_DLQ_ID']
+        elif os.getenv('KAFKA_CONSUMER_CLIENT_ID', None):
+            return os.environ['KAFKA_CONSUMER_CLIENT_ID']
+
+        return os.environ['KAFKA_CONSUMER_GROUP_ID']
+
+    def get_dlq_header_keys(self) -> dict:
+        """
+        Get the keys of the DLQ headers (worked out once from the DLQ ID).
+
+        Returns
+        -------
+        dict
+            The header keys (e.g. "__router.topic") keyed on DLQ_HEADER_NAMES.
+        """
+        if self._dlq_header_keys is None:
+            dlq_id = self.get_dlq_id()
+            self._dlq_header_keys = {name: f'__{dlq_id}.{name}' for name in self.DLQ_HEADER_NAMES}
+
+        return self._dlq_header_keys
+
+    def get_index_selections(self, partitions: list) -> dict:
+        """
+        Select the offsets of newly assigned partitions to replay from the DLQ index.
+
+        Parameters
+        ----------
+        partitions : list
+            The assigned TopicPartition objects.
+
+        Returns
+        -------
+        dict
+            The selections (see DlqIndex.select) keyed on (topic, partition).
+            Empty if there is no DLQ index.
+        """
+        if self.dlq_index is None:
+            return {}
+
+        selections = {}
+
+        for topic in {partition.topic for partition in partitions}:
+            selection = self.dlq_index.select(topic, self.get_rules_for_topic(topic))
+
+            if selection is None:
+                logger.warning(f'Not every rule for {topic} matches an indexed header, replaying every message.')
+                continue
+
+            selections.update(selection)
+
+        return selections
+
+    def get_lane(self, message: Message) -> concurrent.futures.ThreadPoolExecutor:
+        """
+        Get the lane that a message is to be processed on.
+
+        Each lane processes its messages one at a time and in the order they
+        were submitted.  Messages with the same key always go to the same
+        lane, so they are never reordered.
+
+        Parameters
+        ----------
+        message : Message
+            The consumed message.
+
+        Returns
+        -------
+        concurrent.futures.ThreadPoolExecutor
+            A single threaded executor for the lane.
+        """
+        if not self._lanes:
+            import concurrent.futures
+
+            self._lanes = [
+                concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{PROG}-lane-{lane}')
+                for lane in range(self.concurrency)
+            ]
+
+        key = message.key()
+        index = message.offset() if key is None else zlib.crc32(key)
+        return self._lanes[index % self.concurrency]
+
+    def get_poll_timeout(self, timeout: float) -> float:
+        """
+        Get the timeout for polling the consumer (or serving the producer).
+
+        Parameters
+        ----------
+        timeout : float
+            The timeout (in seconds) when not paused for backpressure.
+
+        Returns
+        -------
+        float
+            At most 0.1 seconds while paused for backpressure, so that the
+            producer is served and the partitions are resumed promptly.
+        """
+        if self._backpressure_paused:
+            return 0.1 if timeout == 0 else min(timeout, 0.1)
+
+        return timeout
+
+    def get_rule_metrics(self, rule: KafkaRouterRule) -> KafkaRouterRuleMetrics:
+        """
+        Get the metrics to be recorded for a rule.
+
+        To cap the cardinality of the rule label, once there are
+        KAFKA_ROUTER_PER_RULE_METRICS_MAX_RULES labels, the metrics of any further
+        rules are recorded against a label of "other".
+
+        Parameters
+        ----------
+        rule : KafkaRouterRule
+            The rule.
+
+        Returns
+        -------
+        KafkaRouterRuleMetrics
+            The metrics for the rule.
+        """
+        label = rule.name
+
+        if label not in self.rule_metrics and len(self.rule_metrics) >= self.rule_metrics_max_rules:
+            label = 'other'
+
+        if label not in self.rule_metrics:
+            self.rule_metrics[label] = KafkaRouterRuleMetrics(label, self.rule_metrics_sample_rate)
+
+        return self.rule_metrics[label]
+
+    def get_rule_sources(self) -> dict:
+        """
+        Get the rules from the environment variables and KAFKA_ROUTER_RULES_PATH.
+
+        Rules read from the path are given the KAFKA_ROUTER_RULE_ prefix, so
+        that they are sorted together with the rules from the environment
+        and replace any environment rule of the same name.
+
+        Returns
+        -------
+        dict
+            The rules as JSON strings keyed on their names.
+        """
+        sources = {key: value for key, value in os.environ.items() if key.startswith('KAFKA_ROUTER_RULE_')}
+
+        if self.rules_path:
+            self._rules_signature = self.get_rules_signature()
+            rules = self.read_rules(self.rules_path)
+            sources.update({f'KAFKA_ROUTER_RULE_{name.removeprefix("KAFKA_ROUTER_RULE_")}': rule
+                            for name, rule in rules.items()})
+
+        return sources
+
+    def get_rules(self) -> None:
+        """
+        Get the rules from the environment variables (and KAFKA_ROUTER_RULES_PATH).
+
+        Returns
+        -------
+        list
+            A list of KafkaRouterRules objects.
+        """
+        rules = []
+        start = time.perf_counter()
+        sources = self.get_rule_sources()
+
+        for key in sorted(sources):
+            self.add_rule(
+                KafkaRouterRule(key, sources[key])
+            )
+
+        self.report_rule_load(len(self.rules), start)
+        return rules
+
+    def get_rules_for_topic(self, topic: str) -> list:
+        """
+        Get the rules that have the given topic as their source topic.
+
+        Parameters
+        ----------
+        topic : str
+            The name of the topic that a message was consumed from.
+
+        Returns
+        -------
+        list
+            The KafkaRouterRule objects for the topic in the order that they
+            are to be evaluated.  An empty list if no rules apply to the topic.
+        """
+        return self.rules_by_topic.get(topic, self.NO_RULES).rules
+
+    def get_rules_signature(self) -> list:
+        """
+        Get the modification times and sizes of the files under KAFKA_ROUTER_RULES_PATH.
+
+        Returns
+        -------
+        list
+            A list of (path, modification time, size) tuples.  The time and
+            size are None for a path that cannot be read.
+        """
+        paths = [self.rules_path]
+
+        if os.path.isdir(self.rules_path):
+            paths.extend(os.path.join(self.rules_path, name) for name in sorted(os.listdir(self.rules_path)))
+
+        signature = []
+
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append((path, None, None))
+
+        return signature
+
+    def handler(self, signum: int, frame: types.FrameType) -> None:
+        """Catch signals."""
+        signame = signal.Signals(signum).name
+        logger.warning(f'Caught signal {signame} ({signum}).')
+        sys.exit(0)
+
+    def handle_message(self, message: Message) -> None:
+        """
+        Handle a message that has been consumed from an input topic.
+
+        Parameters
+        ----------
+        message : Message
+            The consumed message to be handled.
+
+        Raises
+        ------
+        KafkaError
+            If an error occurred in the consumer.
+        """
+        if message.error():
+            if message.error().code() == KafkaError._PARTITION_EOF:
+                logger.debug('End of partition reached {0}/{1}'.format(message.topic(), message.partition()))
+            else:
+                raise KafkaException(message.error())
+        else:
+            if self.tracking_offsets():
+                self.offset_tracker.add(message)
+
+            self.match_message_to_rule(message)
+
+    def headers(self, headers: list = None) -> list:
+        """
+        Get or set the headers of the message being processed.
+
+        The headers are held separately for each thread, so that messages can
+        be processed concurrently.
+
+        Parameters
+        ----------
+        headers : list, optional
+            If provided, a list of tuples to set as headers for the message, by default None
+
+        Returns
+        -------
+        list
+            A list of tuples that represent the headers of the message.
+        """
+        if headers is not None:
+            self._local.headers = headers
+
+        return getattr(self._local, 'headers', self._headers)
+
+    def hold_dlq_message(self, topic: str, message: Message) -> bool:
+        """
+        Hold a message produced to the DLQ topic, to be flushed and committed in a batch.
+
+        See dlq_batching.
+
+        Parameters
+        ----------
+        topic : str
+            The topic that the message has been produced to.
+        message : Message
+            The consumed message that is being routed.  Can be None.
+
+        Returns
+        -------
+        bool
+            True if the message is being held.
+        """
+        if topic != self.DLQ_topic_name or message is None or not self.dlq_batching():
+            return False
+
+        self._dlq_held.append(message)
+        return True
+
+    def init_dlq_index(self, env_config: EnvironmentConfig) -> None:
+        """
+        Open the DLQ index or, in DLQ index mode, prepare to build it.
+
+        Parameters
+        ----------
+        env_config : EnvironmentConfig
+            The environment configuration.
+        """
+        path = os.getenv('KAFKA_ROUTER_DLQ_INDEX_PATH')
+        self.dlq_index = None
+        self.index_writer = None
+
+        if env_config.get_boolean('KAFKA_ROUTER_DLQ_INDEX_MODE'):
+            if not (path and self.dlq_mode()):
+                logger.error('DLQ index mode requires DLQ mode and KAFKA_ROUTER_DLQ_INDEX_PATH.')
+                sys.exit(2)
+
+            self.index_writer = DlqIndexWriter(path, env_config.get_list('KAFKA_ROUTER_DLQ_INDEX_HEADERS'))
+            logger.info(f'Building the DLQ index {path}.')
+        elif path:
+            self.dlq_index = DlqIndex(path)
+            logger.info(f'Replaying with the DLQ index {path}.')
+
+    def match_message_to_rule(self, message: Message) -> None:
+        """
+        Match the given message to the configured rules.
+
+        Parameters
+        ----------
+        message : Message
+            The message to be matched.
+        """
+        destination_topics = self.DLQ_topic_name
+        message_matched_to_rule = False
+        self.headers(message.headers())
+        context = MessageContext(message)
+
+        for rule in self.rules_by_topic.get(message.topic(), self.NO_RULES).get_candidates(context):
+            try:
+                if rule.is_match(message, context):
+                    destination_topics = rule.destination_topics
+                    message_matched_to_rule = True
+                    break
+            except (json.decoder.JSONDecodeError, UnicodeDecodeError) as ex:
+                destination_topics = self.DLQ_topic_name
+
+                # The context raises the same error to every rule that needs the
+                # decoded value or parsed JSON, so only add the DLQ headers for
+                # the first one.
+                if not message_matched_to_rule:
+                    self.add_exception_headers(message, ex)
+
+                # Keep DLQ headers intact by saying we have matched the message.
+                message_matched_to_rule = True
+
+        self.prepare_headers(message, destination_topics, message_matched_to_rule)
+        self.produce(destination_topics, message.value(), message.key(), self.headers(), message)
+        self.report_message_matching_status(destination_topics, message, message_matched_to_rule)
+
+    def on_assign(self, consumer: Consumer, partitions: list) -> None:
+        """
+        Set the start and end offsets of a DLQ replay when partitions are assigned.
+
+        Outside of DLQ mode, the partitions are assigned as they are.
+
+        Parameters
+        ----------
+        consumer : Consumer
+            The consumer.
+        partitions : list
+            The TopicPartition objects being assigned.
+        """
+        logger.info(f'Partitions assigned {partitions}.')
+
+        if not self.dlq_mode():
+            return
+
+        consumer.assign(self.replay.assign(consumer, partitions, self.get_index_selections(partitions)))
+
+        if self.replay.complete():
+            logger.info('There is nothing to replay on the assigned partitions.')
+            self.running(False)
+
+    def on_revoke(self, consumer: Consumer, partitions: list) -> None:
+        """
+        Commit the tracked offsets before partitions are revoked.
+
+        Parameters
+        ----------
+        consumer : Consumer
+            The consumer.
+        partitions : list
+            The TopicPartition objects being revoked.
+        """
+        logger.info(f'Partitions revoked {partitions}.')
+        self._backpressure_paused = []
+        producer_backpressure_paused.set(0)
+        self.drain()
+        self.offset_tracker.revoke(partitions)
+        self.replay.revoke(partitions)
+
+    def pause(self, partitions: set) -> None:
+        """
+        Stop fetching from partitions (e.g. once they have been replayed).
+
+        Parameters
+        ----------
+        partitions : set
+            The (topic, partition) tuples to be paused.  Can be empty.
+        """
+        if partitions:
+            logger.info(f'Pausing {sorted(partitions)}.')
+            self.consumer.pause([TopicPartition(*key) for key in partitions])
+
+    def pause_for_backpressure(self) -> None:
+        """Pause the assigned partitions until the producer queue has drained."""
+        self._backpressure_paused = self.consumer.assignment()
+
+        if self._backpressure_paused:
+            logger.info(f'Pausing {len(self._backpressure_paused)} partition(s), the producer has {len(self.producer)}'
+                        f' messages ({self._in_flight_bytes} bytes) in flight.')
+            self.consumer.pause(self._backpressure_paused)
+            producer_backpressure_paused.set(1)
+            producer_backpressure_pause_count.inc()
+
+    def pipelined_mode(self, pipelined_mode: bool = None) -> bool:
+        """
+        Get or set pipelined mode.
+
+        When set to true, messages are not flushed to the producer one at a
+        time and offsets are committed once the messages have been delivered.
+
+        Parameters
+        ----------
+        pipelined_mode : bool, optional
+            Set the pipelined mode, by default None
+
+        Returns
+        -------
+        bool
+            Get pipelined mode.
+        """
+        if pipelined_mode is not None:
+            self._pipelined_mode = pipelined_mode
+
+        return self._pipelined_mode
+
+    def pop_commit_start_time(self, partitions: list) -> float:
+        """
+        Get (and forget) when an asynchronous commit of the partitions was started.
+
+        Parameters
+        ----------
+        partitions : list
+            The TopicPartition objects that were committed.
+
+        Returns
+        -------
+        float
+            The earliest time that a commit of the partitions was started or None
+            if the commit was not asynchronous.
+        """
+        start_times = [
+            self._commit_start_times.pop((partition.topic, partition.partition, partition.offset), None)
+            for partition in partitions
+        ]
+        return min([start_time for start_time in start_times if start_time is not None], default=None)
+
+    def prepare_headers(self, message: Message, destination_topics: str, message_matched_to_rule: bool) -> None:
+        """
+        Prepare headers before producing a message.
+
+        Predominantly used to ensure that a message that has not been
+        matched to any rules and is destined for the DLQ topic has
+        headers explaining why.
+
+        Parameters
+        ----------
+        message : Message
+            The message to be produced.
+        message_matched_to_rule : bool
+            Was the message matched to any rule.
+        """
+        if destination_topics == self.DLQ_topic_name and not message_matched_to_rule:
+            keys = self.get_dlq_header_keys()
+            self.upsert_headers({
+                keys['topic']: message.topic(),
+                keys['partition']: message.partition(),
+                keys['offset']: message.offset(),
+                keys['message']: 'Message not matched to any routing rules.'
+            })
+
+    @BATCH_PROCESS_TIME.time()
+    def process_batch(self, messages: list) -> None:
+        """
+        Process a batch of messages that have been consumed from the input topics.
+
+        Unless in pipelined mode, the producer is flushed once for the whole
+        batch.
+
+        Parameters
+        ----------
+        messages : list
+            The consumed messages to be processed.
+        """
+        consumer_batch_size.observe(len(messages))
+
+        for message in messages:
+            self.handle_message(message)
+
+        if not self.pipelined_mode():
+            self.producer.flush()
+
+    def process_in_lane(self, message: Message) -> None:
+        """
+        Process a message on a lane (concurrent mode).
+
+        Any exception is recorded to be raised on the main thread and the
+        message is left incomplete so that its offset is not committed.
+
+        Parameters
+        ----------
+        message : Message
+            The consumed message to be processed.
+        """
+        try:
+            self.process_message(message)
+
+            if not message.error():
+                self.offset_tracker.done(message, 2)
+        except Exception as ex:
+            self._lane_errors.append(ex)
+        finally:
+            self._lane_slots.release()
+
+    @PROCESS_TIME.time()
+    def process_message(self, message: Message):
+        """
+        Process a message that has been consumed from an input topic.
+
+        Parameters
+        ----------
+        message : Message
+            The consumed message to be processed.
+
+        Raises
+        ------
+        KafkaError
+            If an error occurred in the consumer.
+        """
+        self.handle_message(message)
+
+    def process_messages(self, messages: list) -> None:
+        """
+        Process and commit the consumed messages.
+
+        In DLQ index mode, the messages are only added to the index.  In
+        concurrent mode, the messages are handed to the lanes and the
+        offsets are committed as the lanes complete them.  Otherwise in batch
+        mode, the messages are processed and committed as a unit.
+
+        Parameters
+        ----------
+        messages : list
+            The consumed messages.
+        """
+        self.raise_lane_error()
+
+        if self.index_writer is not None:
+            self.index_writer.add_messages(messages)
+            return
+        elif self.concurrent_mode():
+            self.submit_messages(messages)
+            return
+        elif self.batch_mode():
+            self.process_batch(messages)
+            self.commit_batch(messages)
+            return
+
+        for message in messages:
+            self.process_message(message)
+            self.commit(message)
+
+    def produce(self, topic: str, value: str, key: str, headers: list, message: Message = None) -> None:
+        """
+        Produce a message onto a topic unless dry run and DLQ mode is on.
+
+        Parameters
+        ----------
+        topic : str
+            The topic to be written to.
+        value : str
+            The value of the message.
+        key : str
+            The key of the message.
+        headers : list
+            The headers of the message.
+        message : Message, optional
+            The consumed message that is being routed, by default None
+        """
+        if topic == '':
+            prom_dropped_message_count.inc()
+            dropped_message_count.increment_count()
+            return
+
+        if not self.dry_run_mode():
+            topics = topic.split(',')
+
+            for topic in topics:
+                self.produce_to_topic(topic, value, key, message)
+                prom_producer_message_count.inc()
+                producer_message_count.increment_count()
+
+    def produce_message(self, topic: str, value: str, key: str, callback: callable) -> None:
+        """
+        Produce a message with the current headers, serving delivery reports while the producer queue is full.
+
+        Parameters
+        ----------
+        topic : str
+            The topic to be written to.
+        value : str
+            The value of the message.
+        key : str
+            The key of the message.
+        callback : callable
+            The delivery callback.
+        """
+        while True:
+            try:
+                self.producer.produce(topic, value, key, headers=self.headers(), callback=callback)
+                break
+            except BufferError:
+                producer_buffer_full_count.inc()
+                logger.debug('The producer queue is full, serving delivery reports.')
+                self.producer.poll(0.1)
+
+        with self._in_flight_lock:
+            self._in_flight_bytes += len(value or b'') + len(key or b'')
+
+    def produce_pipelined(self, topic: str, value: str, key: str, message: Message) -> None:
+        """
+        Produce a single copy of a message onto a topic without flushing the producer.
+
+        The delivery of the copy is tracked against the consumed message and
+        the producer is only serviced.  If KAFKA_ROUTER_MAX_IN_FLIGHT messages
+        are awaiting delivery, wait for some to be delivered first.
+
+        Parameters
+        ----------
+        topic : str
+            The topic to be written to.
+        value : str
+            The value of the message.
+        key : str
+            The key of the message.
+        message : Message
+            The consumed message that is being routed.
+        """
+        while len(self.producer) >= self.max_in_flight:
+            self.producer.poll(0.1)
+
+        if self.tracking_offsets():
+            self.offset_tracker.add(message)
+
+        self.produce_message(topic, value, key, self.get_delivery_callback(message))
+        self.producer.poll(0)
+
+    def produce_to_topic(self, topic: str, value: str, key: str, message: Message) -> None:
+        """
+        Produce a single copy of a message onto a topic.
+
+        Unless in pipelined or batch mode, the producer is flushed after the
+        message is produced.  In concurrent mode, messages are routed one at a
+        time on each lane, so the producer is flushed even when consuming in
+        batches.  In pipelined mode, see produce_pipelined.
+
+        Parameters
+        ----------
+        topic : str
+            The topic to be written to.
+        value : str
+            The value of the message.
+        key : str
+            The key of the message.
+        message : Message
+            The consumed message that is being routed.
+        """
+        if self.pipelined_mode() and message is not None:
+            self.produce_pipelined(topic, value, key, message)
+            return
+
+        self.produce_message(topic, value, key, self.delivery_report)
+
+        if self.flush_due(topic, message):
+            self.producer.flush()
+            logger.debug('Successfully flushed message on the producer.')
+
+    def producer_over_limit(self, ratio: float) -> bool:
+        """
+        Check if the producer has too many messages or bytes in flight.
+
+        Parameters
+        ----------
+        ratio : float
+            The fraction of the backpressure limits to check against.  A
+            limit of zero (or less) is ignored.
+
+        Returns
+        -------
+        bool
+            True if either limit has been reached.
+        """
+        messages = self.backpressure_max_messages > 0 and len(self.producer) >= self.backpressure_max_messages * ratio
+        return messages or 0 < self.backpressure_max_bytes * ratio <= self._in_flight_bytes
+
+    def raise_lane_error(self) -> None:
+        """
+        Raise the first exception that occurred on a lane (concurrent mode).
+
+        Raises
+        ------
+        Exception
+            The exception raised when a lane processed a message.
+        """
+        if self._lane_errors:
+            raise self._lane_errors[0]
+
+    def read_rules(self, path: str) -> dict:
+        """
+        Read the rules from a file or a directory.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file or directory.
+
+        Returns
+        -------
+        dict
+            The rules as JSON strings keyed on their names.
+        """
+        if os.path.isdir(path):
+            return self.read_rules_directory(path)
+
+        return self.read_rules_file(path)
+
+    def read_rules_directory(self, path: str) -> dict:
+        """
+        Read the rules from a directory, one rule per file.
+
+        Only files with a .json extension are read.  Each rule is named after
+        its file (without the extension).
+
+        Parameters
+        ----------
+        path : str
+            The path of the directory.
+
+        Returns
+        -------
+        dict
+            The rules as JSON strings keyed on their names.
+        """
+        rules = {}
+
+        try:
+            for filename in sorted(os.listdir(path)):
+                name, extension = os.path.splitext(filename)
+
+                if extension == '.json':
+                    with open(os.path.join(path, filename)) as stream:
+                        rules[name] = stream.read()
+        except OSError as ex:
+            logger.error(f'Unable to read the rules from {path} {ex}')
+            sys.exit(2)
+
+        return rules
+
+    def read_rules_file(self, path: str) -> dict:
+        """
+        Read the rules from a JSON or JSON Lines file.
+
+        A JSON file must contain an object with the rule names as its keys
+        and the rules as its values.  A JSON Lines file (with a .jsonl
+        extension) has an object of the same form on each line, so that a
+        large rule set can be generated a line at a time.  Blank lines are
+        ignored.  The rules are only decoded once, not re-encoded for each
+        rule to decode.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file.
+
+        Returns
+        -------
+        dict
+            The rules keyed on their names.
+        """
+        try:
+            with open(path) as stream:
+                rules = self.decode_rules(stream, path.endswith('.jsonl'))
+        except (OSError, TypeError, ValueError) as ex:
+            logger.error(f'Unable to read the rules from {path} {ex}')
+            sys.exit(2)
+
+        return {name: rule if isinstance(rule, dict) else json.dumps(rule) for name, rule in rules.items()}
+
+    def reload_handler(self, signum: int, frame: types.FrameType) -> None:
+        """Request that the rules are reloaded (on SIGHUP, only handled if KAFKA_ROUTER_RULES_PATH is set)."""
+        logger.info(f'Caught signal {signal.Signals(signum).name} ({signum}), reloading the rules.')
+        self._reload_requested.set()
+
+    def reload_rules(self) -> bool:
+        """
+        Load, validate and compile the rules, ready to be swapped in.
+
+        Runs on the rule watcher thread, off the hot path.  The new rule set
+        is swapped in by the router loop between messages.  If any of the
+        rules (or the files holding them) are invalid, the running rule set
+        is left untouched.
+
+        Returns
+        -------
+        bool
+            True if a new rule set is ready to be swapped in.
+        """
+        start = time.perf_counter()
+
+        try:
+            staged = self.build_rules(self.get_rule_sources())
+        except SystemExit:
+            logger.error('The rules are invalid, the running rules are unchanged.')
+            return False
+
+        if not staged.rules:
+            logger.error('There are no KafkaRouter rules defined, the running rules are unchanged.')
+            return False
+
+        with self._rules_lock:
+            self._pending_rules = staged
+
+        self.report_rule_load(len(staged.rules), start)
+        return True
+
+    def report_message_matching_status(self, destination_topics: str, message: Message,
+                                       message_matched_to_rule: bool) -> None:
+        """
+        Report and set metrics for if the message was matched or not.
+
+        Yes, this could be an if statement in match_message_to_rule method,
+        but radon is at the limit of how complex that method is already.
+
+        Parameters
+        ----------
+        destination_topics: str
+            The name of the topic that the message is being routed to.
+        message: Message
+            The message that was matched.
+        message_matched_to_rule : bool
+            True if the message was successfully matched to a routing rule,
+            False otherwise.
+        """
+        if message_matched_to_rule and destination_topics == self.DLQ_topic_name:
+            non_routed_error_count.inc()
+        elif message_matched_to_rule:
+            pass
+        else:
+            non_routed_error_count.inc()
+
+    def report_rule_load(self, count: int, start: float) -> None:
+        """
+        Log the rule load and record the rule_count and rule_load_time_seconds metrics.
+
+        The metrics are not recorded if KAFKA_ROUTER_PROMETHEUS_DISABLED is
+        set, so that prometheus_client is not imported just to build a router.
+
+        Parameters
+        ----------
+        count : int
+            The number of rules that have been loaded.
+        start : float
+            The value of time.perf_counter() when loading started.
+        """
+        elapsed = time.perf_counter() - start
+
+        if not self.prometheus_disabled:
+            rule_count.set(count)
+            rule_load_time_seconds.set(elapsed)
+
+        logger.info(f'Loaded {count} rules in {elapsed:.3f}s.')
+
+    def resume_from_backpressure(self) -> None:
+        """Resume the partitions paused for backpressure (other than those that have been replayed)."""
+        partitions = [partition for partition in self._backpressure_paused
+                      if (partition.topic, partition.partition) not in self.replay.finished]
+        self._backpressure_paused = []
+        logger.info(f'Resuming {len(partitions)} partition(s), the producer has {len(self.producer)} messages'
+                    f' ({self._in_flight_bytes} bytes) in flight.')
+        self.consumer.resume(partitions)
+        producer_backpressure_paused.set(0)
+
+    def router(self, consumer_factory: callable = Consumer, producer_factory: callable = Producer) -> None:
+        """
+        Consume from the consumer and produce to the producer.
+
+        Exits if SIGINT is caught.
+
+        Parameters
+        ----------
+        consumer_factory : callable, optional
+            Called with the consumer config to create the consumer, by default
+            Consumer.  Can be replaced (e.g. with an in-memory stand-in for
+            testing or benchmarking).
+        producer_factory : callable, optional
+            Called with the producer config to create the producer, by default
+            Producer.
+        """
+        if len(self.rules) == 0:
+            logger.error('There are no KafkaRouter rules defined.')
+            sys.exit(0)
+
+        self.validate_consumer_config(self.consumer_conf)
+        self.create_clients(consumer_factory, producer_factory)
+
+        try:
+            self.subscribe()
+            self.start_rule_watcher()
+            time_of_last_message = time.time() * 1000
+
+            while self.running():
+                self.apply_pending_rules()
+                messages = self.filter_replay(self.consume())
+
+                if not messages:
+                    logger.debug('No messages to consume.')
+                    self.check_for_timeout(time_of_last_message)
+                    self.service()
+                    continue
+
+                with self.start_transaction('Process consumed message'):
+                    time_of_last_message = time.time() * 1000
+                    consumer_message_count.increment_count(len(messages))
+                    prom_consumer_message_count.inc(len(messages))
+                    self.process_messages(messages)
+
+                self.apply_backpressure()
+        except SystemExit:
+            logger.warning('SystemExit exception caught.')
+        finally:
+            logger.info(f'Consumed {consumer_message_count.count()} messages.')
+            logger.info(f'Produced {producer_message_count.count()} messages.')
+            logger.info(f'Dropped {dropped_message_count.count()} messages.')
+            self.close()
+
+    def running(self, running: bool = None) -> bool:
+        """
+        Get or set the running state.
+
+        Parameters
+        ----------
+        running : bool, optional
+            Set the running state if not None, by default None
+
+        Returns
+        -------
+        bool
+            Get the running state.
+        """
+        if running is not None:
+            self._running = running
+
+        return self._running
+
+    def service(self) -> None:
+        """Serve any delivery reports, commit any offsets that are due and apply backpressure while idle."""
+        self.raise_lane_error()
+
+        if self.pipelined_mode() or self._backpressure_paused:
+            self.producer.poll(self.get_poll_timeout(0))
+
+        if self.tracking_offsets():
+            self.commit_offsets()
+        elif self._dlq_held:
+            self.commit_dlq_batch()
+
+        self.apply_backpressure()
+
+    def start_rule_watcher(self) -> None:
+        """Start watching KAFKA_ROUTER_RULES_PATH for changes (if it is set)."""
+        if self.rules_path:
+            logger.info(f'Watching {self.rules_path} for rule changes.')
+            threading.Thread(target=self.watch_rules, name='rule-watcher', daemon=True).start()
+
+    def start_transaction(self, name: str) -> contextlib.AbstractContextManager:
+        """
+        Start a Sentry transaction (if Sentry is enabled).
 
         Parameters
         ----------
-        dlq_mode : bool, optional
-            Set the DLQ mode, by default None
+        name : str
+            The name of the transaction.
+
+        Returns
+        -------
+        contextlib.AbstractContextManager
+            The transaction or, if SENTRY_DSN is not set, a context that does
+            nothing (so that the Sentry SDK is never imported).
+        """
+        if not self.sentry_enabled:
+            return contextlib.nullcontext()
+
+        return sentry_sdk.start_transaction(op='task', name=name)
+
+    def subscribe(self) -> None:
+        """Subscribe the consumer to the source topics."""
+        self.consumer.subscribe(self.source_topics, on_assign=self.on_assign, on_revoke=self.on_revoke)
+
+    def submit_messages(self, messages: list) -> None:
+        """
+        Submit messages to be processed on the lanes (concurrent mode).
+
+        Blocks while KAFKA_ROUTER_MAX_IN_FLIGHT messages are waiting to be
+        processed.  The message is tracked before it is submitted, so that
+        the offsets of later messages that complete first are not committed
+        before it.  Messages with an error (e.g. the end of a partition) are
+        not tracked, as there is nothing to commit for them.
+
+        Parameters
+        ----------
+        messages : list
+            The consumed messages.
+        """
+        for message in messages:
+            self._lane_slots.acquire()
+
+            if self.tracking_offsets() and not message.error():
+                self.offset_tracker.add(message)
+
+            future = self.get_lane(message).submit(self.process_in_lane, message)
+            self._lane_futures.add(future)
+            future.add_done_callback(self._lane_futures.discard)
+
+        self.commit_offsets()
+
+    def tracking_offsets(self) -> bool:
+        """
+        Check if the offsets of consumed messages are being tracked.
 
         Returns
         -------
         bool
-            Get the DLQ mode.
+            True if in pipelined or concurrent mode or commits are being
+            coalesced.  Always False in DLQ mode as offsets are not committed.
+        """
+        return not self.dlq_mode() and (self.pipelined_mode() or self.coalesced_commits() or self.concurrent_mode())
+
+    def upsert_header(self, new_key: str, new_value: str) -> None:
+        """
+        Update an existing header or insert a new one.
+
+        Parameters
+        ----------
+        new_key : str
+            The key value of the header.
+        new_value : str
+            The value of the header.
+        """
+        self.upsert_headers({new_key: new_value})
+
+    def upsert_headers(self, updates: dict) -> None:
+        """
+        Update existing headers or insert new ones in a single pass over the headers.
+
+        Parameters
+        ----------
+        updates : dict
+            The values of the headers keyed on the header keys.
+        """
+        headers = [(key, value) for key, value in self.headers() or [] if key not in updates]
+        headers.extend((key, str(value)) for key, value in updates.items())
+        self.headers(headers)
+
+    def validate_consumer_config(self, config: dict) -> None:
+        """
+        Validate the consumer config.
+
+        Ensures that enable.auto.commit is disabled.
+
+        Parameters
+        ----------
+        config : dict
+            The consumer config.
+
+        Raises
+        ------
+        ValueError
+            Raised if enable.auto.commit is missing or not set to false.
+        """
+        is_valid = False
+
+        if 'enable.auto.commit' not in config:
+            logger.error('Please set the KAFKA_CONSUMER_ENABLE_AUTO_COMMIT environment variable.')
+        elif config['enable.auto.commit'] != 'false':
+            logger.error('Please set the KAFKA_CONSUMER_ENABLE_AUTO_COMMIT environment variable to "false".')
+        else:
+            is_valid = True
+
+        if not is_valid:
+            raise ValueError('The consumer must be configured with enable.auto.commit set to false.')
+
+    def watch_rules(self) -> None:
+        """
+        Reload the rules when KAFKA_ROUTER_RULES_PATH changes or on request.
+
+        Polls the modification times of the rule files every
+        KAFKA_ROUTER_RULES_RELOAD_INTERVAL_MS, or reloads straight away when
+        a SIGHUP is caught.
+        """
+        while self.running():
+            requested = self._reload_requested.wait(self.rules_reload_interval_ms / 1000)
+            self._reload_requested.clear()
+
+            if requested or self.get_rules_signature() != self._rules_signature:
+                self.reload_rules()
+
+    def write_dlq_index(self) -> None:
+        """Write the DLQ index (in DLQ index mode) if every assigned partition has been read."""
+        if self.index_writer is None:
+            return
+        elif not self.replay.complete():
+            logger.error('The DLQ index has not been written as the DLQ has not been read to the end.')
+            return
+
+        self.index_writer.write(self.replay.ends)
+        logger.info(f'The DLQ index has been written to {self.index_writer.path}.')
+
+
+class MessageFile:
+    """
+    A local file of captured messages (or a chunk of one), read through a memory map.
+
+    Files ending in JSON_LINES_SUFFIXES hold a JSON object per line with a
+    "topic", "key", "headers" (a list of [key, value] pairs or an object) and
+    "value", and optionally a "partition" and "offset".  Strings are encoded
+    as UTF-8, with surrogate escapes for bytes that are not valid UTF-8.  A
+    value that is not a string is taken to be a JSON document.
+
+    Any other file is length-prefixed.  Each message is the topic, key and
+    value, a header count and then the key and value of each header.  Each
+    of these is a big-endian 32-bit signed integer, followed by that many
+    bytes for the strings (a length of -1 for None).
+
+    The offset of a message defaults to its position in the file.
+
+    Parameters
+    ----------
+    path : str
+        The path of the file.
+    start : int, optional
+        The position of the chunk to be read, by default 0
+    end : int, optional
+        The end of the chunk, by default None (the end of the file).  JSON
+        Lines chunks hold the lines that start within them.  Length-prefixed
+        files can not be split into chunks.
+    """
+
+    JSON_LINES_SUFFIXES = ('.jsonl', '.ndjson')
+    LENGTH = struct.Struct('>i')
+
+    def __init__(self, path: str, start: int = 0, end: int = None) -> None:
+        self.end = end
+        self.json_lines = path.endswith(self.JSON_LINES_SUFFIXES)
+        self.path = path
+        self.start = start
+
+    def decode_json_line(self, line: bytes, position: int) -> OfflineMessage:
+        """
+        Decode a message from a line of a JSON Lines file.
+
+        Parameters
+        ----------
+        line : bytes
+            The line.
+        position : int
+            The position of the line in the file.
+
+        Returns
+        -------
+        OfflineMessage
+            The message.
+        """
+        record = json.loads(line)
+        value = record.get('value')
+        headers = record.get('headers') or []
+
+        if not isinstance(value, (str, type(None))):
+            value = json.dumps(value)
+
+        if isinstance(headers, dict):
+            headers = headers.items()
+
+        return OfflineMessage(
+            record['topic'],
+            self.encode_text(record.get('key')),
+            [(key, self.encode_text(header_value)) for key, header_value in headers],
+            self.encode_text(value),
+            record.get('partition', 0),
+            record.get('offset', position)
+        )
+
+    def encode(self, topic: str, key: bytes, headers: list, value: bytes) -> bytes:
+        """
+        Encode a message in the format of the file.
+
+        Parameters
+        ----------
+        topic : str
+            The topic name.
+        key : bytes
+            The key of the message.
+        headers : list
+            The headers of the message as (key, value) tuples.
+        value : bytes
+            The value of the message.
+
+        Returns
+        -------
+        bytes
+            The encoded message.
+        """
+        if self.json_lines:
+            record = {
+                'topic': topic,
+                'key': self.decode_text(key),
+                'headers': [[header_key, self.decode_text(header_value)] for header_key, header_value in headers],
+                'value': self.decode_text(value)
+            }
+            return json.dumps(record).encode() + b'\n'
+
+        fields = [topic.encode(), key, value, len(headers)]
+        fields.extend(itertools.chain.from_iterable((header_key.encode(), self.encode_text(header_value))
+                                                    for header_key, header_value in headers))
+        return b''.join(self.encode_field(field) for field in fields)
+
+    def encode_field(self, field: object) -> bytes:
+        """
+        Encode a field of a length-prefixed message.
+
+        Parameters
+        ----------
+        field : object
+            The bytes of the field, None or (for the header count) an int.
+
+        Returns
+        -------
+        bytes
+            The encoded field.
+        """
+        if isinstance(field, int):
+            return self.LENGTH.pack(field)
+        elif field is None:
+            return self.LENGTH.pack(-1)
+
+        return self.LENGTH.pack(len(field)) + field
+
+    def find_line(self, data: mmap.mmap, position: int) -> int:
+        """
+        Find the first line of a JSON Lines file that starts at or after a position.
+
+        Parameters
+        ----------
+        data : mmap.mmap
+            The mapped file.
+        position : int
+            The position.
+
+        Returns
+        -------
+        int
+            The position of the line (the end of the file if there is none).
+        """
+        if position == 0:
+            return 0
+
+        newline = data.find(b'\n', position - 1)
+        return len(data) if newline < 0 else newline + 1
+
+    def get_chunks(self, size: int) -> list:
+        """
+        Split the file into chunks that can be read in parallel.
+
+        Parameters
+        ----------
+        size : int
+            The size of each chunk in bytes.
+
+        Returns
+        -------
+        list
+            The (path, start, end) of each chunk.  A single chunk for a
+            length-prefixed file.
+        """
+        if not self.json_lines:
+            return [(self.path, 0, None)]
+
+        file_size = os.path.getsize(self.path)
+        return [(self.path, start, min(start + size, file_size)) for start in range(0, max(file_size, 1), size)]
+
+    def read(self) -> typing.Iterator:
+        """
+        Read the messages of the file (or chunk).
+
+        Returns
+        -------
+        typing.Iterator
+            The OfflineMessage objects.
+        """
+        with open(self.path, 'rb') as stream:
+            if not os.fstat(stream.fileno()).st_size:
+                return
+
+            with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    data.madvise(mmap.MADV_SEQUENTIAL)
+
+                reader = self.read_json_lines if self.json_lines else self.read_length_prefixed
+                yield from reader(data)
+
+    def read_field(self, data: mmap.mmap, position: int) -> tuple:
+        """
+        Read a field of a length-prefixed message.
+
+        Parameters
+        ----------
+        data : mmap.mmap
+            The mapped file.
+        position : int
+            The position of the field.
+
+        Returns
+        -------
+        tuple
+            The bytes of the field (or None) and the position of the next field.
+        """
+        (length,) = self.LENGTH.unpack_from(data, position)
+        position += self.LENGTH.size
+
+        if length < 0:
+            return None, position
+
+        return data[position:position + length], position + length
+
+    def read_json_lines(self, data: mmap.mmap) -> typing.Iterator:
+        """
+        Read the messages of a chunk of a JSON Lines file.
+
+        Parameters
+        ----------
+        data : mmap.mmap
+            The mapped file.
+
+        Returns
+        -------
+        typing.Iterator
+            The OfflineMessage objects.
+        """
+        end = len(data) if self.end is None else self.end
+        position = self.find_line(data, self.start)
+
+        while position < end:
+            following = self.find_line(data, position + 1)
+            line = data[position:following]
+
+            if line.strip():
+                yield self.decode_json_line(line, position)
+
+            position = following
+
+    def read_length_prefixed(self, data: mmap.mmap) -> typing.Iterator:
+        """
+        Read the messages of a length-prefixed file.
+
+        Parameters
+        ----------
+        data : mmap.mmap
+            The mapped file.
+
+        Returns
+        -------
+        typing.Iterator
+            The OfflineMessage objects.
+        """
+        position = 0
+
+        while position < len(data):
+            start = position
+            topic, position = self.read_field(data, position)
+            key, position = self.read_field(data, position)
+            value, position = self.read_field(data, position)
+            (count,) = self.LENGTH.unpack_from(data, position)
+            position += self.LENGTH.size
+            headers = []
+
+            for _ in range(count):
+                header_key, position = self.read_field(data, position)
+                header_value, position = self.read_field(data, position)
+                headers.append((header_key.decode(), header_value))
+
+            yield OfflineMessage(topic.decode(), key, headers, value, 0, start)
+
+    @staticmethod
+    def decode_text(value: object) -> str:
+        """
+        Decode bytes (from a message) to a string for a JSON Lines file.
+
+        Parameters
+        ----------
+        value : object
+            The bytes, None or any other value (which is converted to a string).
+
+        Returns
+        -------
+        str
+            The string with surrogate escapes for bytes that are not valid
+            UTF-8, or None.
+        """
+        if value is None:
+            return None
+        elif isinstance(value, bytes):
+            return value.decode('utf-8', 'surrogateescape')
+
+        return str(value)
+
+    @staticmethod
+    def encode_text(value: object) -> bytes:
+        """
+        Encode a string (from a JSON Lines file) to bytes.
+
+        Parameters
+        ----------
+        value : object
+            The string, bytes, None or any other value (which is converted to
+            a string).
+
+        Returns
+        -------
+        bytes
+            The bytes or None.
+        """
+        if value is None or isinstance(value, bytes):
+            return value
+
+        return str(value).encode('utf-8', 'surrogateescape')
+
+
+class OfflineMessage:
+    """
+    Provide the parts of the Confluent Kafka Message API used to route a message read from a file.
+
+    Parameters
+    ----------
+    topic : str
+        The topic name.
+    key : bytes
+        The key of the message.
+    headers : list
+        A list of (key, value) tuples.
+    value : bytes
+        The value of the message.
+    partition : int
+        The partition of the message.
+    offset : int
+        The offset of the message.
+    """
+
+    def __init__(self, topic: str, key: bytes, headers: list, value: bytes, partition: int, offset: int) -> None:
+        self._headers = headers
+        self._key = key
+        self._offset = offset
+        self._partition = partition
+        self._topic = topic
+        self._value = value
+
+    def error(self) -> None:
+        """Get the error of the message (always None)."""
+        return None
+
+    def headers(self) -> list:
+        """Get the headers of the message."""
+        return list(self._headers)
+
+    def key(self) -> bytes:
+        """Get the key of the message."""
+        return self._key
+
+    def offset(self) -> int:
+        """Get the offset of the message."""
+        return self._offset
+
+    def partition(self) -> int:
+        """Get the partition of the message."""
+        return self._partition
+
+    def topic(self) -> str:
+        """Get the topic of the message."""
+        return self._topic
+
+    def value(self) -> bytes:
+        """Get the value of the message."""
+        return self._value
+
+
+class OfflineProducer:
+    """
+    Provide the parts of the Confluent Kafka Producer API used by the router, counting (and writing) messages.
+
+    As with the Confluent Kafka Producer, the delivery callbacks of the
+    produced messages are served by poll and flush.
+
+    Parameters
+    ----------
+    message_file : MessageFile
+        The file (or chunk) being routed.
+    output_dir : str, optional
+        The directory to write the routed messages to, by default None (the
+        messages are only counted).  The messages produced to each topic are
+        written to <output_dir>/<topic>/<chunk><suffix> in the format of the
+        file being routed.
+    chunk : int, optional
+        The number of the chunk being routed, by default 0
+    """
+
+    def __init__(self, message_file: MessageFile, output_dir: str = None, chunk: int = 0) -> None:
+        self.chunk = chunk
+        self.counts = {}
+        self.deliveries = []
+        self.message_file = message_file
+        self.output_dir = output_dir
+        self.streams = {}
+
+    def __len__(self) -> int:
+        """Get the number of messages awaiting delivery."""
+        return len(self.deliveries)
+
+    def close(self) -> None:
+        """Close the routed files."""
+        for stream in self.streams.values():
+            stream.close()
+
+    def flush(self, timeout: float = None) -> int:
+        """Serve the delivery callbacks of all the produced messages."""
+        return self.poll(timeout)
+
+    def get_stream(self, topic: str) -> typing.BinaryIO:
+        """
+        Get the file that the messages produced to a topic are written to.
+
+        Parameters
+        ----------
+        topic : str
+            The topic name.
+
+        Returns
+        -------
+        typing.BinaryIO
+            The open file.
+        """
+        if topic not in self.streams:
+            directory = os.path.join(self.output_dir, topic)
+            os.makedirs(directory, exist_ok=True)
+            suffix = '.jsonl' if self.message_file.json_lines else '.bin'
+            self.streams[topic] = open(os.path.join(directory, f'{self.chunk:06d}{suffix}'), 'wb')
+
+        return self.streams[topic]
+
+    def poll(self, timeout: float = None) -> int:
+        """
+        Serve the delivery callbacks of the produced messages.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Ignored, by default None
+
+        Returns
+        -------
+        int
+            The number of delivery callbacks served.
+        """
+        deliveries, self.deliveries = self.deliveries, []
+
+        for callback, message in deliveries:
+            callback(None, message)
+
+        return len(deliveries)
+
+    def produce(self, topic: str, value: bytes = None, key: bytes = None, headers: list = None,
+                callback: callable = None) -> None:
+        """
+        Count (and write) a message produced to a topic.
+
+        Parameters
+        ----------
+        topic : str
+            The topic name.
+        value : bytes, optional
+            The value of the message, by default None
+        key : bytes, optional
+            The key of the message, by default None
+        headers : list, optional
+            The headers of the message, by default None
+        callback : callable, optional
+            Called with the produced message by poll or flush, by default None
         """
-        if dlq_mode is not None:
-            self._dlq_mode = dlq_mode
+        self.counts[topic] = self.counts.get(topic, 0) + 1
 
-        return self._dlq_mode
+        if callback is not None:
+            self.deliveries.append((callback, OfflineMessage(topic, key, headers, value, 0, 0)))
 
-    def dry_run_mode(self, dry_run_mode: bool = None) -> bool:
-        """
-        Get or set dry run mode.
+        if self.output_dir is not None:
+            self.get_stream(topic).write(self.message_file.encode(topic, key, headers or [], value))
 
-        When set to true, no messages are produced.
 
-        Parameters
-        ----------
-        dry_run_mode : bool, optional
-            Set the dry-run mode, by default None
+class OfflineRouter:
+    """
+    Route messages from local files with the configured rules (no broker is required).
 
-        Returns
-        -------
-        bool
-            Get dry-run mode.
-        """
-        if dry_run_mode is not None:
-            self._dry_run_mode = dry_run_mode
+    JSON Lines files are split into chunks and the chunks (and other files)
+    are routed in parallel by a pool of worker processes, each with its own
+    KafkaRouter.
 
-        return self._dry_run_mode
+    Parameters
+    ----------
+    paths : list
+        The paths of the files (see MessageFile for the formats).
+    output_dir : str, optional
+        The directory to write the routed messages to, by default None
+    processes : int, optional
+        The number of worker processes, by default None (the number of CPUs).
+        If 1, the files are routed in this process.
+    chunk_size : int, optional
+        The size (in bytes) of the chunks that JSON Lines files are split
+        into, by default 64MiB
+    dlq_topic : str, optional
+        The DLQ topic name, by default 'dlq'
+    """
 
-    def get_dlq_id(self):
+    worker_router = None
+
+    def __init__(self, paths: list, output_dir: str = None, processes: int = None, chunk_size: int = 64 * 1024 ** 2,
+                 dlq_topic: str = 'dlq') -> None:
+        self.chunk_size = chunk_size
+        self.dlq_topic = dlq_topic
+        self.output_dir = output_dir
+        self.paths = paths
+        self.processes = processes or os.cpu_count()
+
+    def get_chunks(self) -> list:
         """
-        Get the ID for the DLQ headers.
+        Get the chunks of the files to be routed.
 
         Returns
         -------
-        str
-            If KAFKA_ROUTER_DLQ_ID is provided. If not provided will be set
-            to KAFKA_CONSUMER_CLIENT_ID (if present) or KAFKA_CONSUMER_GROUP_ID.
+        list
+            The (number, path, start, end) of each chunk.
         """
-        if os.getenv('KAFKA_ROUTER_DLQ_ID', None):
-            return os.environ['KAFKA_ROUTER_DLQ_ID']
-        elif os.getenv('KAFKA_CONSUMER_CLIENT_ID', None):
-            return os.environ['KAFKA_CONSUMER_CLIENT_ID']
+        chunks = itertools.chain.from_iterable(MessageFile(path).get_chunks(self.chunk_size) for path in self.paths)
+        return [(number, *chunk) for number, chunk in enumerate(chunks)]
 
-        return os.environ['KAFKA_CONSUMER_GROUP_ID']
-
-    def get_rules(self) -> None:
+    def route(self) -> dict:
         """
-        Get the rules from the environment variables.
+        Route the messages of the files.
 
         Returns
         -------
-        list
-            A list of KafkaRouterRules objects.
+        dict
+            The number of messages produced to each topic.
         """
-        rules = []
-        keys = []
+        chunks = self.get_chunks()
 
-        for key in os.environ.keys():
-            if key.startswith('KAFKA_ROUTER_RULE_'):
-                keys.append(key)
+        if self.processes == 1:
+            self.init_worker(self.dlq_topic)
+            return self.merge_counts(map(self.route_chunk, chunks))
 
-        keys.sort()
+        import multiprocessing
 
-        for key in keys:
-            self.add_rule(
-                KafkaRouterRule(key, os.environ[key])
-            )
+        context = multiprocessing.get_context('spawn')
 
-        return rules
+        with context.Pool(min(self.processes, len(chunks)), self.init_worker, (self.dlq_topic,)) as pool:
+            counts = self.merge_counts(pool.imap_unordered(self.route_chunk, chunks))
+            # Let the workers exit on their own (leaving the block terminates them, which they log as a signal).
+            pool.close()
+            pool.join()
 
-    def handler(self, signum: int, frame: types.FrameType) -> None:
-        """Catch signals."""
-        signame = signal.Signals(signum).name
-        logger.warning(f'Caught signal {signame} ({signum}).')
-        sys.exit(0)
+        return counts
 
-    def headers(self, headers: list = None) -> list:
+    def route_chunk(self, chunk: tuple) -> dict:
         """
-        Get or set the headers of the message being processed.
+        Route the messages of a chunk (in a worker process).
 
         Parameters
         ----------
-        headers : list, optional
-            If provided, a list of tuples to set as headers for the message, by default None
+        chunk : tuple
+            The number, path, start and end of the chunk.
 
         Returns
         -------
-        list
-            A list of tuples that represent the headers of the message.
-        """
-        if headers is not None:
-            self._headers = headers
-
-        return self._headers
-
-    def match_message_to_rule(self, message: Message) -> None:
-        """
-        Match the given message to the configured rules.
-
-        Parameters
-        ----------
-        message : Message
-            The message to be matched.
+        dict
+            The number of messages produced to each topic.
         """
-        destination_topics = self.DLQ_topic_name
-        message_matched_to_rule = False
-        self.headers(message.headers())
+        number, path, start, end = chunk
+        message_file = MessageFile(path, start, end)
+        producer = OfflineProducer(message_file, self.output_dir, number)
+        self.worker_router.producer = producer
 
-        for rule in self.rules:
-            try:
-                if rule.is_match(message):
-                    destination_topics = rule.destination_topics
-                    message_matched_to_rule = True
-                    break
-            except json.decoder.JSONDecodeError as ex:
-                destination_topics = self.DLQ_topic_name
-                self.upsert_header(f'__{self.get_dlq_id()}.topic', message.topic())
-                self.upsert_header(f'__{self.get_dlq_id()}.partition', message.partition())
-                self.upsert_header(f'__{self.get_dlq_id()}.offset', message.offset())
-                self.upsert_header(f'__{self.get_dlq_id()}.message', ex)
-                self.upsert_header(f'__{self.get_dlq_id()}.stacktrace', traceback.format_exc())
+        try:
+            for message in message_file.read():
+                self.worker_router.match_message_to_rule(message)
 
-                # Keep DLQ headers intact by saying we have matched the message.
-                message_matched_to_rule = True
+            producer.flush()
+        finally:
+            producer.close()
 
-        self.prepare_headers(message, destination_topics, message_matched_to_rule)
-        self.produce(destination_topics, message.value(), message.key(), self.headers())
-        self.report_message_matching_status(destination_topics, message, message_matched_to_rule)
+        return producer.counts
 
-    def prepare_headers(self, message: Message, destination_topics: str, message_matched_to_rule: bool) -> None:
+    @classmethod
+    def init_worker(cls, dlq_topic: str) -> None:
         """
-        Prepare headers before producing a message.
+        Create the KafkaRouter of a worker process.
 
-        Predominantly used to ensure that a message that has not been
-        matched to any rules and is destined for the DLQ topic has
-        headers explaining why.
+        The OfflineProducer writes each message as it is produced and has no
+        delivery callbacks, so the router is put into the default mode (no
+        batch, pipelined, concurrent, DLQ batch or coalesced commit settings).
 
         Parameters
         ----------
-        message : Message
-            The message to be produced.
-        message_matched_to_rule : bool
-            Was the message matched to any rule.
+        dlq_topic : str
+            The DLQ topic name.
         """
-        if destination_topics == self.DLQ_topic_name and not message_matched_to_rule:
-            self.upsert_header(f'__{self.get_dlq_id()}.topic', message.topic())
-            self.upsert_header(f'__{self.get_dlq_id()}.partition', message.partition())
-            self.upsert_header(f'__{self.get_dlq_id()}.offset', message.offset())
-            self.upsert_header(f'__{self.get_dlq_id()}.message', 'Message not matched to any routing rules.')
-
-    @PROCESS_TIME.time()
-    def process_message(self, message: Message):
+        worker_router = KafkaRouter(dlq_topic)
+        worker_router.batch_size = 1
+        worker_router.commit_count = 0
+        worker_router.commit_interval_ms = 0
+        worker_router.concurrency = 1
+        worker_router.dlq_batch_size = 1
+        worker_router.pipelined_mode(False)
+        cls.worker_router = worker_router
+
+    @staticmethod
+    def merge_counts(results: typing.Iterable) -> dict:
         """
-        Process a message that has been consumed from an input topic.
+        Add up the number of messages produced to each topic by each chunk.
 
         Parameters
         ----------
-        message : Message
-            The consumed message to be processed.
+        results : typing.Iterable
+            The counts of each chunk.
 
-        Raises
-        ------
-        KafkaError
-            If an error occurred in the consumer.
+        Returns
+        -------
+        dict
+            The number of messages produced to each topic.
         """
-        if message.error():
-            if message.error().code() == KafkaError._PARTITION_EOF:
-                logger.debug('End of partition reached {0}/{1}'.format(message.topic(), message.partition()))
-            else:
-                raise KafkaException(message.error())
+        counts = {}
+
+        for result in results:
+            for topic, count in result.items():
+                counts[topic] = counts.get(topic, 0) + count
+
+        return counts
+
+
+class Supervisor:
+    """
+    Run KafkaRouter workers in separate processes.
+
+    Each worker has its own consumer in the same consumer group, so the
+    partitions of the source topics are spread across the workers (and the
+    cores that they run on).  The metrics of the workers are aggregated
+    onto a single Prometheus endpoint.
+
+    The workers write their metrics to PROMETHEUS_MULTIPROC_DIR.  If it is
+    set, the metric files left by a previous run are removed at start up.
+    Otherwise, a temporary directory is created and removed on shut down.
+
+    Parameters
+    ----------
+    workers : int
+        The number of worker processes to run.
+    """
+
+    def __init__(self, workers: int) -> None:
+        import multiprocessing
+        import tempfile
+
+        self.workers = workers
+        self.backoff_ms = int(os.getenv('KAFKA_ROUTER_WORKER_BACKOFF_MS', '1000'))
+        self.max_backoff_ms = int(os.getenv('KAFKA_ROUTER_WORKER_MAX_BACKOFF_MS', '60000'))
+        self.context = multiprocessing.get_context('spawn')
+        self.failures = {}
+        self.finished = set()
+        self.processes = {}
+        self.started_times = {}
+        self.start_times = {}
+        self.running(True)
+        self.metrics_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+        self.owns_metrics_dir = not self.metrics_dir
+
+        if self.owns_metrics_dir:
+            self.metrics_dir = tempfile.mkdtemp(prefix=f'{PROG}-')
+            os.environ['PROMETHEUS_MULTIPROC_DIR'] = self.metrics_dir
         else:
-            self.match_message_to_rule(message)
+            self.wipe_metrics_dir()
 
-    def produce(self, topic: str, value: str, key: str, headers: list) -> None:
+    def check_worker(self, worker_id: int) -> None:
         """
-        Produce a message onto a topic unless dry run and DLQ mode is on.
+        Check a worker and (re)start it if required.
 
         Parameters
         ----------
-        topic : str
-            The topic to be written to.
-        value : str
-            The value of the message.
-        key : str
-            The key of the message.
-        headers : list
-            The headers of the message.
+        worker_id : int
+            The ID of the worker.
         """
-        if topic == '':
-            prom_dropped_message_count.inc()
-            dropped_message_count.increment_count()
-            return
+        process = self.processes.get(worker_id)
 
-        if not self.dry_run_mode():
-            topics = topic.split(',')
+        if process is None and self.worker_due(worker_id):
+            self.start_worker(worker_id)
+        elif process is not None and not process.is_alive():
+            self.worker_exited(worker_id, process)
 
-            for topic in topics:
-                self.producer.produce(topic, value, key, headers=self.headers(), callback=self.delivery_report)
-                self.producer.flush()
-                logger.debug('Successfully flushed message on the producer.')
-                prom_producer_message_count.inc()
-                producer_message_count.increment_count()
+    def handler(self, signum: int, frame: types.FrameType) -> None:
+        """Catch signals."""
+        signame = signal.Signals(signum).name
+        logger.warning(f'Supervisor caught signal {signame} ({signum}).')
+        self.running(False)
 
-    def report_message_matching_status(self, destination_topics: str, message: Message,
-                                       message_matched_to_rule: bool) -> None:
-        """
-        Report and set metrics for if the message was matched or not.
+    def reload_handler(self, signum: int, frame: types.FrameType) -> None:
+        """Pass a SIGHUP on to the workers so that they reload their rules."""
+        logger.info(f'Supervisor caught signal {signal.Signals(signum).name} ({signum}), passing it to the workers.')
 
-        Yes, this could be an if statement in match_message_to_rule method,
-        but radon is at the limit of how complex that method is already.
+        for process in self.processes.values():
+            os.kill(process.pid, signum)
 
-        Parameters
-        ----------
-        destination_topics: str
-            The name of the topic that the message is being routed to.
-        message: Message
-            The message that was matched.
-        message_matched_to_rule : bool
-            True if the message was successfully matched to a routing rule,
-            False otherwise.
-        """
-        if message_matched_to_rule and destination_topics == self.DLQ_topic_name:
-            non_routed_error_count.inc()
-        elif message_matched_to_rule:
-            pass
-        else:
-            non_routed_error_count.inc()
+    def remove_metrics_dir(self) -> None:
+        """Remove PROMETHEUS_MULTIPROC_DIR if the supervisor created it."""
+        if self.owns_metrics_dir:
+            import shutil
 
-    def router(self) -> None:
-        """
-        Consume from the consumer and produce to the producer.
+            shutil.rmtree(self.metrics_dir, ignore_errors=True)
 
-        Exits if SIGINT is caught.
-        """
-        if len(self.rules) == 0:
-            logger.error('There are no KafkaRouter rules defined.')
-            sys.exit(0)
+    def run(self) -> None:
+        """Start the workers and restart any that fail until all have finished or a signal is caught."""
+        signal.signal(signal.SIGINT, self.handler)
+        signal.signal(signal.SIGTERM, self.handler)
 
-        self.validate_consumer_config(self.consumer_conf)
-        self.consumer = Consumer(self.consumer_conf)
-        self.producer = Producer(self.producer_conf)
+        if os.getenv('KAFKA_ROUTER_RULES_PATH'):
+            signal.signal(signal.SIGHUP, self.reload_handler)
 
         try:
-            self.consumer.subscribe(self.source_topics)
-            time_of_last_message = time.time() * 1000
-
-            while self.running():
-                msg = self.consumer.poll(timeout=1.0)
+            self.start_metrics_server()
 
-                if msg is None:
-                    logger.debug('No messages to consume.')
-                    self.check_for_timeout(time_of_last_message)
-                    continue
+            while self.running() and len(self.finished) < self.workers:
+                for worker_id in range(self.workers):
+                    self.check_worker(worker_id)
 
-                with sentry_sdk.start_transaction(op='task', name='Process consumed message'):
-                    time_of_last_message = time.time() * 1000
-                    consumer_message_count.increment_count()
-                    prom_consumer_message_count.inc()
-                    self.process_message(msg)
-                    self.commit(msg)
-        except SystemExit:
-            logger.warning('SystemExit exception caught.')
+                time.sleep(0.5)
         finally:
-            logger.info('Closing the consumer.')
-            logger.info(f'Consumed {consumer_message_count.count()} messages.')
-            logger.info(f'Produced {producer_message_count.count()} messages.')
-            logger.info(f'Dropped {dropped_message_count.count()} messages.')
-            self.consumer.close()
+            self.stop_workers()
 
     def running(self, running: bool = None) -> bool:
         """
@@ -766,57 +4744,105 @@ class KafkaRouter:
 
         return self._running
 
-    def upsert_header(self, new_key: str, new_value: str) -> None:
+    def start_metrics_server(self) -> None:
+        """Serve the metrics of all the workers on KAFKA_ROUTER_PROMETHEUS_PORT (unless disabled)."""
+        if EnvironmentConfig().get_boolean('KAFKA_ROUTER_PROMETHEUS_DISABLED'):
+            return
+
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        version_info = prometheus_client.Info(f'{kafka_prefix}run_version', 'The currently running version.',
+                                              registry=registry)
+        version_info.info({f'{kafka_prefix}version': __version__})
+        port = int(os.getenv('KAFKA_ROUTER_PROMETHEUS_PORT', '8000'))
+        prometheus_client.start_http_server(port, registry=registry)
+
+    def start_worker(self, worker_id: int) -> None:
         """
-        Update an existing header or insert a new one.
+        Start a worker process.
 
         Parameters
         ----------
-        new_key : str
-            The key value of the header.
-        new_value : str
-            The value of the header.
+        worker_id : int
+            The ID of the worker.
         """
-        existing_headers = self.headers()
-        new_headers = []
+        process = self.context.Process(target=run_worker, args=(worker_id,), name=f'{PROG}-worker-{worker_id}')
+        process.start()
+        logger.info(f'Started worker {worker_id} (PID {process.pid}).')
+        self.processes[worker_id] = process
+        self.started_times[worker_id] = time.time()
+
+    def stop_workers(self) -> None:
+        """Ask the workers to stop, wait for them to do so and then remove the metrics directory (if created)."""
+        try:
+            for process in self.processes.values():
+                process.terminate()
 
-        for key, value in existing_headers:
-            if key != new_key:
-                new_headers.append((key, value))
+            for process in self.processes.values():
+                process.join()
+                multiprocess.mark_process_dead(process.pid)
+        finally:
+            self.remove_metrics_dir()
 
-        new_headers.append((new_key, str(new_value)))
-        self.headers(new_headers)
+    def wipe_metrics_dir(self) -> None:
+        """Remove the metric files left in PROMETHEUS_MULTIPROC_DIR by a previous run."""
+        os.makedirs(self.metrics_dir, exist_ok=True)
 
-    def validate_consumer_config(self, config: dict) -> None:
-        """
-        Validate the consumer config.
+        for name in os.listdir(self.metrics_dir):
+            if name.endswith('.db'):
+                os.remove(os.path.join(self.metrics_dir, name))
 
-        Ensures that enable.auto.commit is disabled.
+    def worker_due(self, worker_id: int) -> bool:
+        """
+        Check if a worker that is not running is due to be started.
 
         Parameters
         ----------
-        config : dict
-            The consumer config.
+        worker_id : int
+            The ID of the worker.
 
-        Raises
-        ------
-        ValueError
-            Raised if enable.auto.commit is missing or not set to false.
+        Returns
+        -------
+        bool
+            False if the worker has finished or is backing off after a failure.
         """
-        is_valid = False
+        return worker_id not in self.finished and time.time() >= self.start_times.get(worker_id, 0)
 
-        if 'enable.auto.commit' not in config:
-            logger.error('Please set the KAFKA_CONSUMER_ENABLE_AUTO_COMMIT environment variable.')
-        elif config['enable.auto.commit'] != 'false':
-            logger.error('Please set the KAFKA_CONSUMER_ENABLE_AUTO_COMMIT environment variable to "false".')
-        else:
-            is_valid = True
+    def worker_exited(self, worker_id: int, process: multiprocessing.Process) -> None:
+        """
+        Handle a worker process that has exited.
 
-        if not is_valid:
-            raise ValueError('The consumer must be configured with enable.auto.commit set to false.')
+        A worker that exits cleanly (e.g. at the end of a DLQ replay) is not
+        restarted.  A worker that fails is restarted after a delay that doubles
+        with each consecutive failure up to KAFKA_ROUTER_WORKER_MAX_BACKOFF_MS.
+        A worker that ran for longer than that before failing is no longer
+        considered to be failing consecutively.
+
+        Parameters
+        ----------
+        worker_id : int
+            The ID of the worker.
+        process : multiprocessing.Process
+            The process that has exited.
+        """
+        del self.processes[worker_id]
+        multiprocess.mark_process_dead(process.pid)
 
+        if process.exitcode == 0:
+            logger.info(f'Worker {worker_id} has finished.')
+            self.finished.add(worker_id)
+            return
 
-if __name__ == '__main__':
+        uptime_ms = (time.time() - self.started_times[worker_id]) * 1000
+        failures = 1 if uptime_ms > self.max_backoff_ms else self.failures.get(worker_id, 0) + 1
+        self.failures[worker_id] = failures
+        backoff_ms = min(self.backoff_ms * 2 ** (failures - 1), self.max_backoff_ms)
+        self.start_times[worker_id] = time.time() + backoff_ms / 1000
+        logger.error(f'Worker {worker_id} exited with {process.exitcode}, restarting in {backoff_ms}ms.')
+
+
+def init_sentry() -> None:
+    """Initialise Sentry if SENTRY_DSN is configured in the environment."""
     sentry_dsn = os.getenv('SENTRY_DSN', None)
 
     if sentry_dsn:
@@ -826,6 +4852,73 @@ if __name__ == '__main__':
         logger.debug(f'Sentry config "{sentry_config}".')
         sentry_sdk.init(**sentry_config)
 
-    start_http_server(int(os.getenv('KAFKA_ROUTER_PROMETHEUS_PORT', '8000')))
+
+def route_files(argv: list) -> int:
+    """
+    Route messages from local files and print the number produced to each topic.
+
+    Parameters
+    ----------
+    argv : list
+        The command line arguments (after "offline").
+
+    Returns
+    -------
+    int
+        The exit status.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog=f'{PROG} offline',
+                                     description='Route messages from local JSON Lines or length-prefixed files.')
+    parser.add_argument('paths', nargs='+', metavar='FILE', help='The files of messages to be routed.')
+    parser.add_argument('--output-dir', help='Write the routed messages to a file for each topic in this directory.')
+    parser.add_argument('--processes', type=int, help='The number of worker processes (by default, one per CPU).')
+    parser.add_argument('--chunk-size-mb', type=int, default=64,
+                        help='The size of the chunks that JSON Lines files are split into.')
+    parser.add_argument('--dlq-topic', default=os.getenv('KAFKA_ROUTER_DLQ_TOPIC_NAME') or 'dlq',
+                        help='The topic for messages that match no rule.')
+    args = parser.parse_args(argv)
+    os.environ.setdefault('KAFKA_ROUTER_DLQ_ID', PROG)
+    start = time.perf_counter()
+    counts = OfflineRouter(args.paths, args.output_dir, args.processes, args.chunk_size_mb * 1024 ** 2,
+                           args.dlq_topic).route()
+
+    for topic, count in sorted(counts.items()):
+        print(f'{topic}\t{count}')
+
+    logger.info(f'Routed {sum(counts.values())} messages in {time.perf_counter() - start:.3f}s.')
+    return 0
+
+
+def run_worker(worker_id: int) -> None:
+    """
+    Run a KafkaRouter in a worker process.
+
+    Parameters
+    ----------
+    worker_id : int
+        The ID of the worker.
+    """
+    logger.info(f'Worker {worker_id} starting.')
+    init_sentry()
     router = KafkaRouter(os.getenv('KAFKA_ROUTER_DLQ_TOPIC_NAME', None))
     router.router()
+
+
+if __name__ == '__main__':
+    workers = int(os.getenv('KAFKA_ROUTER_WORKERS', '1'))
+
+    if sys.argv[1:2] == ['offline']:
+        sys.exit(route_files(sys.argv[2:]))
+    elif workers > 1:
+        Supervisor(workers).run()
+    else:
+        init_sentry()
+
+        if not EnvironmentConfig().get_boolean('KAFKA_ROUTER_PROMETHEUS_DISABLED'):
+            VERSION_INFO.info({f'{kafka_prefix}version': __version__})
+            prometheus_client.start_http_server(int(os.getenv('KAFKA_ROUTER_PROMETHEUS_PORT', '8000')))
+
+        router = KafkaRouter(os.getenv('KAFKA_ROUTER_DLQ_TOPIC_NAME', None))
+        router.router()
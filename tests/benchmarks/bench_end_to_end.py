@@ -0,0 +1,223 @@
+"""
+End-to-end throughput benchmark of the router loop.
+
+Runs KafkaRouter.router (poll, route, produce, delivery report and commit)
+against the in-memory broker in tests/step_defs/fake_broker.py, so that no
+broker or network is required.  Broker latency and delivery failures can be
+simulated.
+
+Run from the root of the repository:
+
+    PYTHONPATH=.:tests/step_defs python tests/benchmarks/bench_end_to_end.py --pipelined --latency-ms 5
+
+The results can be saved and compared in the same way as bench_routing.py.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+from bench_routing import compare
+from confluent_kafka import KafkaException
+from fake_broker import FakeBroker
+
+import router
+
+SOURCE_TOPIC = 'input'
+
+
+def get_args(argv: list) -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+
+    Parameters
+    ----------
+    argv : list
+        The command line arguments (without the program name).
+
+    Returns
+    -------
+    argparse.Namespace
+        The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--messages', type=int, default=20000, help='The number of messages to route.')
+    parser.add_argument('--partitions', type=int, default=3, help='The number of partitions of each topic.')
+    parser.add_argument('--rules', type=int, default=10, help='The number of rules.')
+    parser.add_argument('--payload-size', type=int, default=1024,
+                        help='The approximate size of each message value in bytes.')
+    parser.add_argument('--dlq-ratio', type=float, default=0.1, help='The fraction of messages that match no rule.')
+    parser.add_argument('--latency-ms', type=float, default=0, help='The simulated delivery latency.')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='The fraction of deliveries that fail (the router stops on the first unless pipelined).')
+    parser.add_argument('--pipelined', action='store_true', help='Run in pipelined mode.')
+    parser.add_argument('--batch-size', type=int, default=1, help='KAFKA_ROUTER_BATCH_SIZE.')
+    parser.add_argument('--commit-count', type=int, default=0, help='KAFKA_ROUTER_COMMIT_COUNT.')
+    parser.add_argument('--concurrency', type=int, default=1, help='KAFKA_ROUTER_CONCURRENCY.')
+    parser.add_argument('--max-in-flight', type=int, default=10000, help='KAFKA_ROUTER_MAX_IN_FLIGHT.')
+    parser.add_argument('--seed', type=int, default=42, help='The seed for the random message generator.')
+    parser.add_argument('--save', metavar='FILE', help='Save the result as a baseline.')
+    parser.add_argument('--compare', metavar='FILE', help='Compare the result against a baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='The fraction by which throughput may drop when comparing.')
+    return parser.parse_args(argv)
+
+
+def get_router(args: argparse.Namespace) -> router.KafkaRouter:
+    """
+    Create a router for the benchmark.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The command line arguments.
+
+    Returns
+    -------
+    router.KafkaRouter
+        The router.
+    """
+    kafka_router = router.KafkaRouter('dlq')
+    kafka_router.consumer_conf = {'enable.auto.commit': 'false', 'group.id': 'router'}
+    kafka_router.pipelined_mode(args.pipelined)
+    kafka_router.batch_size = args.batch_size
+    kafka_router.commit_count = args.commit_count
+    kafka_router.concurrency = args.concurrency
+    kafka_router.max_in_flight = args.max_in_flight
+
+    for index in range(args.rules):
+        rule = {
+            'destination_topics': f'output.C{index}',
+            'jmespath': 'country',
+            'regexp': f'^C{index}$',
+            'source_topic': SOURCE_TOPIC
+        }
+        kafka_router.add_rule(router.KafkaRouterRule(f'KAFKA_ROUTER_RULE_{index:05d}', json.dumps(rule)))
+
+    return kafka_router
+
+
+def populate(broker: FakeBroker, args: argparse.Namespace) -> None:
+    """
+    Append the messages to be routed to the source topic.
+
+    Parameters
+    ----------
+    broker : FakeBroker
+        The broker.
+    args : argparse.Namespace
+        The command line arguments.
+    """
+    generator = random.Random(args.seed)
+
+    for offset in range(args.messages):
+        if generator.random() < args.dlq_ratio:
+            country = 'XX'
+        else:
+            country = f'C{generator.randrange(args.rules)}'
+
+        document = {'id': offset, 'country': country, 'padding': ''}
+        document['padding'] = 'x' * max(0, args.payload_size - len(json.dumps(document)))
+        broker.append(SOURCE_TOPIC, json.dumps(document).encode(), f'{offset % 100}'.encode())
+
+
+def run(args: argparse.Namespace) -> dict:
+    """
+    Run the router loop until every message has been consumed.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The command line arguments.
+
+    Returns
+    -------
+    dict
+        The result of the benchmark.
+    """
+    broker = FakeBroker(args.partitions, args.latency_ms, args.failure_rate, args.seed)
+    populate(broker, args)
+    kafka_router = get_router(args)
+    broker.idle_callback = lambda broker: kafka_router.running(False)
+    error = None
+    start = time.perf_counter()
+
+    try:
+        kafka_router.router(broker.consumer, broker.producer)
+    except KafkaException as ex:
+        error = str(ex)
+
+    elapsed = time.perf_counter() - start
+    committed = sum(broker.committed_offset('router', SOURCE_TOPIC, partition) or 0
+                    for partition in range(args.partitions))
+    return {
+        'scenario': f'end-to-end/{args.rules}/{args.payload_size}/{args.latency_ms}/{get_mode(args)}',
+        'msgs_per_sec': committed / elapsed,
+        'committed': committed,
+        'elapsed_seconds': elapsed,
+        'error': error
+    }
+
+
+def get_mode(args: argparse.Namespace) -> str:
+    """
+    Describe the router mode of the benchmark.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The command line arguments.
+
+    Returns
+    -------
+    str
+        The modes that are enabled (e.g. "pipelined+batch5").
+    """
+    modes = {
+        'pipelined': args.pipelined,
+        f'batch{args.batch_size}': args.batch_size > 1,
+        f'commit{args.commit_count}': args.commit_count > 0,
+        f'concurrency{args.concurrency}': args.concurrency > 1
+    }
+    return '+'.join(mode for mode, enabled in modes.items() if enabled) or 'default'
+
+
+def main(argv: list) -> int:
+    """
+    Run the benchmark.
+
+    Parameters
+    ----------
+    argv : list
+        The command line arguments (without the program name).
+
+    Returns
+    -------
+    int
+        The exit status.
+    """
+    args = get_args(argv)
+    os.environ.setdefault('KAFKA_ROUTER_DLQ_ID', 'router')
+    router.logger.setLevel(logging.CRITICAL)
+    result = run(args)
+    print(f'{result["scenario"]}: {result["committed"]:,} messages committed in {result["elapsed_seconds"]:.2f}s'
+          f' ({result["msgs_per_sec"]:,.0f} msgs/s)')
+
+    if result['error']:
+        print(f'The router stopped: {result["error"]}')
+
+    if args.save:
+        with open(args.save, 'w') as stream:
+            json.dump({'version': router.__version__, 'args': vars(args), 'results': [result]}, stream, indent=2)
+
+    if args.compare:
+        return 1 if compare([result], args.compare, args.tolerance) else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
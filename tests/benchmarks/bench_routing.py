@@ -0,0 +1,336 @@
+"""
+Micro-benchmarks of the routing engine.
+
+Drives KafkaRouter.match_message_to_rule (or each KafkaRouterRule.is_match
+in turn) with the in-memory messages of tests/step_defs/fake_broker.py, so
+that no broker is required.  Each scenario is a combination of a rule set
+shape, a number of rules, a payload size and the ratio of messages that
+match no rule (and so go to the DLQ).
+
+Run from the root of the repository (the rule schema is read from there):
+
+    PYTHONPATH=.:tests/step_defs python tests/benchmarks/bench_routing.py --save baseline.json
+
+and then, on a branch:
+
+    PYTHONPATH=.:tests/step_defs python tests/benchmarks/bench_routing.py --compare baseline.json
+
+When comparing, the exit status is 1 if the throughput of any scenario has
+dropped by more than the tolerance.
+"""
+import argparse
+import functools
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+from fake_broker import FakeMessage
+
+import router
+
+SHAPES = ['bytes', 'header', 'jmespath', 'raw']
+
+
+def get_rule(shape: str, index: int, topic: str) -> dict:
+    """
+    Get a rule that matches messages for a country code.
+
+    Parameters
+    ----------
+    shape : str
+        The shape of the rule set (bytes, header, jmespath or raw).
+    index : int
+        The index of the rule, used to create a unique country code.
+    topic : str
+        The source topic of the rule.
+
+    Returns
+    -------
+    dict
+        The rule.
+    """
+    rule = {
+        'destination_topics': f'output.C{index}',
+        'source_topic': topic
+    }
+
+    if shape == 'header':
+        rule.update({'header': 'country', 'header_regexp': f'^C{index}$'})
+    elif shape == 'jmespath':
+        rule.update({'jmespath': 'country', 'regexp': f'^C{index}$'})
+    else:
+        rule['regexp'] = f'"country": "C{index}"'
+        rule['bytes'] = shape == 'bytes'
+
+    return rule
+
+
+def get_messages(args: argparse.Namespace, rule_count: int, payload_size: int, topic: str) -> list:
+    """
+    Create the messages for a scenario.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The command line arguments.
+    rule_count : int
+        The number of rules, each of which matches a different country code.
+    payload_size : int
+        The approximate size of each message value in bytes.
+    topic : str
+        The topic of the messages.
+
+    Returns
+    -------
+    list
+        The messages.
+    """
+    generator = random.Random(args.seed)
+    messages = []
+
+    for offset in range(args.messages):
+        if generator.random() < args.dlq_ratio:
+            country = 'XX'
+        else:
+            country = f'C{generator.randrange(rule_count)}'
+
+        document = {'id': offset, 'country': country, 'padding': ''}
+        document['padding'] = 'x' * max(0, payload_size - len(json.dumps(document)))
+        headers = [('country', country.encode())]
+        messages.append(FakeMessage(topic, 0, offset, None, json.dumps(document).encode(), headers, 0))
+
+    return messages
+
+
+def get_router(shape: str, rule_count: int, topic: str) -> router.KafkaRouter:
+    """
+    Create a router with a rule set for a scenario.
+
+    The router is in dry run mode, so the messages are routed but not
+    produced.
+
+    Parameters
+    ----------
+    shape : str
+        The shape of the rule set.
+    rule_count : int
+        The number of rules.
+    topic : str
+        The source topic of the rules.
+
+    Returns
+    -------
+    router.KafkaRouter
+        The router.
+    """
+    kafka_router = router.KafkaRouter('dlq')
+    kafka_router.dry_run_mode(True)
+
+    for index in range(rule_count):
+        rule = json.dumps(get_rule(shape, index, topic))
+        kafka_router.add_rule(router.KafkaRouterRule(f'KAFKA_ROUTER_RULE_{index:05d}', rule))
+
+    return kafka_router
+
+
+def match_each_rule(kafka_router: router.KafkaRouter, message: FakeMessage) -> None:
+    """
+    Check a message against each rule for its topic in turn until one matches.
+
+    Parameters
+    ----------
+    kafka_router : router.KafkaRouter
+        The router holding the rules.
+    message : FakeMessage
+        The message to be checked.
+    """
+    context = router.MessageContext(message)
+
+    for rule in kafka_router.get_rules_for_topic(message.topic()):
+        if rule.is_match(message, context):
+            return
+
+
+def percentile(latencies: list, fraction: float) -> float:
+    """
+    Get a percentile from a sorted list of latencies.
+
+    Parameters
+    ----------
+    latencies : list
+        The latencies in nanoseconds, sorted in ascending order.
+    fraction : float
+        The percentile as a fraction (e.g. 0.99).
+
+    Returns
+    -------
+    float
+        The latency in microseconds.
+    """
+    index = min(len(latencies) - 1, int(len(latencies) * fraction))
+    return latencies[index] / 1000
+
+
+def run_scenario(args: argparse.Namespace, shape: str, rule_count: int, payload_size: int) -> dict:
+    """
+    Run a single benchmark scenario.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The command line arguments.
+    shape : str
+        The shape of the rule set.
+    rule_count : int
+        The number of rules.
+    payload_size : int
+        The approximate size of each message value in bytes.
+
+    Returns
+    -------
+    dict
+        The results of the scenario.
+    """
+    topic = f'bench.{shape}.{rule_count}.{payload_size}'
+    kafka_router = get_router(shape, rule_count, topic)
+    messages = get_messages(args, rule_count, payload_size, topic)
+    route = kafka_router.match_message_to_rule
+
+    if args.target == 'rules':
+        route = functools.partial(match_each_rule, kafka_router)
+
+    for message in messages[:args.warmup]:
+        route(message)
+
+    latencies = []
+    start = time.perf_counter()
+
+    for message in messages:
+        message_start = time.perf_counter_ns()
+        route(message)
+        latencies.append(time.perf_counter_ns() - message_start)
+
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'scenario': f'{args.target}/{shape}/{rule_count}/{payload_size}/{args.dlq_ratio}',
+        'msgs_per_sec': len(messages) / elapsed,
+        'p50_us': percentile(latencies, 0.5),
+        'p99_us': percentile(latencies, 0.99)
+    }
+
+
+def compare(results: list, baseline_path: str, tolerance: float) -> int:
+    """
+    Compare the results against a saved baseline.
+
+    Parameters
+    ----------
+    results : list
+        The results of this run.
+    baseline_path : str
+        The path of the baseline JSON file.
+    tolerance : float
+        The fraction by which throughput may drop before it is a regression.
+
+    Returns
+    -------
+    int
+        The number of scenarios that have regressed.
+    """
+    with open(baseline_path) as stream:
+        baseline = {result['scenario']: result for result in json.load(stream)['results']}
+
+    regressions = 0
+
+    for result in results:
+        previous = baseline.get(result['scenario'])
+
+        if previous is None:
+            continue
+
+        change = result['msgs_per_sec'] / previous['msgs_per_sec'] - 1
+        regressed = change < -tolerance
+        regressions += regressed
+        flag = '  REGRESSION' if regressed else ''
+        print(f'{result["scenario"]:<40} {previous["msgs_per_sec"]:>12,.0f} -> {result["msgs_per_sec"]:>12,.0f}'
+              f' msgs/s ({change:+.1%}){flag}')
+
+    return regressions
+
+
+def get_args(argv: list) -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+
+    Parameters
+    ----------
+    argv : list
+        The command line arguments (without the program name).
+
+    Returns
+    -------
+    argparse.Namespace
+        The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=SHAPES, help='The rule set shapes.')
+    parser.add_argument('--rules', nargs='+', type=int, default=[10, 100, 1000], help='The numbers of rules.')
+    parser.add_argument('--payload-sizes', nargs='+', type=int, default=[256, 4096, 65536],
+                        help='The approximate sizes of the message values in bytes.')
+    parser.add_argument('--dlq-ratio', type=float, default=0.1,
+                        help='The fraction of messages that match no rule.')
+    parser.add_argument('--messages', type=int, default=1000, help='The number of messages per scenario.')
+    parser.add_argument('--warmup', type=int, default=100, help='The number of messages routed before timing.')
+    parser.add_argument('--seed', type=int, default=42, help='The seed for the random message generator.')
+    parser.add_argument('--target', choices=['router', 'rules'], default='router',
+                        help='Route with match_message_to_rule or check each rule with is_match in turn.')
+    parser.add_argument('--save', metavar='FILE', help='Save the results as a baseline.')
+    parser.add_argument('--compare', metavar='FILE', help='Compare the results against a baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='The fraction by which throughput may drop when comparing.')
+    return parser.parse_args(argv)
+
+
+def main(argv: list) -> int:
+    """
+    Run the benchmarks.
+
+    Parameters
+    ----------
+    argv : list
+        The command line arguments (without the program name).
+
+    Returns
+    -------
+    int
+        The exit status.
+    """
+    args = get_args(argv)
+    os.environ.setdefault('KAFKA_ROUTER_DLQ_ID', 'router')
+    router.logger.setLevel(logging.ERROR)
+    results = []
+    print(f'{"scenario":<40} {"msgs/s":>12} {"p50 us":>10} {"p99 us":>10}')
+
+    for shape, rule_count, payload_size in itertools.product(args.shapes, args.rules, args.payload_sizes):
+        result = run_scenario(args, shape, rule_count, payload_size)
+        results.append(result)
+        print(f'{result["scenario"]:<40} {result["msgs_per_sec"]:>12,.0f} {result["p50_us"]:>10.1f}'
+              f' {result["p99_us"]:>10.1f}')
+
+    if args.save:
+        with open(args.save, 'w') as stream:
+            json.dump({'version': router.__version__, 'args': vars(args), 'results': results}, stream, indent=2)
+
+    if args.compare:
+        return 1 if compare(results, args.compare, args.tolerance) else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,152 @@
+"""
+Cold start benchmark of the router.
+
+Times, in a fresh interpreter each time, importing router.py and creating a
+KafkaRouter in DLQ mode with a rule set (which is what a DLQ replay job does
+before it consumes anything).  The time taken by the interpreter itself
+(``python -c pass``) is measured in the same way and subtracted, so that the
+budget applies to the router alone.
+
+Run from the root of the repository:
+
+    PYTHONPATH=. python tests/benchmarks/bench_startup.py --budget-ms 300
+
+The exit status is 1 if the median start up time is over the budget.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import router
+
+STARTUP = "import router; router.KafkaRouter('dlq')"
+
+
+def get_args(argv: list) -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+
+    Parameters
+    ----------
+    argv : list
+        The command line arguments (without the program name).
+
+    Returns
+    -------
+    argparse.Namespace
+        The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--runs', type=int, default=10, help='The number of cold starts to time.')
+    parser.add_argument('--rules', type=int, default=10, help='The number of rules.')
+    parser.add_argument('--shape', choices=['header', 'jmespath'], default='jmespath',
+                        help='Match the rules on a header or on a JMESPath expression.')
+    parser.add_argument('--budget-ms', type=float, default=500,
+                        help='Fail if the median start up time (less the interpreter) is over this.')
+    parser.add_argument('--save', metavar='FILE', help='Save the result as a baseline.')
+    return parser.parse_args(argv)
+
+
+def get_environment(args: argparse.Namespace) -> dict:
+    """
+    Get the environment of a replay job with the rules of the benchmark.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The command line arguments.
+
+    Returns
+    -------
+    dict
+        The environment variables.
+    """
+    environment = {key: value for key, value in os.environ.items() if not key.startswith('KAFKA_ROUTER_RULE_')}
+    environment.update({
+        'KAFKA_ROUTER_DLQ_ID': 'router',
+        'KAFKA_ROUTER_DLQ_MODE': 'true',
+        'KAFKA_ROUTER_PROMETHEUS_DISABLED': 'true'
+    })
+    environment.pop('SENTRY_DSN', None)
+
+    for index in range(args.rules):
+        rule = {'destination_topics': f'output.C{index}', 'source_topic': 'dlq'}
+
+        if args.shape == 'header':
+            rule.update({'header': 'country', 'header_regexp': f'^C{index}$'})
+        else:
+            rule.update({'jmespath': 'country', 'regexp': f'^C{index}$'})
+
+        environment[f'KAFKA_ROUTER_RULE_{index:05d}'] = json.dumps(rule)
+
+    return environment
+
+
+def time_runs(code: str, runs: int, environment: dict) -> list:
+    """
+    Time running some code in a fresh interpreter.
+
+    Parameters
+    ----------
+    code : str
+        The code to be run.
+    runs : int
+        The number of times to run it.
+    environment : dict
+        The environment variables.
+
+    Returns
+    -------
+    list
+        The times taken in milliseconds.
+    """
+    times = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], env=environment, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+
+    return times
+
+
+def main(argv: list) -> int:
+    """
+    Run the benchmark.
+
+    Parameters
+    ----------
+    argv : list
+        The command line arguments (without the program name).
+
+    Returns
+    -------
+    int
+        The exit status.
+    """
+    args = get_args(argv)
+    environment = get_environment(args)
+    interpreter_ms = statistics.median(time_runs('pass', args.runs, environment))
+    startup_times = time_runs(STARTUP, args.runs, environment)
+    startup_ms = statistics.median(startup_times) - interpreter_ms
+    print(f'startup/{args.shape}/{args.rules}: {startup_ms:.1f}ms median'
+          f' ({min(startup_times) - interpreter_ms:.1f}ms best, {interpreter_ms:.1f}ms interpreter)')
+
+    if args.save:
+        with open(args.save, 'w') as stream:
+            result = {'scenario': f'startup/{args.shape}/{args.rules}', 'startup_ms': startup_ms}
+            json.dump({'version': router.__version__, 'args': vars(args), 'results': [result]}, stream, indent=2)
+
+    if startup_ms > args.budget_ms:
+        print(f'REGRESSION: start up took {startup_ms:.1f}ms, the budget is {args.budget_ms:.1f}ms.')
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -26,6 +26,149 @@ Feature: Kafka Router Rule
         | Hello, world!                                                                                                | input.dlq | {"destination_topics":"GB.output","source_topic":"input.dlq","header":"__router.errors.topic","header_regexp":"^foo$"}                     | False            |
         | Hello, world!                                                                                                | input.dlq | {"destination_topics":"GB.output","source_topic":"input.dlq","header":"__router.errors.topic","header_regexp":"^input$","regexp":"^Hello"} | True             |
         | Goodbye Cruel World, Elvis Costello                                                                          | input.dlq | {"destination_topics":"GB.output","source_topic":"input.dlq","header":"__router.errors.topic","header_regexp":"^foo$","regexp":"^Hello"}   | False            |
+        | Country: Scotland                                                                                            | input     | {"bytes":false,"destination_topics":"GB.output","regexp":"Scotland","source_topic":"input"}                                                | True             |
+        | Hello, world!                                                                                                | input     | {"bytes":true,"destination_topics":"GB.output","regexp":"^Hello","source_topic":"input"}                                                   | True             |
+        | Goodbye Cruel World, Elvis Costello                                                                          | input     | {"bytes":true,"destination_topics":"GB.output","regexp":"^Hello","source_topic":"input"}                                                   | False            |
+        | Hello, world!                                                                                                | input     | {"bytes":true,"destination_topics":"GB.output","header":"status","header_regexp":"^TEST$","source_topic":"input"}                          | True             |
+
+    Scenario: Invalid JSON Is Parsed Once and Routed to the DLQ
+        Given a KafkaRouter with DLQ topic "dlq_topic"
+        And a message with a value of Hello, world!
+        And with message topic input.json
+        When OS environment KAFKA_ROUTER_DLQ_ID is router
+        And the KafkaRouter is in dry run mode
+        And the KafkaRouter has a rule of {"destination_topics":"GB.output","jmespath":"country","regexp":"^GB$","source_topic":"input.json"}
+        And the KafkaRouter has a rule of {"destination_topics":"IE.output","jmespath":"country","regexp":"^IE$","source_topic":"input.json"}
+        And the KafkaRouter has a rule of {"destination_topics":"GB.output","jmespath":"vat_number","regexp":"^GB","source_topic":"input.json"}
+        And the message is matched by the KafkaRouter
+        Then the message value was read 2 times
+        And the KafkaRouter header __router.topic is input.json
+        And the KafkaRouter header __router.message is Expecting value: line 1 column 1 (char 0)
+
+    Scenario: A Message That Is Not UTF-8 Is Routed to the DLQ
+        Given a KafkaRouter with DLQ topic "dlq_topic"
+        And a message with a Latin-1 value of Café Olé
+        And with message topic input.text
+        When OS environment KAFKA_ROUTER_DLQ_ID is router
+        And the KafkaRouter is in dry run mode
+        And the KafkaRouter has a rule of {"destination_topics":"CAFE","regexp":"^Caf","source_topic":"input.text"}
+        And the message is matched by the KafkaRouter
+        Then the KafkaRouter header __router.topic is input.text
+        And the KafkaRouter header __router.message is 'utf-8' codec can't decode byte 0xe9 in position 3: invalid continuation byte
+
+    Scenario: Bytes Rules Match Messages That Are Not UTF-8
+        Given a KafkaRouter with DLQ topic "dlq_topic"
+        And a message with a Latin-1 value of Café Olé
+        And with message topic input.bytes
+        When append message header status with value TEST
+        And the KafkaRouter has a rule of {"bytes":true,"destination_topics":"LIVE","header":"status","header_regexp":"^LIVE$","source_topic":"input.bytes"}
+        And the KafkaRouter has a rule of {"bytes":true,"destination_topics":"CAFE","regexp":"^Caf","source_topic":"input.bytes"}
+        And the KafkaRouter has a rule of {"bytes":true,"destination_topics":"TEST","header":"status","header_regexp":"^TEST$","source_topic":"input.bytes"}
+        Then 2 rules are candidates for the message
+        And the first matching candidate is CAFE
+
+    Scenario: Shared JMESPath Expressions Are Evaluated Once
+        Given a KafkaRouter with DLQ topic "dlq_topic"
+        And a message with a value of { "country": "IE", "vat_number": "IE1234567T" }
+        And with message topic input.shared
+        When the KafkaRouter is in dry run mode
+        And the KafkaRouter has a rule of {"destination_topics":"GB.output","jmespath":"country","regexp":"^GB$","source_topic":"input.shared"}
+        And the KafkaRouter has a rule of {"destination_topics":"GB.output","jmespath":"vat_number","regexp":"^GB","source_topic":"input.shared"}
+        And the KafkaRouter has a rule of {"destination_topics":"IE.output","jmespath":"country","regexp":"^IE$","source_topic":"input.shared"}
+        And the JMESPath evaluations are counted
+        And the message is matched by the KafkaRouter
+        Then the KafkaRouter has 2 distinct JMESPath expressions
+        And the JMESPath expressions were evaluated 2 times
+
+    Scenario Outline: Equality Rules Are Dispatched by Value
+        Given a KafkaRouter with DLQ topic "dlq_topic"
+        And a message with a value of <message_value>
+        And with message topic input.eq
+        When append message header status with value <status>
+        And the KafkaRouter has a rule of {"destination_topics":"GB","jmespath":"country","regexp":"^GB$","source_topic":"input.eq"}
+        And the KafkaRouter has a rule of {"destination_topics":"IE","jmespath":"country","regexp":"^IE$","source_topic":"input.eq"}
+        And the KafkaRouter has a rule of {"destination_topics":"EU","jmespath":"country","regexp":"^(FR|DE|IE)$","source_topic":"input.eq"}
+        And the KafkaRouter has a rule of {"destination_topics":"FR","jmespath":"country","regexp":"^FR$","source_topic":"input.eq"}
+        And the KafkaRouter has a rule of {"destination_topics":"TEST","header":"status","header_regexp":"^TEST$","source_topic":"input.eq"}
+        And the KafkaRouter has a rule of {"destination_topics":"BENELUX","jmespath":"country","regexp":"^BE$|^NL$|^LU$","source_topic":"input.eq"}
+        And the KafkaRouter has a rule of {"destination_topics":"SPAIN","jmespath":"country","regexp":"^(?:ES|AD)$","source_topic":"input.eq"}
+        And the KafkaRouter has a rule of {"destination_topics":"RAW","regexp":"^RAW$","source_topic":"input.eq"}
+        Then <candidates> rules are candidates for the message
+        And the first matching candidate is <destination_topics>
+
+        Examples:
+        | message_value       | status | candidates | destination_topics |
+        | {"country": "GB"}   | LIVE   | 1          | GB                 |
+        | {"country": "IE"}   | LIVE   | 2          | IE                 |
+        | {"country": "FR"}   | TEST   | 3          | EU                 |
+        | {"country": "DE"}   | LIVE   | 1          | EU                 |
+        | {"country": "GB\n"} | LIVE   | 1          | GB                 |
+        | {"country": "ES"}   | TEST   | 2          | TEST               |
+        | {"country": "NL"}   | LIVE   | 1          | BENELUX            |
+        | {"country": 44}     | LIVE   | 6          | None               |
+        | RAW                 | LIVE   | 7          | RAW                |
+
+    Scenario Outline: Whole Message Patterns Are Scanned Together
+        Given a KafkaRouter with DLQ topic "dlq_topic"
+        And a message with a value of <message_value>
+        And with message topic input.log
+        When append message header status with value LIVE
+        And the KafkaRouter has a rule of {"destination_topics":"ERROR","regexp":"\\bERROR\\b","source_topic":"input.log"}
+        And the KafkaRouter has a rule of {"destination_topics":"DISK","regexp":"WARN.*disk","source_topic":"input.log"}
+        And the KafkaRouter has a rule of {"destination_topics":"REPEAT","regexp":"(\\w)\\1{3}","source_topic":"input.log"}
+        And the KafkaRouter has a rule of {"destination_topics":"TEST","header":"status","header_regexp":"TEST","regexp":"WARN","source_topic":"input.log"}
+        And the KafkaRouter has a rule of {"destination_topics":"WARN","regexp":"(?i:warn)","source_topic":"input.log"}
+        Then <candidates> rules are candidates for the message
+        And the first matching candidate is <destination_topics>
+
+        Examples:
+        | message_value                    | candidates | destination_topics |
+        | INFO all is well                 | 1          | None               |
+        | INFO aaaa                        | 1          | REPEAT             |
+        | WARN low disk space              | 5          | DISK               |
+        | WARN low memory                  | 5          | WARN               |
+        | ERROR out of memory              | 5          | ERROR              |
+
+    Scenario: Rule Metrics Are Recorded With a Capped Rule Label
+        Given no rules in the OS environment
+        And OS environment KAFKA_ROUTER_PER_RULE_METRICS is true
+        And OS environment KAFKA_ROUTER_PER_RULE_METRICS_MAX_RULES is 2
+        And OS environment KAFKA_ROUTER_PER_RULE_METRICS_SAMPLE_RATE is 1
+        And a KafkaRouter with DLQ topic "dlq_topic"
+        And a message with a value of { "country": "IE" }
+        And with message topic input.metrics
+        When the KafkaRouter is in dry run mode
+        And the KafkaRouter has a rule named METRICS_GB of {"destination_topics":"GB","header":"status","header_regexp":"LIVE","jmespath":"country","regexp":"GB","source_topic":"input.metrics"}
+        And the KafkaRouter has a rule named METRICS_FR of {"destination_topics":"FR","jmespath":"country","regexp":"FR","source_topic":"input.metrics"}
+        And the KafkaRouter has a rule named METRICS_IE of {"destination_topics":"IE","jmespath":"country","regexp":"IE","source_topic":"input.metrics"}
+        And append message header status with value LIVE
+        And the message is matched by the KafkaRouter
+        Then the rule_evaluation_count_total metric for rule METRICS_GB is 1.0
+        And the rule_match_count_total metric for rule METRICS_GB is 0.0
+        And the rule_evaluation_count_total metric for rule other is 1.0
+        And the rule_match_count_total metric for rule other is 1.0
+        And the rule_check_time_seconds_count metric for rule METRICS_GB and stage header is 1.0
+        And the rule_check_time_seconds_count metric for rule METRICS_GB and stage regexp is 1.0
+        And the rule_check_time_seconds_count metric for rule METRICS_FR and stage data is 1.0
+        And the rule_check_time_seconds_count metric for rule METRICS_FR and stage header is 0.0
+
+    Scenario: Rule Metrics Count JSON Decode Errors
+        Given OS environment KAFKA_ROUTER_PER_RULE_METRICS is true
+        And OS environment KAFKA_ROUTER_PER_RULE_METRICS_SAMPLE_RATE is 0
+        And a KafkaRouter with DLQ topic "dlq_topic"
+        And a message with a value of Hello, world!
+        And with message topic input.metrics
+        When the KafkaRouter is in dry run mode
+        And the KafkaRouter has a rule named METRICS_JSON of {"destination_topics":"GB","jmespath":"country","regexp":"GB","source_topic":"input.metrics"}
+        And the message is matched by the KafkaRouter
+        Then the rule_json_decode_error_count_total metric for rule METRICS_JSON is 1.0
+        And the rule_check_time_seconds_count metric for rule METRICS_JSON and stage data is 0.0
+
+    Scenario: The Rule Schema Is Loaded Once From Beside the Module
+        Given the rule schema has not been loaded
+        And the working directory is not the root of the repository
+        When 3 rules are initialised
+        Then the rule schema validator was created once
 
     Scenario Outline: Rule Exceptions
         Given an Invalid Kafka Router Rule of <rule>
@@ -33,6 +176,11 @@ Feature: Kafka Router Rule
         Then the SystemExit is 2
 
         Examples:
-        | rule                            |
-        | Invalid JSON.                   |
-        | { "message": "Invalid schema" } |
+        | rule                                                                                                     |
+        | Invalid JSON.                                                                                            |
+        | { "message": "Invalid schema" }                                                                          |
+        | {"destination_topics":"output","regexp":"[A-Z","source_topic":"input"}                                   |
+        | {"destination_topics":"output","header":"status","header_regexp":"(TEST","source_topic":"input"}         |
+        | {"destination_topics":"output","jmespath":"country[","regexp":"^GB$","source_topic":"input"}             |
+        | {"bytes":true,"destination_topics":"output","jmespath":"country","regexp":"^GB$","source_topic":"input"} |
+        | {"bytes":"yes","destination_topics":"output","regexp":"^GB$","source_topic":"input"}                     |
@@ -23,6 +23,322 @@ Feature: The KafkaRouter class.
             | dlq_topic | rule                                                                                          | source_topic |
             | None      | {"destination_topics":"GB.output","jmespath":"country","regexp":"^GB$","source_topic":"input"} | input        |
 
+    Scenario Outline: Rules Are Indexed by Source Topic
+        Given a KafkaRouter with DLQ topic None
+        When rule {"destination_topics":"GB.output","jmespath":"country","regexp":"^GB$","source_topic":"input"} is added to the KafkaRouter
+        And rule {"destination_topics":"IE.output","jmespath":"country","regexp":"^IE$","source_topic":"input"} is added to the KafkaRouter
+        And rule {"destination_topics":"output","source_topic":"other"} is added to the KafkaRouter
+        Then KafkaRouter has <rule_count> rules for topic <topic>
+
+        Examples:
+            | topic   | rule_count |
+            | input   | 2          |
+            | other   | 1          |
+            | unknown | 0          |
+
+    Scenario: Topics Without Rules Share One Empty Rule Set
+        Given a KafkaRouter with DLQ topic None
+        When rule {"destination_topics":"output","source_topic":"other"} is added to the KafkaRouter
+        Then the KafkaRouter rules for topics unknown.a and unknown.b are the same empty list
+
+    Scenario: Pipelined Mode Commits Once All Copies Are Delivered
+        Given a pipelined KafkaRouter with a mock consumer and producer
+        When rule {"destination_topics":"a,b","source_topic":"pipelined"} is added to the KafkaRouter
+        And 3 messages on topic pipelined are processed
+        Then the committed offset for pipelined is None
+        When the producer delivers 1 messages
+        Then the committed offset for pipelined is None
+        When the producer delivers 1 messages
+        Then the committed offset for pipelined is 1
+        When the KafkaRouter is drained
+        Then the committed offset for pipelined is 3
+
+    Scenario: Pipelined Mode Does Not Commit Failed Deliveries
+        Given a pipelined KafkaRouter with a mock consumer and producer
+        When rule {"destination_topics":"a","source_topic":"pipelined"} is added to the KafkaRouter
+        And 4 messages on topic pipelined are processed
+        And the producer delivers 1 messages
+        Then the committed offset for pipelined is 1
+        When the producer fails to deliver 1 messages
+        And the producer delivers 1 messages
+        Then the committed offset for pipelined is 1
+        When the KafkaRouter is drained
+        Then the committed offset for pipelined is 1
+        And the KafkaRouter has no messages in flight
+
+    Scenario: A Failed Delivery Does Not Stop The Router In Pipelined Mode
+        Given a fake broker with 1 partitions
+        And a KafkaRouter with DLQ topic dlq
+        When rule {"destination_topics":"GB","source_topic":"fake"} is added to the KafkaRouter
+        And 5 messages on topic fake of the fake broker with every third country IE
+        And the KafkaRouter mode is pipelined
+        And the fake broker fails every delivery
+        And the KafkaRouter is run against the fake broker until it is idle
+        Then the fake broker has committed 0 messages on topic fake
+        And the KafkaRouter has no messages in flight
+
+    Scenario: Coalesced Commits
+        Given a KafkaRouter with a mock consumer and producer
+        When rule {"destination_topics":"a","source_topic":"coalesced"} is added to the KafkaRouter
+        And commits are coalesced every 2 messages
+        And 3 messages on topic coalesced are processed
+        Then the committed offset for coalesced is 2
+        When the asynchronous commits are reported
+        Then no commits are awaiting a report
+        When the partitions of coalesced are revoked
+        Then the committed offset for coalesced is 3
+
+    Scenario Outline: Batch Mode Processes and Commits Batches
+        Given a KafkaRouter with a mock consumer and producer
+        When rule {"destination_topics":"a","source_topic":"batched"} is added to the KafkaRouter
+        And the batch size is <batch_size>
+        And 7 messages on topic batched are waiting to be consumed
+        And the KafkaRouter consumes and processes the messages
+        Then <batch_size> messages have been delivered
+        And the committed offset for batched is <batch_size>
+
+        Examples:
+            | batch_size |
+            | 1          |
+            | 5          |
+
+    Scenario: Concurrent Mode Preserves the Order of Each Key
+        Given a KafkaRouter with a mock consumer and producer
+        When rule {"destination_topics":"a","source_topic":"concurrent"} is added to the KafkaRouter
+        And the concurrency is 4
+        And the batch size is 50
+        And 50 messages with 7 keys on topic concurrent are waiting to be consumed
+        And the KafkaRouter consumes and processes the messages
+        And the KafkaRouter is drained
+        Then 50 messages have been delivered
+        And the messages for each key have been delivered in order
+        And the committed offset for concurrent is 50
+
+    Scenario Outline: The Router Loop Runs Against a Fake Broker
+        Given a fake broker with 3 partitions
+        And a KafkaRouter with DLQ topic dlq
+        When rule {"destination_topics":"GB","jmespath":"country","regexp":"^GB$","source_topic":"fake"} is added to the KafkaRouter
+        And 60 messages on topic fake of the fake broker with every third country IE
+        And the KafkaRouter mode is <mode>
+        And the KafkaRouter is run against the fake broker until it is idle
+        Then the fake broker has 40 messages on topic GB
+        And the fake broker has 20 messages on topic dlq
+        And the fake broker has committed 60 messages on topic fake
+
+        Examples:
+            | mode        |
+            | default     |
+            | pipelined   |
+            | batched     |
+            | coalesced   |
+            | concurrent  |
+            | dlq-batched |
+
+    Scenario: The Processing Time Of Each Message Is Observed
+        Given a fake broker with 2 partitions
+        And a KafkaRouter with DLQ topic dlq
+        When rule {"destination_topics":"GB","jmespath":"country","regexp":"^GB$","source_topic":"fake"} is added to the KafkaRouter
+        And 30 messages on topic fake of the fake broker with every third country IE
+        And the processing_time_seconds_count metric is sampled
+        And the KafkaRouter is run against the fake broker until it is idle
+        Then the fake broker has committed 30 messages on topic fake
+        And the processing_time_seconds_count metric has increased by 30
+
+    Scenario: The End Of A Partition Is Not Committed In Concurrent Mode
+        Given a fake broker with 3 partitions
+        And a KafkaRouter with DLQ topic dlq
+        When rule {"destination_topics":"GB","jmespath":"country","regexp":"^GB$","source_topic":"fake"} is added to the KafkaRouter
+        And 60 messages on topic fake of the fake broker with every third country IE
+        And the KafkaRouter mode is concurrent
+        And the consumer reports the end of each partition
+        And the KafkaRouter is run against the fake broker until it is idle
+        Then the fake broker has 40 messages on topic GB
+        And the fake broker has 20 messages on topic dlq
+        And the fake broker has committed 60 messages on topic fake
+
+    Scenario: Every Stack Trace Is Formatted In Full By Default
+        Given a fake broker with 1 partitions
+        And a KafkaRouter with DLQ topic dlq
+        When rule {"destination_topics":"GB","jmespath":"country","regexp":"^GB$","source_topic":"fake"} is added to the KafkaRouter
+        And 5 messages on topic fake of the fake broker with invalid JSON
+        And the KafkaRouter is run against the fake broker until it is idle
+        Then the fake broker has 5 messages on topic dlq
+        And 5 messages on topic dlq of the fake broker have a full stack trace
+        And the messages on topic dlq of the fake broker have no stack trace reference
+
+    Scenario: A Storm Of Invalid JSON Is Flushed To The DLQ In Batches
+        Given a fake broker with 2 partitions
+        And a KafkaRouter with DLQ topic dlq
+        When rule {"destination_topics":"GB","jmespath":"country","regexp":"^GB$","source_topic":"fake"} is added to the KafkaRouter
+        And 25 messages on topic fake of the fake broker with invalid JSON
+        And the DLQ batch size is 10 and stack traces are sampled every 10
+        And the KafkaRouter is run against the fake broker until it is idle
+        Then the fake broker has 25 messages on topic dlq
+        And 3 messages on topic dlq of the fake broker have a full stack trace
+        And the messages on topic dlq of the fake broker have the same stack trace reference
+        And the fake broker has committed 25 messages on topic fake
+        And the KafkaRouter producer has been flushed 3 times
+
+    Scenario: The Source Partitions Are Paused Under Producer Backpressure
+        Given a fake broker with 2 partitions and 5ms of latency
+        And a KafkaRouter with DLQ topic dlq
+        When rule {"destination_topics":"GB","jmespath":"country","regexp":"^GB$","source_topic":"fake"} is added to the KafkaRouter
+        And 60 messages on topic fake of the fake broker with every third country IE
+        And the KafkaRouter mode is pipelined
+        And the producer backpressure limit is 8 messages
+        And the KafkaRouter is run against the fake broker until it is idle
+        Then the fake broker has 40 messages on topic GB
+        And the fake broker has 20 messages on topic dlq
+        And the fake broker has committed 60 messages on topic fake
+        And the KafkaRouter producer has had at most 8 messages in flight
+        And the producer_backpressure_pause_count_total metric is more than 0
+        And the producer_backpressure_paused metric is 0
+
+    Scenario: Delivery Reports Are Served When The Producer Queue Is Full
+        Given a fake broker with 1 partitions and 5ms of latency
+        And a KafkaRouter with DLQ topic dlq
+        When rule {"destination_topics":"GB","jmespath":"country","regexp":"^GB$","source_topic":"fake"} is added to the KafkaRouter
+        And 30 messages on topic fake of the fake broker with every third country IE
+        And the KafkaRouter mode is batched
+        And the producer queue holds 3 messages
+        And the KafkaRouter is run against the fake broker until it is idle
+        Then the fake broker has 20 messages on topic GB
+        And the fake broker has 10 messages on topic dlq
+        And the fake broker has committed 30 messages on topic fake
+        And the KafkaRouter producer has had at most 3 messages in flight
+        And the producer_buffer_full_count_total metric is more than 0
+
+    Scenario: The Router Loop Stops When a Delivery Fails
+        Given a fake broker with 1 partitions
+        And a KafkaRouter with DLQ topic dlq
+        When rule {"destination_topics":"GB","source_topic":"fake"} is added to the KafkaRouter
+        And 5 messages on topic fake of the fake broker with every third country IE
+        And the fake broker fails every delivery
+        Then running the KafkaRouter against the fake broker raises a KafkaException
+        And the fake broker has committed 0 messages on topic fake
+
+    Scenario: Rules Are Loaded in Bulk From a JSON Lines File
+        Given a JSON Lines rules file with 500 rules for topic bulk
+        And a KafkaRouter with a mock consumer and producer
+        Then KafkaRouter has 500 rules for topic bulk
+        And the rule_count metric is 500
+        And the rule_load_time_seconds metric is more than 0
+
+    Scenario Outline: Rules Are Reloaded Without Restarting the Consumer
+        Given a rules <kind> with rule GB {"destination_topics":"GB","source_topic":"reload.a"}
+        And a KafkaRouter with a mock consumer and producer
+        When the rules <kind> is updated with rule IE {"destination_topics":"IE","source_topic":"reload.b"}
+        And the KafkaRouter reloads the rules
+        Then KafkaRouter has 1 rules for topic reload.a
+        When the reloaded rules are swapped in
+        Then KafkaRouter has 0 rules for topic reload.a
+        And KafkaRouter has 1 rules for topic reload.b
+        And the consumer has been re-subscribed to reload.b
+
+        Examples:
+            | kind      |
+            | file      |
+            | directory |
+
+    Scenario Outline: An Invalid Rules Update Leaves the Running Rules Untouched
+        Given a rules <kind> with rule GB {"destination_topics":"GB","source_topic":"reload.a"}
+        And a KafkaRouter with a mock consumer and producer
+        When the rules <kind> is updated with rule IE <rule>
+        And the KafkaRouter reloads the rules
+        And the reloaded rules are swapped in
+        Then KafkaRouter has 1 rules for topic reload.a
+        And KafkaRouter has 0 rules for topic reload.b
+        And the consumer has not been re-subscribed
+
+        Examples:
+            | kind      | rule                                                                 |
+            | file      | {"source_topic":"reload.b"}                                          |
+            | file      | {"destination_topics":"IE",                                          |
+            | directory | {"destination_topics":"IE","regexp":"(","source_topic":"reload.b"} |
+
+    Scenario: Reloaded Rules Are Compiled Before They Are Swapped In
+        Given a rules file with rule GB {"destination_topics":"GB","source_topic":"reload.a"}
+        And a KafkaRouter with a mock consumer and producer
+        When the rules file is updated with rule IE {"destination_topics":"IE","regexp":"IE","source_topic":"reload.b"}
+        And rule FR {"destination_topics":"FR","regexp":"FR","source_topic":"reload.b"} is added to the rules file
+        And the KafkaRouter reloads the rules
+        Then the reloaded rules for topic reload.b have a combined pattern
+
+    Scenario: The Rule Watcher Reloads a Changed Rules File
+        Given a rules file with rule GB {"destination_topics":"GB","source_topic":"reload.a"}
+        And a KafkaRouter with a mock consumer and producer
+        When the rule watcher is started
+        And the rules file is updated with rule IE {"destination_topics":"IE","source_topic":"reload.b"}
+        Then reloaded rules are waiting to be swapped in
+
+    Scenario: SIGHUP Requests a Reload of the Rules
+        Given a rules file with rule GB {"destination_topics":"GB","source_topic":"reload.a"}
+        And a KafkaRouter with a mock consumer and producer
+        When System Signal SIGHUP is sent to the KafkaRouter
+        Then a reload of the rules has been requested
+
+    Scenario: SIGHUP Is Not Handled Without A Rules Path
+        Given a KafkaRouter with a mock consumer and producer
+        Then the KafkaRouter does not handle SIGHUP
+
+    Scenario Outline: Dependencies Are Only Imported When They Are Used
+        Given a KafkaRouter is created in a new interpreter with rule <rule>
+        Then the module <module> has been imported is <is_imported>
+
+        Examples:
+            | rule                                                                                  | module             | is_imported |
+            | {"destination_topics":"a","header":"h","header_regexp":"^x$","source_topic":"input"}  | jmespath           | False       |
+            | {"destination_topics":"a","jmespath":"country","regexp":"^x$","source_topic":"input"} | jmespath           | True        |
+            | {"destination_topics":"a","header":"h","header_regexp":"^x$","source_topic":"input"}  | sentry_sdk         | False       |
+            | {"destination_topics":"a","header":"h","header_regexp":"^x$","source_topic":"input"}  | multiprocessing    | False       |
+            | {"destination_topics":"a","header":"h","header_regexp":"^x$","source_topic":"input"}  | concurrent.futures | False       |
+            | {"destination_topics":"a","header":"h","header_regexp":"^x$","source_topic":"input"}  | argparse           | False       |
+
+    Scenario: Prometheus Is Not Imported When It Is Disabled
+        Given OS environment KAFKA_ROUTER_PROMETHEUS_DISABLED is True
+        And a KafkaRouter is created in a new interpreter with rule {"destination_topics":"a","header":"h","header_regexp":"^x$","source_topic":"input"}
+        Then the module prometheus_client has been imported is False
+
+    Scenario Outline: Dependencies Are Not Imported With The Module
+        Given the router module is imported in a new interpreter
+        Then the module <module> has been imported is <is_imported>
+
+        Examples:
+            | module            | is_imported |
+            | prometheus_client | False       |
+
+    Scenario Outline: A DLQ Replay Stops Once It Has Been Replayed
+        Given a fake broker with 1 partitions
+        And a KafkaRouter with DLQ topic dlq
+        When rule {"destination_topics":"GB","jmespath":"country","regexp":"^GB$","source_topic":"fake"} is added to the KafkaRouter
+        And 60 messages on topic fake of the fake broker with every third country IE
+        And the KafkaRouter is in DLQ mode with a replay of <bounds>
+        And the KafkaRouter replays the fake broker
+        Then the fake broker has <gb_count> messages on topic GB
+        And the fake broker has <dlq_count> messages on topic dlq
+        And the replay stopped without waiting for the timeout
+
+        Examples:
+            | bounds                    | gb_count | dlq_count |
+            | everything                | 40       | 20        |
+            | offsets 10 to 30          | 13       | 7         |
+            | timestamps 10000 to 30000 | 13       | 7         |
+            | offsets 10 to 1000        | 33       | 17        |
+            | offsets 70 to 80          | 0        | 0         |
+
+    Scenario: A DLQ Replay Seeks To The Offsets In The DLQ Index
+        Given a fake broker with 1 partitions
+        And a KafkaRouter with DLQ topic dlq
+        When 4500 DLQ messages on topic fake of the fake broker with every 1500th from topic orders
+        And the DLQ index of topic fake of the fake broker is built
+        And rule {"destination_topics":"orders","header":"__router.topic","header_regexp":"^orders$","source_topic":"fake"} is added to the KafkaRouter
+        And the KafkaRouter is in DLQ mode with the DLQ index
+        And the KafkaRouter replays the fake broker
+        Then the fake broker has 3 messages on topic orders
+        And the fake broker has 0 messages on topic dlq
+        And the KafkaRouter consumer has seeked 2 times
+        And the replay stopped without waiting for the timeout
+
     Scenario Outline: DLQ ID
         Given a KafkaRouter with DLQ topic <dlq_topic>
         When OS environment KAFKA_ROUTER_DLQ_ID is <kafka_router_dlq_id>
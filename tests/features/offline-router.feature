@@ -0,0 +1,56 @@
+Feature: Offline Router
+    In order to test a rule set against captured messages without a broker
+    As a developer
+    I want to route messages from local files and count where they go.
+
+    Scenario Outline: Route A File Of Messages Offline
+        Given a rule {"destination_topics":"GB","jmespath":"country","regexp":"^GB$","source_topic":"input"}
+        And a <file_format> file of 300 messages on topic input with every third country IE
+        When the file is routed offline with <processes> processes and chunks of <chunk_size> bytes
+        Then 200 messages have been routed to GB
+        And 100 messages have been routed to dlq
+
+        Examples:
+            | file_format | processes | chunk_size |
+            | jsonl       | 1         | 67108864   |
+            | jsonl       | 1         | 1000       |
+            | jsonl       | 2         | 1000       |
+            | bin         | 1         | 1000       |
+            | bin         | 2         | 1000       |
+
+    Scenario Outline: Files Are Routed Offline In The Default Mode
+        Given a rule {"destination_topics":"GB","jmespath":"country","regexp":"^GB$","source_topic":"input"}
+        And the environment variable <name> is set to <value>
+        And a jsonl file of 300 messages on topic input with every third country IE
+        When the file is routed offline with 1 processes and chunks of 1000 bytes
+        Then 200 messages have been routed to GB
+        And 100 messages have been routed to dlq
+        And the offline worker router is in the default mode with nothing in flight
+
+        Examples:
+            | name                            | value |
+            | KAFKA_ROUTER_BATCH_SIZE         | 50    |
+            | KAFKA_ROUTER_COMMIT_COUNT       | 50    |
+            | KAFKA_ROUTER_COMMIT_INTERVAL_MS | 1000  |
+            | KAFKA_ROUTER_CONCURRENCY        | 4     |
+            | KAFKA_ROUTER_DLQ_BATCH_SIZE     | 50    |
+            | KAFKA_ROUTER_PIPELINED_MODE     | True  |
+
+    Scenario Outline: Routed Messages Are Written To The Output Directory
+        Given a rule {"destination_topics":"GB","jmespath":"country","regexp":"^GB$","source_topic":"input"}
+        And a <file_format> file of 300 messages on topic input with every third country IE
+        When the file is routed offline to an output directory
+        Then the output directory has 200 messages on topic GB
+        And the output directory has 100 messages on topic dlq with the header __router.message
+
+        Examples:
+            | file_format |
+            | jsonl       |
+            | bin         |
+
+    Scenario: Route Files Offline From The Command Line
+        Given a rule {"destination_topics":"GB","jmespath":"country","regexp":"^GB$","source_topic":"input"}
+        And a jsonl file of 300 messages on topic input with every third country IE
+        When router.py offline is run on the file
+        Then the output is GB 200 and dlq 100
+        And no signal was caught by the workers
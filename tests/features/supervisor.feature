@@ -0,0 +1,50 @@
+Feature: Supervisor
+    In order to use more than one core
+    As a Kafka Router
+    I want to run supervised worker processes
+
+    Scenario: A Failed Worker Is Restarted With Backoff
+        Given a Supervisor with 1 worker and a backoff of 1000ms
+        When the workers are checked
+        Then worker 0 is running
+        When worker 0 exits with 1
+        And the workers are checked
+        Then worker 0 is not running
+        And worker 0 is restarted in 1000ms
+        When the workers are checked
+        Then worker 0 is not running
+        When the backoff of worker 0 has passed
+        And the workers are checked
+        Then worker 0 is running
+        When worker 0 exits with 1
+        And the workers are checked
+        Then worker 0 is restarted in 2000ms
+
+    Scenario: A Worker That Finishes Is Not Restarted
+        Given a Supervisor with 2 worker and a backoff of 1000ms
+        When the workers are checked
+        And worker 1 exits with 0
+        And the workers are checked
+        And the workers are checked
+        Then worker 0 is running
+        And worker 1 is not running
+        And 1 worker has finished
+
+    Scenario: Stopping the Supervisor Stops the Workers
+        Given a Supervisor with 2 worker and a backoff of 1000ms
+        When the workers are checked
+        And the workers are stopped
+        Then all workers have been terminated
+
+    Scenario: A Metrics Directory Created By The Supervisor Is Removed
+        Given a Supervisor with 1 worker and its own metrics directory
+        When the workers are checked
+        And the workers are stopped
+        Then the metrics directory of the Supervisor has been removed
+
+    Scenario: Stale Metric Files Are Removed From A Configured Metrics Directory
+        Given a metrics directory with the files counter_1001.db and README
+        And a Supervisor with 1 worker and a backoff of 1000ms
+        When the workers are checked
+        And the workers are stopped
+        Then the metrics directory only has the file README
@@ -0,0 +1,827 @@
+"""
+An in-memory stand-in for a Kafka broker.
+
+Provides consumers and producers that are compatible with the parts of the
+Confluent Kafka client used by the router, so that the whole router loop
+(poll, produce, delivery report and commit) can be run with no network.
+Pass the broker's consumer and producer methods to KafkaRouter.router as the
+client factories.
+"""
+import random
+import threading
+import time
+import zlib
+
+from confluent_kafka import (OFFSET_INVALID, TIMESTAMP_CREATE_TIME, KafkaError,
+                             TopicPartition)
+
+
+class FakeMessage:
+    """
+    Provide an API that is compatible with the Confluent Kafka Message.
+
+    Parameters
+    ----------
+    topic : str
+        The topic name.
+    partition : int
+        The partition number.
+    offset : int
+        The offset of the message in the partition.
+    key : bytes
+        The key of the message.
+    value : bytes
+        The value of the message.
+    headers : list
+        A list of (key, value) tuples.
+    timestamp : int
+        The creation time of the message in milliseconds since the epoch.
+    error : KafkaError, optional
+        The error of the message (e.g. the end of a partition), by default None
+    """
+
+    def __init__(self, topic: str, partition: int, offset: int, key: bytes, value: bytes, headers: list,
+                 timestamp: int, error: KafkaError = None) -> None:
+        self._error = error
+        self._headers = headers
+        self._key = key
+        self._offset = offset
+        self._partition = partition
+        self._timestamp = timestamp
+        self._topic = topic
+        self._value = value
+
+    def error(self) -> KafkaError:
+        """Get the error of the message (None unless it is an event such as the end of a partition)."""
+        return self._error
+
+    def headers(self) -> list:
+        """Get the headers of the message."""
+        return self._headers
+
+    def key(self) -> bytes:
+        """Get the key of the message."""
+        return self._key
+
+    def offset(self) -> int:
+        """Get the offset of the message."""
+        return self._offset
+
+    def partition(self) -> int:
+        """Get the partition of the message."""
+        return self._partition
+
+    def timestamp(self) -> tuple:
+        """Get the timestamp type and the timestamp of the message."""
+        return TIMESTAMP_CREATE_TIME, self._timestamp
+
+    def topic(self) -> str:
+        """Get the topic of the message."""
+        return self._topic
+
+    def value(self) -> bytes:
+        """Get the value of the message."""
+        return self._value
+
+
+class FakeBroker:
+    """
+    Hold topics, partitions and committed offsets in memory.
+
+    Parameters
+    ----------
+    partitions : int, optional
+        The number of partitions of each topic, by default 1
+    latency_ms : float, optional
+        How long a produced message takes to be delivered, by default 0
+    failure_rate : float, optional
+        The fraction of produced messages that fail to be delivered, by
+        default 0
+    seed : int, optional
+        The seed for choosing which deliveries fail, by default None
+    idle_callback : callable, optional
+        Called (with the broker) when a consumer polls and there are no
+        messages to consume, by default None
+    """
+
+    def __init__(self, partitions: int = 1, latency_ms: float = 0, failure_rate: float = 0, seed: int = None,
+                 idle_callback: callable = None) -> None:
+        self._lock = threading.RLock()
+        self._random = random.Random(seed)
+        self.committed = {}
+        self.failure_rate = failure_rate
+        self.idle_callback = idle_callback
+        self.latency_ms = latency_ms
+        self.partitions = partitions
+        self.topics = {}
+
+    def append(self, topic: str, value: bytes, key: bytes = None, headers: list = None,
+               partition: int = None, timestamp: int = None) -> FakeMessage:
+        """
+        Append a message to a topic.
+
+        Parameters
+        ----------
+        topic : str
+            The topic name.
+        value : bytes
+            The value of the message.
+        key : bytes, optional
+            The key of the message, by default None
+        headers : list, optional
+            The headers of the message, by default None
+        partition : int, optional
+            The partition to append to.  By default, chosen from a hash of
+            the key (or at random if there is no key).
+        timestamp : int, optional
+            The creation time of the message in milliseconds since the epoch,
+            by default now.
+
+        Returns
+        -------
+        FakeMessage
+            The message as stored on the topic.
+        """
+        with self._lock:
+            if partition is None:
+                partition = self.get_partition(key)
+
+            if timestamp is None:
+                timestamp = int(time.time() * 1000)
+
+            log = self.get_partitions(topic)[partition]
+            message = FakeMessage(topic, partition, len(log), key, value, list(headers or []), timestamp)
+            log.append(message)
+            return message
+
+    def commit(self, group: str, offsets: list) -> None:
+        """
+        Commit offsets for a consumer group.
+
+        Parameters
+        ----------
+        group : str
+            The consumer group ID.
+        offsets : list
+            The TopicPartition objects to be committed.
+        """
+        with self._lock:
+            for offset in offsets:
+                self.committed[(group, offset.topic, offset.partition)] = offset.offset
+
+    def committed_offset(self, group: str, topic: str, partition: int = 0) -> int:
+        """
+        Get the offset committed by a consumer group for a partition.
+
+        Parameters
+        ----------
+        group : str
+            The consumer group ID.
+        topic : str
+            The topic name.
+        partition : int, optional
+            The partition number, by default 0
+
+        Returns
+        -------
+        int
+            The committed offset or None if nothing has been committed.
+        """
+        return self.committed.get((group, topic, partition))
+
+    def consumer(self, config: dict) -> 'FakeConsumer':
+        """
+        Create a consumer (a client factory for KafkaRouter.router).
+
+        Parameters
+        ----------
+        config : dict
+            The consumer config.
+
+        Returns
+        -------
+        FakeConsumer
+            The consumer.
+        """
+        return FakeConsumer(self, config)
+
+    def fails(self) -> bool:
+        """
+        Decide if the delivery of a produced message fails.
+
+        Returns
+        -------
+        bool
+            True if the delivery is to fail.
+        """
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+    def get_partition(self, key: bytes) -> int:
+        """
+        Choose a partition for a message.
+
+        Parameters
+        ----------
+        key : bytes
+            The key of the message.  Can be None.
+
+        Returns
+        -------
+        int
+            The partition number.
+        """
+        if key is None:
+            return self._random.randrange(self.partitions)
+
+        return zlib.crc32(key) % self.partitions
+
+    def get_partitions(self, topic: str) -> list:
+        """
+        Get the partitions of a topic, creating the topic if required.
+
+        Parameters
+        ----------
+        topic : str
+            The topic name.
+
+        Returns
+        -------
+        list
+            A list of messages for each partition.
+        """
+        with self._lock:
+            return self.topics.setdefault(topic, [[] for _ in range(self.partitions)])
+
+    def messages(self, topic: str) -> list:
+        """
+        Get all the messages on a topic.
+
+        Parameters
+        ----------
+        topic : str
+            The topic name.
+
+        Returns
+        -------
+        list
+            The messages in partition order.
+        """
+        return [message for log in self.get_partitions(topic) for message in log]
+
+    def producer(self, config: dict) -> 'FakeProducer':
+        """
+        Create a producer (a client factory for KafkaRouter.router).
+
+        Parameters
+        ----------
+        config : dict
+            The producer config.
+
+        Returns
+        -------
+        FakeProducer
+            The producer.
+        """
+        return FakeProducer(self, config)
+
+
+class FakeConsumer:
+    """
+    Provide an API that is compatible with the Confluent Kafka Consumer.
+
+    Consumption starts from the offsets committed for the group (or the
+    start of each partition).  Every partition of the subscribed topics is
+    assigned (to any on_assign callback) when the consumer is first polled.
+    Asynchronous commits are reported to any on_commit callback in the config
+    when the consumer is next polled.  If enable.partition.eof is set in the
+    config, a message with a _PARTITION_EOF error is returned each time a
+    partition has been consumed up to its end.
+
+    Parameters
+    ----------
+    broker : FakeBroker
+        The broker to consume from.
+    config : dict
+        The consumer config.
+    """
+
+    def __init__(self, broker: FakeBroker, config: dict) -> None:
+        self.assigned = False
+        self.broker = broker
+        self.eof_offsets = {}
+        self.group = config.get('group.id')
+        self.on_assign = None
+        self.on_commit = config.get('on_commit')
+        self.partition_eof = str(config.get('enable.partition.eof', False)).lower() == 'true'
+        self.paused = set()
+        self.pending_reports = []
+        self.positions = {}
+        self.seeks = []
+        self.topics = []
+
+    def assign(self, partitions: list) -> None:
+        """
+        Assign partitions, starting from their offsets (if valid).
+
+        Parameters
+        ----------
+        partitions : list
+            The TopicPartition objects.
+        """
+        for partition in partitions:
+            if partition.offset != OFFSET_INVALID:
+                self.positions[(partition.topic, partition.partition)] = partition.offset
+
+    def assignment(self) -> list:
+        """
+        Get the assigned partitions.
+
+        Returns
+        -------
+        list
+            TopicPartition objects for every partition of the subscribed
+            topics (once they have been assigned).
+        """
+        return [TopicPartition(topic, partition, OFFSET_INVALID) for topic, partition, _ in self.get_partitions()
+                if self.assigned]
+
+    def close(self) -> None:
+        """Close the consumer."""
+        self.serve_commit_reports()
+
+    def commit(self, message: FakeMessage = None, offsets: list = None, asynchronous: bool = True) -> list:
+        """
+        Commit offsets.
+
+        Parameters
+        ----------
+        message : FakeMessage, optional
+            Commit the offset after this message, by default None
+        offsets : list, optional
+            A list of TopicPartition objects to be committed, by default None
+        asynchronous : bool, optional
+            If True, report the commit to on_commit when next polled, by
+            default True
+
+        Returns
+        -------
+        list
+            The committed offsets (if synchronous).
+        """
+        if message is not None:
+            offsets = [TopicPartition(message.topic(), message.partition(), message.offset() + 1)]
+
+        self.broker.commit(self.group, offsets)
+
+        if asynchronous and self.on_commit is not None:
+            self.pending_reports.append(offsets)
+
+        return None if asynchronous else offsets
+
+    def consume(self, num_messages: int = 1, timeout: float = -1) -> list:
+        """
+        Consume a batch of messages.
+
+        Parameters
+        ----------
+        num_messages : int, optional
+            The maximum number of messages to return, by default 1
+        timeout : float, optional
+            Ignored, by default -1
+
+        Returns
+        -------
+        list
+            The messages consumed (from each partition in turn).
+        """
+        self.serve_commit_reports()
+        self.serve_assignment()
+        messages = []
+
+        for topic, partition, log in self.get_active_partitions():
+            position = self.get_position(topic, partition)
+            batch = log[position:position + num_messages - len(messages)]
+            self.positions[(topic, partition)] = position + len(batch)
+            messages.extend(batch)
+            messages.extend(self.get_eof(topic, partition, len(log), num_messages - len(messages)))
+
+        if not (messages or self.has_paused_backlog()) and self.broker.idle_callback is not None:
+            self.broker.idle_callback(self.broker)
+
+        return messages
+
+    def get_active_partitions(self) -> list:
+        """
+        Get the partitions of the subscribed topics that have not been paused.
+
+        Returns
+        -------
+        list
+            A list of (topic, partition, messages) tuples.
+        """
+        return [(topic, partition, log) for topic, partition, log in self.get_partitions()
+                if (topic, partition) not in self.paused]
+
+    def get_eof(self, topic: str, partition: int, end: int, room: int) -> list:
+        """
+        Get the end of partition event of a partition (if it is due).
+
+        Parameters
+        ----------
+        topic : str
+            The topic name.
+        partition : int
+            The partition number.
+        end : int
+            The offset after the last message of the partition.
+        room : int
+            How many more messages can be returned.
+
+        Returns
+        -------
+        list
+            A message with a _PARTITION_EOF error if enable.partition.eof is
+            set, the partition has been consumed up to its end and that has not
+            already been reported.  Otherwise an empty list.
+        """
+        key = (topic, partition)
+
+        if not self.partition_eof or room < 1 or self.positions[key] < end or self.eof_offsets.get(key) == end:
+            return []
+
+        self.eof_offsets[key] = end
+        return [FakeMessage(topic, partition, end, None, None, [], 0, KafkaError(KafkaError._PARTITION_EOF))]
+
+    def get_partitions(self) -> list:
+        """
+        Get the partitions of the subscribed topics.
+
+        Returns
+        -------
+        list
+            A list of (topic, partition, messages) tuples.
+        """
+        return [(topic, partition, log)
+                for topic in self.topics for partition, log in enumerate(self.broker.get_partitions(topic))]
+
+    def get_position(self, topic: str, partition: int) -> int:
+        """
+        Get the offset of the next message to be consumed from a partition.
+
+        Parameters
+        ----------
+        topic : str
+            The topic name.
+        partition : int
+            The partition number.
+
+        Returns
+        -------
+        int
+            The offset.
+        """
+        if (topic, partition) not in self.positions:
+            committed = self.broker.committed_offset(self.group, topic, partition)
+            self.positions[(topic, partition)] = committed or 0
+
+        return self.positions[(topic, partition)]
+
+    def get_watermark_offsets(self, partition: TopicPartition, timeout: float = None, cached: bool = False) -> tuple:
+        """
+        Get the low and high watermarks of a partition.
+
+        Parameters
+        ----------
+        partition : TopicPartition
+            The partition.
+        timeout : float, optional
+            Ignored, by default None
+        cached : bool, optional
+            Ignored, by default False
+
+        Returns
+        -------
+        tuple
+            The low and high watermarks.
+        """
+        return 0, len(self.broker.get_partitions(partition.topic)[partition.partition])
+
+    def offsets_for_times(self, partitions: list, timeout: float = None) -> list:
+        """
+        Get the offset of the first message at or after a time in each partition.
+
+        Parameters
+        ----------
+        partitions : list
+            TopicPartition objects with the times (in milliseconds since the
+            epoch) as their offsets.
+        timeout : float, optional
+            Ignored, by default None
+
+        Returns
+        -------
+        list
+            TopicPartition objects with the offsets (-1 if there is no such
+            message).
+        """
+        offsets = []
+
+        for partition in partitions:
+            log = self.broker.get_partitions(partition.topic)[partition.partition]
+            found = [message.offset() for message in log if message.timestamp()[1] >= partition.offset]
+            offsets.append(TopicPartition(partition.topic, partition.partition, found[0] if found else -1))
+
+        return offsets
+
+    def has_paused_backlog(self) -> bool:
+        """
+        Check if there are messages left to consume on partitions that have been paused.
+
+        Returns
+        -------
+        bool
+            True if a partition has been paused with messages left to consume.
+        """
+        return any(self.get_position(topic, partition) < len(log) for topic, partition, log in self.get_partitions()
+                   if (topic, partition) in self.paused)
+
+    def pause(self, partitions: list) -> None:
+        """
+        Stop consuming from partitions.
+
+        Parameters
+        ----------
+        partitions : list
+            The TopicPartition objects.
+        """
+        self.paused.update((partition.topic, partition.partition) for partition in partitions)
+
+    def poll(self, timeout: float = None) -> FakeMessage:
+        """
+        Consume a message.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Ignored, by default None
+
+        Returns
+        -------
+        FakeMessage
+            The message consumed or None if there are no messages.
+        """
+        messages = self.consume()
+        return messages[0] if messages else None
+
+    def position(self, partitions: list) -> list:
+        """
+        Get the offsets of the next messages to be consumed.
+
+        Parameters
+        ----------
+        partitions : list
+            The TopicPartition objects.
+
+        Returns
+        -------
+        list
+            TopicPartition objects with the offsets.
+        """
+        return [TopicPartition(partition.topic, partition.partition,
+                               self.get_position(partition.topic, partition.partition))
+                for partition in partitions]
+
+    def resume(self, partitions: list) -> None:
+        """
+        Resume consuming from partitions.
+
+        Parameters
+        ----------
+        partitions : list
+            The TopicPartition objects.
+        """
+        self.paused.difference_update((partition.topic, partition.partition) for partition in partitions)
+
+    def seek(self, partition: TopicPartition) -> None:
+        """
+        Move the position of a partition to an offset.
+
+        Parameters
+        ----------
+        partition : TopicPartition
+            The partition and the offset of the next message to consume.
+        """
+        self.seeks.append(partition)
+        self.positions[(partition.topic, partition.partition)] = partition.offset
+
+    def serve_assignment(self) -> None:
+        """Assign every partition of the subscribed topics (once)."""
+        if self.assigned:
+            return
+
+        self.assigned = True
+        partitions = [TopicPartition(topic, partition)
+                      for topic in self.topics for partition in range(len(self.broker.get_partitions(topic)))]
+
+        if self.on_assign is not None:
+            self.on_assign(self, partitions)
+
+    def serve_commit_reports(self) -> None:
+        """Report asynchronous commits to the on_commit callback."""
+        reports, self.pending_reports = self.pending_reports, []
+
+        for offsets in reports:
+            self.on_commit(None, offsets)
+
+    def subscribe(self, topics: list, on_assign: callable = None, on_revoke: callable = None) -> None:
+        """
+        Subscribe to topics.
+
+        Parameters
+        ----------
+        topics : list
+            The topic names.
+        on_assign : callable, optional
+            Called with the partitions when they are assigned, by default None
+        on_revoke : callable, optional
+            Ignored, by default None
+        """
+        self.on_assign = on_assign
+        self.topics = list(topics)
+
+
+class FakeProducer:
+    """
+    Provide an API that is compatible with the Confluent Kafka Producer.
+
+    Messages are delivered (or fail) once the broker latency has passed and
+    the producer is polled or flushed.  Like the real producer, it can be
+    used from more than one thread and produce raises BufferError once
+    queue.buffering.max.messages are in flight.
+
+    Parameters
+    ----------
+    broker : FakeBroker
+        The broker to produce to.
+    config : dict
+        The producer config.
+    """
+
+    def __init__(self, broker: FakeBroker, config: dict) -> None:
+        self._lock = threading.RLock()
+        self.broker = broker
+        self.flushes = 0
+        self.in_flight = []
+        self.max_in_flight = 0
+        self.queue_limit = int(config.get('queue.buffering.max.messages', 100000))
+
+    def __len__(self) -> int:
+        """Get the number of messages awaiting delivery."""
+        return len(self.in_flight)
+
+    def deliver(self, due: float) -> int:
+        """
+        Deliver the messages that are due.
+
+        Parameters
+        ----------
+        due : float
+            Deliver the messages that were due before this time.
+
+        Returns
+        -------
+        int
+            The number of delivery reports served.
+        """
+        with self._lock:
+            count = 0
+
+            while self.in_flight and self.in_flight[0][0] <= due:
+                _, topic, value, key, headers, callback = self.in_flight.pop(0)
+                self.report(topic, value, key, headers, callback)
+                count += 1
+
+            return count
+
+    def encode(self, value: object) -> bytes:
+        """
+        Encode a header value as the real producer does.
+
+        Parameters
+        ----------
+        value : object
+            The header value (bytes or str).
+
+        Returns
+        -------
+        bytes
+            The encoded value.
+        """
+        return value.encode() if isinstance(value, str) else value
+
+    def flush(self, timeout: float = None) -> int:
+        """
+        Wait for all messages to be delivered.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Ignored, by default None
+
+        Returns
+        -------
+        int
+            The number of messages still awaiting delivery.
+        """
+        self.flushes += 1
+
+        while self.in_flight:
+            self.poll(self.broker.latency_ms / 1000)
+
+        return 0
+
+    def poll(self, timeout: float = None) -> int:
+        """
+        Serve the delivery reports of the messages that are due.
+
+        Waits up to the timeout for the next message to be due.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The maximum time to wait in seconds, by default None
+
+        Returns
+        -------
+        int
+            The number of delivery reports served.
+        """
+        now = time.monotonic()
+
+        if self.in_flight and timeout:
+            time.sleep(max(0, min(timeout, self.in_flight[0][0] - now)))
+            now = time.monotonic()
+
+        return self.deliver(now)
+
+    def produce(self, topic: str, value: bytes = None, key: bytes = None, headers: list = None,
+                callback: callable = None) -> None:
+        """
+        Queue a message for delivery.
+
+        Parameters
+        ----------
+        topic : str
+            The topic to produce to.
+        value : bytes, optional
+            The value of the message, by default None
+        key : bytes, optional
+            The key of the message, by default None
+        headers : list, optional
+            The headers of the message, by default None
+        callback : callable, optional
+            The delivery callback, by default None
+
+        Raises
+        ------
+        BufferError
+            If the queue is full.
+        """
+        value = self.encode(value)
+        headers = [(header, self.encode(header_value)) for header, header_value in headers or []]
+        due = time.monotonic() + self.broker.latency_ms / 1000
+
+        with self._lock:
+            if len(self.in_flight) >= self.queue_limit:
+                raise BufferError('Local: Queue full')
+
+            self.in_flight.append((due, topic, value, key, headers, callback))
+            self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+
+    def report(self, topic: str, value: bytes, key: bytes, headers: list, callback: callable) -> None:
+        """
+        Append a message to the broker and report the delivery.
+
+        Parameters
+        ----------
+        topic : str
+            The topic to produce to.
+        value : bytes
+            The value of the message.
+        key : bytes
+            The key of the message.
+        headers : list
+            The headers of the message.
+        callback : callable
+            The delivery callback.  Can be None.
+        """
+        if self.broker.fails():
+            error = KafkaError(KafkaError._MSG_TIMED_OUT)
+            message = FakeMessage(topic, -1, -1, key, value, headers, int(time.time() * 1000))
+        else:
+            error = None
+            message = self.broker.append(topic, value, key, headers)
+
+        if callback is not None:
+            callback(error, message)
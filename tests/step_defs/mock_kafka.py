@@ -0,0 +1,377 @@
+"""Mock objects that provide APIs compatible with the Confluent Kafka client."""
+import threading
+
+from confluent_kafka import KafkaError
+
+
+class MockConfluentKafkaMessage:
+    """
+    Provide an API that is compatible with the Confluent Kafka Message.
+
+    Parameters
+    ----------
+    value : object, optional
+        The value of the string.  Will be encoded and stored as bytes, by default None
+    topic : str, optional
+        The topic name, by default None
+    headers : list, optional
+        A list of tuples to set as headers, by default None
+    """
+
+    def __init__(self, value: object = None, topic: str = None, headers: list = []) -> None:
+        self._value = None
+        self._topic = None
+        self._key = None
+        self._headers = []
+        self._partition = 0
+        self._offset = 0
+        self.value_reads = 0
+        self.value(value)
+        self.topic(topic)
+
+    def append_header(self, key: str, value: str) -> None:
+        """
+        Append a header.
+
+        Parameters
+        ----------
+        key : str
+            The key of the header.
+        value : str
+            The value of the header.
+        """
+        headers = self.headers()
+        headers.append(
+            (
+                key,
+                value.encode()
+            )
+        )
+        self.headers(headers)
+
+    def error(self) -> None:
+        """
+        Get the error of the message.
+
+        Returns
+        -------
+        None
+            The mock messages never have an error.
+        """
+        return None
+
+    def headers(self, headers: list = None) -> list:
+        """
+        Get or set the headers of the message.
+
+        Parameters
+        ----------
+        headers : list, optional
+            If not None, set the headers, by default None
+
+        Returns
+        -------
+        list
+            The headers of the message.
+        """
+        if headers is not None:
+            self._headers = headers
+
+        return self._headers
+
+    def key(self, key: bytes = None) -> bytes:
+        """
+        Get or set the key of the message.
+
+        Parameters
+        ----------
+        key : bytes, optional
+            If not None, set the key, by default None
+
+        Returns
+        -------
+        bytes
+            The key of the message.
+        """
+        if key is not None:
+            self._key = key
+
+        return self._key
+
+    def offset(self, offset: int = None) -> int:
+        """
+        Get or set the offset.
+
+        Parameters
+        ----------
+        offset : int, optional
+            If provided, set the offset to this value.
+
+        Returns
+        -------
+        int
+            The offset of the message.
+        """
+        if offset is not None:
+            self._offset = offset
+
+        return self._offset
+
+    def partition(self, partition: int = None) -> int:
+        """
+        Get or set the partition.
+
+        Parameters
+        ----------
+        partition : int, optional
+            The partition number, by default None
+
+        Returns
+        -------
+        int
+            The partition number.
+        """
+        if partition is not None:
+            self._partition = partition
+
+        return self._partition
+
+    def topic(self, topic: str = None) -> str:
+        """
+        Get or set the topic name.
+
+        Parameters
+        ----------
+        topic : str, optional
+            If not None, set the topic name, by default None
+
+        Returns
+        -------
+        str
+            The topic name.
+        """
+        if topic is not None:
+            self._topic = topic
+
+        return self._topic
+
+    def value(self, value: object = None) -> bytes:
+        """
+        Get or set the value of the message.
+
+        Parameters
+        ----------
+        value : object, optional
+            The value to set the message to if not None, by default None
+
+        Returns
+        -------
+        bytes
+            The value of the message.
+        """
+        if value is not None:
+            if type(value) is str:
+                self._value = value.encode('utf-8')
+            else:
+                self._value = value
+        else:
+            self.value_reads += 1
+
+        return self._value
+
+
+class MockConsumer:
+    """Provide an API that is compatible with the Confluent Kafka Consumer."""
+
+    def __init__(self) -> None:
+        self.commits = []
+        self.messages = []
+        self.subscriptions = []
+
+    def close(self) -> None:
+        """Close the consumer."""
+        pass
+
+    def commit(self, message: MockConfluentKafkaMessage = None, offsets: list = None,
+               asynchronous: bool = True) -> None:
+        """
+        Record a commit.
+
+        Parameters
+        ----------
+        message : MockConfluentKafkaMessage, optional
+            Commit the offset after this message, by default None
+        offsets : list, optional
+            A list of TopicPartition objects to be committed, by default None
+        asynchronous : bool, optional
+            Ignored, by default True
+        """
+        if message is not None:
+            self.commits.append((message.topic(), message.partition(), message.offset() + 1))
+
+        for offset in offsets or []:
+            self.commits.append((offset.topic, offset.partition, offset.offset))
+
+    def consume(self, num_messages: int = 1, timeout: float = -1) -> list:
+        """
+        Consume a batch of messages.
+
+        Parameters
+        ----------
+        num_messages : int, optional
+            The maximum number of messages to return, by default 1
+        timeout : float, optional
+            Ignored, by default -1
+
+        Returns
+        -------
+        list
+            The messages consumed.
+        """
+        messages = self.messages[:num_messages]
+        self.messages = self.messages[num_messages:]
+        return messages
+
+    def committed_offset(self, topic: str, partition: int) -> int:
+        """
+        Get the last offset committed for a partition.
+
+        Parameters
+        ----------
+        topic : str
+            The topic name.
+        partition : int
+            The partition number.
+
+        Returns
+        -------
+        int
+            The last offset committed or None if nothing has been committed.
+        """
+        offsets = [commit[2] for commit in self.commits if commit[:2] == (topic, partition)]
+        return offsets[-1] if offsets else None
+
+    def poll(self, timeout: float = None) -> MockConfluentKafkaMessage:
+        """
+        Consume a message.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Ignored, by default None
+
+        Returns
+        -------
+        MockConfluentKafkaMessage
+            The message consumed or None if there are no messages.
+        """
+        messages = self.consume()
+        return messages[0] if messages else None
+
+    def subscribe(self, topics: list, on_assign: callable = None, on_revoke: callable = None) -> None:
+        """
+        Record a subscription.
+
+        Parameters
+        ----------
+        topics : list
+            The topic names.
+        on_assign : callable, optional
+            Ignored, by default None
+        on_revoke : callable, optional
+            Ignored, by default None
+        """
+        self.subscriptions.append(list(topics))
+
+
+class MockProducer:
+    """
+    Provide an API that is compatible with the Confluent Kafka Producer.
+
+    Messages are only delivered when requested with deliver (or flush).  Like
+    the real producer, it can be used from more than one thread.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.RLock()
+        self.delivered = []
+        self.pending = []
+
+    def __len__(self) -> int:
+        """Get the number of messages awaiting delivery."""
+        return len(self.pending)
+
+    def deliver(self, count: int, error: KafkaError = None) -> None:
+        """
+        Deliver messages awaiting delivery.
+
+        Parameters
+        ----------
+        count : int
+            The number of messages to be delivered.
+        error : KafkaError, optional
+            If provided, report the delivery as having failed, by default None
+        """
+        with self._lock:
+            for _ in range(min(count, len(self.pending))):
+                message, callback = self.pending.pop(0)
+                self.delivered.append(message)
+                callback(error, message)
+
+    def flush(self, timeout: float = None) -> int:
+        """
+        Deliver all messages awaiting delivery.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Ignored, by default None
+
+        Returns
+        -------
+        int
+            The number of messages still awaiting delivery.
+        """
+        self.deliver(len(self.pending))
+        return 0
+
+    def poll(self, timeout: float = None) -> int:
+        """
+        Service the producer without delivering anything.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Ignored, by default None
+
+        Returns
+        -------
+        int
+            The number of events served.
+        """
+        return 0
+
+    def produce(self, topic: str, value: bytes = None, key: bytes = None, headers: list = None,
+                callback: callable = None) -> None:
+        """
+        Queue a message for delivery.
+
+        Parameters
+        ----------
+        topic : str
+            The topic to produce to.
+        value : bytes, optional
+            The value of the message, by default None
+        key : bytes, optional
+            The key of the message, by default None
+        headers : list, optional
+            The headers of the message, by default None
+        callback : callable, optional
+            The delivery callback, by default None
+        """
+        message = MockConfluentKafkaMessage(value, topic)
+        message.key(key)
+        message.headers(list(headers or []))
+
+        with self._lock:
+            self.pending.append((message, callback))
@@ -2,14 +2,89 @@
 import json
 import os
 import signal
+import subprocess
+import sys
+import time
 
 import pytest
+from confluent_kafka import KafkaError, KafkaException, TopicPartition
+from fake_broker import FakeBroker
+from mock_kafka import MockConfluentKafkaMessage, MockConsumer, MockProducer
+from prometheus_client import REGISTRY
 from pytest_bdd import given, parsers, scenarios, then, when
 
+import router
 from router import KafkaRouter, KafkaRouterRule
 
 scenarios('../features/kafka-router.feature')
 
+MODE_SETTINGS = {
+    'batched': ('batch_size', 7),
+    'coalesced': ('commit_count', 10),
+    'concurrent': ('concurrency', 3),
+    'dlq-batched': ('dlq_batch_size', 8)
+}
+
+
+def run_against_fake_broker(kafka_router: KafkaRouter, fake_broker: FakeBroker) -> None:
+    """
+    Run the router loop against a fake broker until there is nothing left to consume.
+
+    Parameters
+    ----------
+    kafka_router : KafkaRouter
+        The router to be run.
+    fake_broker : FakeBroker
+        The broker to consume from and produce to.
+    """
+    kafka_router.consumer_conf = {**kafka_router.consumer_conf, 'enable.auto.commit': 'false', 'group.id': 'router'}
+    fake_broker.idle_callback = lambda broker: kafka_router.running(False)
+    kafka_router.router(fake_broker.consumer, fake_broker.producer)
+
+
+def int_or_none(value: str) -> int:
+    """
+    Convert a word of a step to an integer (if it is one).
+
+    Parameters
+    ----------
+    value : str
+        The word.
+
+    Returns
+    -------
+    int
+        The integer or None if the word is not one.
+    """
+    return int(value) if value.isdigit() else None
+
+
+def write_rules(kind: str, rules_path, name: str, rule: str) -> None:
+    """
+    Write a single rule to a rules file or directory, replacing any other rules.
+
+    Parameters
+    ----------
+    kind : str
+        Either "file" or "directory".
+    rules_path : pathlib.Path
+        The path of the rules file or directory.
+    name : str
+        The name of the rule.
+    rule : str
+        The rule as a JSON string (which may be invalid).
+    """
+    if kind == 'file':
+        rules_path.write_text(f'{{"{name}": {rule}}}')
+        return
+
+    rules_path.mkdir(exist_ok=True)
+
+    for path in rules_path.glob('*.json'):
+        path.unlink()
+
+    (rules_path / f'{name}.json').write_text(rule)
+
 
 @given(parsers.parse('a KafkaRouter with DLQ topic {dlq_topic}'), target_fixture='kafka_router')
 def _(dlq_topic):
@@ -20,6 +95,100 @@ def _(dlq_topic):
     return KafkaRouter(dlq_topic)
 
 
+@given('a KafkaRouter with a mock consumer and producer', target_fixture='kafka_router')
+def _():
+    """a KafkaRouter with a mock consumer and producer."""
+    kafka_router = KafkaRouter('dlq')
+    kafka_router.consumer = MockConsumer()
+    kafka_router.producer = MockProducer()
+    return kafka_router
+
+
+@given('a pipelined KafkaRouter with a mock consumer and producer', target_fixture='kafka_router')
+def _():
+    """a pipelined KafkaRouter with a mock consumer and producer."""
+    kafka_router = KafkaRouter('dlq')
+    kafka_router.pipelined_mode(True)
+    kafka_router.consumer = MockConsumer()
+    kafka_router.producer = MockProducer()
+    return kafka_router
+
+
+@given(parsers.parse('a fake broker with {partitions:d} partitions'), target_fixture='fake_broker')
+def _(partitions: int, monkeypatch: pytest.MonkeyPatch):
+    """a fake broker with <partitions> partitions."""
+    monkeypatch.setenv('KAFKA_ROUTER_DLQ_ID', 'router')
+    return FakeBroker(partitions, seed=42)
+
+
+@given(parsers.parse('a fake broker with {partitions:d} partitions and {latency_ms:d}ms of latency'),
+       target_fixture='fake_broker')
+def _(partitions: int, latency_ms: int, monkeypatch: pytest.MonkeyPatch):
+    """a fake broker with <partitions> partitions and <latency_ms>ms of latency."""
+    monkeypatch.setenv('KAFKA_ROUTER_DLQ_ID', 'router')
+    return FakeBroker(partitions, latency_ms, seed=42)
+
+
+@given(parsers.parse('a JSON Lines rules file with {count:d} rules for topic {topic}'))
+def _(count: int, topic: str, tmp_path, monkeypatch: pytest.MonkeyPatch):
+    """a JSON Lines rules file with <count> rules for topic <topic>."""
+    for key in os.environ:
+        if key.startswith('KAFKA_ROUTER_RULE_'):
+            monkeypatch.delenv(key)
+
+    rules_path = tmp_path / 'rules.jsonl'
+
+    with rules_path.open('w') as stream:
+        for index in range(count):
+            rule = {'destination_topics': f'output.{index}', 'regexp': f'^C{index}$', 'source_topic': topic}
+            stream.write(json.dumps({f'BULK_{index:05d}': rule}) + '\n\n')
+
+    monkeypatch.setenv('KAFKA_ROUTER_RULES_PATH', str(rules_path))
+
+
+@given(parsers.parse('a KafkaRouter is created in a new interpreter with rule {rule}'), target_fixture='modules')
+def _(rule: str):
+    """a KafkaRouter is created in a new interpreter with rule <rule>."""
+    environment = {key: value for key, value in os.environ.items()
+                   if not key.startswith('KAFKA_ROUTER_RULE_') and key != 'SENTRY_DSN'}
+    environment.update({
+        'KAFKA_ROUTER_DLQ_ID': 'router',
+        'KAFKA_ROUTER_RULE_1': rule,
+        'PYTHONPATH': os.path.dirname(os.path.abspath(router.__file__))
+    })
+    code = "import json, sys, router; router.KafkaRouter('dlq'); print(json.dumps(sorted(sys.modules)))"
+    result = subprocess.run([sys.executable, '-c', code], env=environment, capture_output=True, check=True, text=True)
+    return json.loads(result.stdout)
+
+
+@given('the router module is imported in a new interpreter', target_fixture='modules')
+def _():
+    """the router module is imported in a new interpreter."""
+    environment = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(router.__file__)))
+    code = 'import json, sys, router; print(json.dumps(sorted(sys.modules)))'
+    result = subprocess.run([sys.executable, '-c', code], env=environment, capture_output=True, check=True, text=True)
+    return json.loads(result.stdout)
+
+
+@given(parsers.parse('OS environment {key} is {value}'))
+def _(key: str, value: str, monkeypatch: pytest.MonkeyPatch):
+    """OS environment <key> is <value>."""
+    monkeypatch.setenv(key, value)
+
+
+@given(parsers.parse('a rules {kind:w} with rule {name:w} {rule}'), target_fixture='rules_path')
+def _(kind: str, name: str, rule: str, tmp_path, monkeypatch: pytest.MonkeyPatch):
+    """a rules <kind> with rule <name> <rule>."""
+    for key in os.environ:
+        if key.startswith('KAFKA_ROUTER_RULE_'):
+            monkeypatch.delenv(key)
+
+    rules_path = tmp_path / 'rules' if kind == 'directory' else tmp_path / 'rules.json'
+    write_rules(kind, rules_path, name, rule)
+    monkeypatch.setenv('KAFKA_ROUTER_RULES_PATH', str(rules_path))
+    return rules_path
+
+
 @given(parsers.parse('consumer config to be validated is {config}'), target_fixture='consumer_config')
 def _(config: str):
     """consumer config to be validated is <config>."""
@@ -61,6 +230,262 @@ def _(rule: str, kafka_router: KafkaRouter):
     )
 
 
+@when(parsers.parse('{count:d} messages on topic {topic} are processed'))
+def _(count: int, topic: str, kafka_router: KafkaRouter):
+    """<count> messages on topic <topic> are processed."""
+    for offset in range(count):
+        message = MockConfluentKafkaMessage(f'Message {offset}', topic)
+        message.offset(offset)
+        kafka_router.process_message(message)
+        kafka_router.commit(message)
+
+
+@when(parsers.parse('{count:d} messages on topic {topic} are waiting to be consumed'))
+def _(count: int, topic: str, kafka_router: KafkaRouter):
+    """<count> messages on topic <topic> are waiting to be consumed."""
+    for offset in range(count):
+        message = MockConfluentKafkaMessage(f'Message {offset}', topic)
+        message.offset(offset)
+        kafka_router.consumer.messages.append(message)
+
+
+@when(parsers.parse('{count:d} messages with {keys:d} keys on topic {topic} are waiting to be consumed'))
+def _(count: int, keys: int, topic: str, kafka_router: KafkaRouter):
+    """<count> messages with <keys> keys on topic <topic> are waiting to be consumed."""
+    for offset in range(count):
+        message = MockConfluentKafkaMessage(f'{offset}', topic)
+        message.key(f'key-{offset % keys}'.encode())
+        message.offset(offset)
+        kafka_router.consumer.messages.append(message)
+
+
+@when(parsers.parse('{count:d} messages on topic {topic} of the fake broker with every third country IE'))
+def _(count: int, topic: str, fake_broker: FakeBroker):
+    """<count> messages on topic <topic> of the fake broker with every third country IE."""
+    for index in range(count):
+        country = 'IE' if index % 3 == 2 else 'GB'
+        fake_broker.append(topic, json.dumps({'country': country}).encode(), f'{index % 7}'.encode(),
+                           timestamp=index * 1000)
+
+
+@when(parsers.parse(
+    '{count:d} DLQ messages on topic {topic} of the fake broker with every {interval:d}th from topic {source}'))
+def _(count: int, topic: str, interval: int, source: str, fake_broker: FakeBroker):
+    """<count> DLQ messages on topic <topic> of the fake broker with every <interval>th from topic <source>."""
+    for index in range(count):
+        headers = [('__router.topic', source.encode() if index % interval == 0 else b'payments')]
+        fake_broker.append(topic, b'{}', headers=headers, partition=0)
+
+
+@when(parsers.parse('the DLQ index of topic {topic} of the fake broker is built'))
+def _(topic: str, fake_broker: FakeBroker, tmp_path, monkeypatch: pytest.MonkeyPatch):
+    """the DLQ index of topic <topic> of the fake broker is built."""
+    monkeypatch.setenv('KAFKA_ROUTER_DLQ_INDEX_MODE', 'true')
+    monkeypatch.setenv('KAFKA_ROUTER_DLQ_INDEX_PATH', str(tmp_path / 'dlq.idx'))
+    monkeypatch.setenv('KAFKA_ROUTER_DLQ_MODE', 'true')
+    index_router = KafkaRouter('dlq')
+    index_router.add_rule(KafkaRouterRule('KAFKA_ROUTER_RULE_INDEX', json.dumps({
+        'destination_topics': 'index',
+        'source_topic': topic
+    })))
+    run_against_fake_broker(index_router, fake_broker)
+    monkeypatch.delenv('KAFKA_ROUTER_DLQ_INDEX_MODE')
+    monkeypatch.delenv('KAFKA_ROUTER_DLQ_MODE')
+    assert fake_broker.topics.get('index') is None
+
+
+@when(parsers.parse('{count:d} messages on topic {topic} of the fake broker with invalid JSON'))
+def _(count: int, topic: str, fake_broker: FakeBroker):
+    """<count> messages on topic <topic> of the fake broker with invalid JSON."""
+    for index in range(count):
+        fake_broker.append(topic, f'{{"country": GB{index}'.encode(), f'{index}'.encode(), headers=[])
+
+
+@when(parsers.parse('the DLQ batch size is {batch_size:d} and stack traces are sampled every {interval:d}'))
+def _(batch_size: int, interval: int, kafka_router: KafkaRouter):
+    """the DLQ batch size is <batch_size> and stack traces are sampled every <interval>."""
+    kafka_router.dlq_batch_size = batch_size
+    kafka_router.stack_traces = router.StackTraceSampler(interval)
+
+
+@when('the consumer reports the end of each partition')
+def _(kafka_router: KafkaRouter):
+    """the consumer reports the end of each partition."""
+    kafka_router.consumer_conf = {'enable.partition.eof': 'true'}
+
+
+@when(parsers.parse('the {metric:w} metric is sampled'), target_fixture='metric_sample')
+def _(metric: str):
+    """the <metric> metric is sampled."""
+    return REGISTRY.get_sample_value(metric) or 0.0
+
+
+@when(parsers.parse('the producer backpressure limit is {count:d} messages'))
+def _(count: int, kafka_router: KafkaRouter):
+    """the producer backpressure limit is <count> messages."""
+    kafka_router.backpressure_max_messages = count
+
+
+@when(parsers.parse('the producer queue holds {count:d} messages'))
+def _(count: int, kafka_router: KafkaRouter):
+    """the producer queue holds <count> messages."""
+    kafka_router.producer_conf = {'queue.buffering.max.messages': count}
+
+
+@when('the fake broker fails every delivery')
+def _(fake_broker: FakeBroker):
+    """the fake broker fails every delivery."""
+    fake_broker.failure_rate = 1
+
+
+@when(parsers.parse('the KafkaRouter mode is {mode}'))
+def _(mode: str, kafka_router: KafkaRouter):
+    """the KafkaRouter mode is <mode>."""
+    if mode == 'pipelined':
+        kafka_router.pipelined_mode(True)
+    elif mode in MODE_SETTINGS:
+        setattr(kafka_router, *MODE_SETTINGS[mode])
+
+
+@when('the KafkaRouter is run against the fake broker until it is idle')
+def _(kafka_router: KafkaRouter, fake_broker: FakeBroker):
+    """the KafkaRouter is run against the fake broker until it is idle."""
+    run_against_fake_broker(kafka_router, fake_broker)
+
+
+@when(parsers.parse('the KafkaRouter is in DLQ mode with a replay of {bounds}'))
+def _(bounds: str, kafka_router: KafkaRouter):
+    """the KafkaRouter is in DLQ mode with a replay of <bounds>."""
+    kafka_router.dlq_mode(True)
+    kafka_router.timeout_ms = 60000
+
+    if bounds.startswith('offsets'):
+        _, kafka_router.replay.start_offset, _, kafka_router.replay.end_offset = map(int_or_none, bounds.split())
+    elif bounds.startswith('timestamps'):
+        _, kafka_router.replay.start_timestamp_ms, _, kafka_router.replay.end_timestamp_ms = map(
+            int_or_none, bounds.split())
+
+
+@when('the KafkaRouter is in DLQ mode with the DLQ index')
+def _(kafka_router: KafkaRouter):
+    """the KafkaRouter is in DLQ mode with the DLQ index."""
+    kafka_router.dlq_mode(True)
+    kafka_router.timeout_ms = 60000
+    kafka_router.init_dlq_index(router.EnvironmentConfig())
+
+
+@when('the KafkaRouter replays the fake broker')
+def _(kafka_router: KafkaRouter, fake_broker: FakeBroker):
+    """the KafkaRouter replays the fake broker."""
+    kafka_router.consumer_conf = {'enable.auto.commit': 'false', 'group.id': 'router'}
+    fake_broker.idle_polls = 0
+
+    def idle(broker: FakeBroker) -> None:
+        broker.idle_polls += 1
+
+        if broker.idle_polls > 10:
+            kafka_router.running(False)
+
+    fake_broker.idle_callback = idle
+    kafka_router.router(fake_broker.consumer, fake_broker.producer)
+
+
+@when(parsers.parse('the batch size is {batch_size:d}'))
+def _(batch_size: int, kafka_router: KafkaRouter):
+    """the batch size is <batch_size>."""
+    kafka_router.batch_size = batch_size
+
+
+@when('the KafkaRouter consumes and processes the messages')
+def _(kafka_router: KafkaRouter):
+    """the KafkaRouter consumes and processes the messages."""
+    kafka_router.process_messages(kafka_router.consume())
+
+
+@when(parsers.parse('the producer delivers {count:d} messages'))
+def _(count: int, kafka_router: KafkaRouter):
+    """the producer delivers <count> messages."""
+    kafka_router.producer.deliver(count)
+    kafka_router.commit_offsets()
+
+
+@when(parsers.parse('the producer fails to deliver {count:d} messages'))
+def _(count: int, kafka_router: KafkaRouter):
+    """the producer fails to deliver <count> messages."""
+    kafka_router.producer.deliver(count, KafkaError(KafkaError._MSG_TIMED_OUT))
+    kafka_router.commit_offsets()
+
+
+@when(parsers.parse('the concurrency is {concurrency:d}'))
+def _(concurrency: int, kafka_router: KafkaRouter):
+    """the concurrency is <concurrency>."""
+    kafka_router.concurrency = concurrency
+
+
+@when(parsers.parse('commits are coalesced every {count:d} messages'))
+def _(count: int, kafka_router: KafkaRouter):
+    """commits are coalesced every <count> messages."""
+    kafka_router.commit_count = count
+
+
+@when('the asynchronous commits are reported')
+def _(kafka_router: KafkaRouter):
+    """the asynchronous commits are reported."""
+    commits = kafka_router.consumer.commits
+    kafka_router.commit_report(None, [TopicPartition(*commit) for commit in commits])
+
+
+@when(parsers.parse('the partitions of {topic} are revoked'))
+def _(topic: str, kafka_router: KafkaRouter):
+    """the partitions of <topic> are revoked."""
+    kafka_router.on_revoke(kafka_router.consumer, [TopicPartition(topic, 0)])
+
+
+@when('the KafkaRouter is drained')
+def _(kafka_router: KafkaRouter):
+    """the KafkaRouter is drained."""
+    kafka_router.drain()
+
+
+@when('the KafkaRouter reloads the rules')
+def _(kafka_router: KafkaRouter):
+    """the KafkaRouter reloads the rules."""
+    kafka_router.reload_rules()
+
+
+@when('the reloaded rules are swapped in')
+def _(kafka_router: KafkaRouter):
+    """the reloaded rules are swapped in."""
+    kafka_router.apply_pending_rules()
+
+
+@when('the rule watcher is started')
+def _(kafka_router: KafkaRouter):
+    """the rule watcher is started."""
+    kafka_router.rules_reload_interval_ms = 10
+    kafka_router.start_rule_watcher()
+
+
+@when(parsers.parse('rule {name:w} {rule} is added to the rules file'))
+def _(name: str, rule: str, rules_path):
+    """rule <name> <rule> is added to the rules file."""
+    rules = json.loads(rules_path.read_text())
+    rules[name] = json.loads(rule)
+    rules_path.write_text(json.dumps(rules))
+
+
+@when(parsers.parse('the rules {kind:w} is updated with rule {name:w} {rule}'))
+def _(kind: str, name: str, rule: str, rules_path):
+    """the rules <kind> is updated with rule <name> <rule>."""
+    write_rules(kind, rules_path, name, rule)
+
+
+@when('System Signal SIGHUP is sent to the KafkaRouter')
+def _(kafka_router: KafkaRouter):
+    """System Signal SIGHUP is sent to the KafkaRouter."""
+    os.kill(os.getpid(), signal.SIGHUP)
+
+
 @when('the consumer config is validated')
 def _():
     """the consumer config is validated."""
@@ -89,6 +514,22 @@ def _(expected_value: str, kafka_router: KafkaRouter):
     assert kafka_router.get_dlq_id() == expected_value
 
 
+@then(parsers.parse('KafkaRouter has {rule_count:d} rules for topic {topic}'))
+def _(rule_count: int, topic: str, kafka_router: KafkaRouter):
+    """KafkaRouter has <rule_count> rules for topic <topic>."""
+    rules = kafka_router.get_rules_for_topic(topic)
+    assert len(rules) == rule_count
+    assert all(rule.source_topic == topic for rule in rules)
+
+
+@then(parsers.parse('the KafkaRouter rules for topics {first} and {second} are the same empty list'))
+def _(first: str, second: str, kafka_router: KafkaRouter):
+    """the KafkaRouter rules for topics <first> and <second> are the same empty list."""
+    rules = kafka_router.get_rules_for_topic(first)
+    assert rules == []
+    assert kafka_router.get_rules_for_topic(second) is rules
+
+
 @then(parsers.parse('KafkaRouter source topics include {source_topic}'))
 def _(source_topic: str, kafka_router: KafkaRouter):
     """KafkaRouter source topics include <source_topic>."""
@@ -110,6 +551,175 @@ def _(is_true: str, consumer_config: dict):
     assert actual == expected
 
 
+@then(parsers.parse('running the KafkaRouter against the fake broker raises a KafkaException'))
+def _(kafka_router: KafkaRouter, fake_broker: FakeBroker):
+    """running the KafkaRouter against the fake broker raises a KafkaException."""
+    with pytest.raises(KafkaException):
+        run_against_fake_broker(kafka_router, fake_broker)
+
+
+@then(parsers.parse('{count:d} messages on topic {topic} of the fake broker have a full stack trace'))
+def _(count: int, topic: str, fake_broker: FakeBroker):
+    """<count> messages on topic <topic> of the fake broker have a full stack trace."""
+    stacktraces = [dict(message.headers())['__router.stacktrace'] for message in fake_broker.messages(topic)]
+    assert len([stacktrace for stacktrace in stacktraces if stacktrace.startswith(b'Traceback')]) == count
+
+
+@then(parsers.parse('the messages on topic {topic} of the fake broker have the same stack trace reference'))
+def _(topic: str, fake_broker: FakeBroker):
+    """the messages on topic <topic> of the fake broker have the same stack trace reference."""
+    references = {dict(message.headers())['__router.stacktrace.reference'] for message in fake_broker.messages(topic)}
+    assert len(references) == 1
+
+
+@then(parsers.parse('the messages on topic {topic} of the fake broker have no stack trace reference'))
+def _(topic: str, fake_broker: FakeBroker):
+    """the messages on topic <topic> of the fake broker have no stack trace reference."""
+    headers = [dict(message.headers()) for message in fake_broker.messages(topic)]
+    assert not any('__router.stacktrace.reference' in message_headers for message_headers in headers)
+
+
+@then(parsers.parse('the KafkaRouter producer has had at most {count:d} messages in flight'))
+def _(count: int, kafka_router: KafkaRouter):
+    """the KafkaRouter producer has had at most <count> messages in flight."""
+    assert 0 < kafka_router.producer.max_in_flight <= count
+
+
+@then(parsers.parse('the KafkaRouter producer has been flushed {count:d} times'))
+def _(count: int, kafka_router: KafkaRouter):
+    """the KafkaRouter producer has been flushed <count> times."""
+    assert kafka_router.producer.flushes == count
+
+
+@then(parsers.parse('the fake broker has {count:d} messages on topic {topic}'))
+def _(count: int, topic: str, fake_broker: FakeBroker):
+    """the fake broker has <count> messages on topic <topic>."""
+    assert len(fake_broker.messages(topic)) == count
+
+
+@then(parsers.parse('the fake broker has committed {count:d} messages on topic {topic}'))
+def _(count: int, topic: str, fake_broker: FakeBroker):
+    """the fake broker has committed <count> messages on topic <topic>."""
+    partitions = range(fake_broker.partitions)
+    assert sum(fake_broker.committed_offset('router', topic, partition) or 0 for partition in partitions) == count
+
+
+@then('the KafkaRouter has no messages in flight')
+def _(kafka_router: KafkaRouter):
+    """the KafkaRouter has no messages in flight."""
+    assert kafka_router._in_flight_bytes == 0
+
+
+@then(parsers.parse('the committed offset for {topic} is {offset}'))
+def _(topic: str, offset: str, kafka_router: KafkaRouter):
+    """the committed offset for <topic> is <offset>."""
+    expected = None if offset == 'None' else int(offset)
+    assert kafka_router.consumer.committed_offset(topic, 0) == expected
+
+
+@then(parsers.parse('{count:d} messages have been delivered'))
+def _(count: int, kafka_router: KafkaRouter):
+    """<count> messages have been delivered."""
+    assert len(kafka_router.producer.delivered) == count
+
+
+@then('the messages for each key have been delivered in order')
+def _(kafka_router: KafkaRouter):
+    """the messages for each key have been delivered in order."""
+    values_by_key = {}
+
+    for message in kafka_router.producer.delivered:
+        values_by_key.setdefault(message.key(), []).append(int(message.value()))
+
+    assert values_by_key
+    assert all(values == sorted(values) for values in values_by_key.values())
+
+
+@then('no commits are awaiting a report')
+def _(kafka_router: KafkaRouter):
+    """no commits are awaiting a report."""
+    partitions = [TopicPartition(*commit) for commit in kafka_router.consumer.commits]
+    assert kafka_router.pop_commit_start_time(partitions) is None
+
+
+@then('a reload of the rules has been requested')
+def _(kafka_router: KafkaRouter):
+    """a reload of the rules has been requested."""
+    assert kafka_router._reload_requested.is_set()
+
+
+@then('the KafkaRouter does not handle SIGHUP')
+def _(kafka_router: KafkaRouter):
+    """the KafkaRouter does not handle SIGHUP."""
+    assert signal.getsignal(signal.SIGHUP) != kafka_router.reload_handler
+
+
+@then(parsers.parse('the consumer has been re-subscribed to {topic}'))
+def _(topic: str, kafka_router: KafkaRouter):
+    """the consumer has been re-subscribed to <topic>."""
+    assert kafka_router.consumer.subscriptions == [[topic]]
+
+
+@then('the consumer has not been re-subscribed')
+def _(kafka_router: KafkaRouter):
+    """the consumer has not been re-subscribed."""
+    assert kafka_router.consumer.subscriptions == []
+
+
+@then(parsers.parse('the reloaded rules for topic {topic} have a combined pattern'))
+def _(topic: str, kafka_router: KafkaRouter):
+    """the reloaded rules for topic <topic> have a combined pattern."""
+    assert kafka_router._pending_rules.rules_by_topic[topic]._combined
+
+
+@then('reloaded rules are waiting to be swapped in')
+def _(kafka_router: KafkaRouter):
+    """reloaded rules are waiting to be swapped in."""
+    deadline = time.time() + 5
+
+    while kafka_router._pending_rules is None and time.time() < deadline:
+        time.sleep(0.01)
+
+    kafka_router.running(False)
+    assert [rule.name for rule in kafka_router._pending_rules.rules] == ['IE']
+
+
+@then(parsers.parse('the {metric:w} metric is {value:g}'))
+def _(metric: str, value: float):
+    """the <metric> metric is <value>."""
+    assert REGISTRY.get_sample_value(metric) == value
+
+
+@then(parsers.parse('the {metric:w} metric has increased by {value:g}'))
+def _(metric: str, value: float, metric_sample: float):
+    """the <metric> metric has increased by <value>."""
+    assert REGISTRY.get_sample_value(metric) - metric_sample == value
+
+
+@then(parsers.parse('the {metric:w} metric is more than {value:g}'))
+def _(metric: str, value: float):
+    """the <metric> metric is more than <value>."""
+    assert REGISTRY.get_sample_value(metric) > value
+
+
+@then(parsers.parse('the module {module} has been imported is {is_imported}'))
+def _(module: str, is_imported: str, modules: list):
+    """the module <module> has been imported is <is_imported>."""
+    assert (module in modules) == (is_imported == 'True')
+
+
+@then(parsers.parse('the KafkaRouter consumer has seeked {count:d} times'))
+def _(count: int, kafka_router: KafkaRouter):
+    """the KafkaRouter consumer has seeked <count> times."""
+    assert len(kafka_router.consumer.seeks) == count
+
+
+@then('the replay stopped without waiting for the timeout')
+def _(fake_broker: FakeBroker):
+    """the replay stopped without waiting for the timeout."""
+    assert fake_broker.idle_polls <= 1
+
+
 @then('headers count is two')
 def _(kafka_router: KafkaRouter):
     """headers count is two."""
@@ -1,153 +1,15 @@
 """Kafka Router Rule feature tests."""
+import json
+import os
 
+import jmespath
 import pytest
+from mock_kafka import MockConfluentKafkaMessage
+from prometheus_client import REGISTRY
 from pytest_bdd import given, parsers, scenarios, then, when
 
 import router
 
-
-class MockConfluentKafkaMessage:
-    """
-    Provide an API that is compatible with the Confluent Kafka Message.
-
-    Parameters
-    ----------
-    value : object, optional
-        The value of the string.  Will be encoded and stored as bytes, by default None
-    topic : str, optional
-        The topic name, by default None
-    headers : list, optional
-        A list of tuples to set as headers, by default None
-    """
-
-    def __init__(self, value: object = None, topic: str = None, headers: list = []) -> None:
-        self._value = None
-        self._topic = None
-        self._headers = []
-        self._partition = 0
-        self._offset = 0
-        self.value(value)
-        self.topic(topic)
-
-    def append_header(self, key: str, value: str) -> None:
-        """
-        Append a header.
-
-        Parameters
-        ----------
-        key : str
-            The key of the header.
-        value : str
-            The value of the header.
-        """
-        headers = self.headers()
-        headers.append(
-            (
-                key,
-                value.encode()
-            )
-        )
-        self.headers(headers)
-
-    def headers(self, headers: list = None) -> list:
-        """
-        Get or set the headers of the message.
-
-        Parameters
-        ----------
-        headers : list, optional
-            If not None, set the headers, by default None
-
-        Returns
-        -------
-        list
-            The headers of the message.
-        """
-        if headers is not None:
-            self._headers = headers
-
-        return self._headers
-
-    def offset(self, offset: int = None) -> int:
-        """
-        Get or set the offset.
-
-        Parameters
-        ----------
-        offset : int, optional
-            If provided, set the offset to this value.
-
-        Returns
-        -------
-        int
-            The offset of the message.
-        """
-        if offset is not None:
-            self._offset = offset
-
-        return self._offset
-
-    def partition(self, partition: int = None) -> int:
-        """
-        Get or set the partition.
-
-        Parameters
-        ----------
-        partition : int, optional
-            The partition number, by default None
-
-        Returns
-        -------
-        int
-            The partition number.
-        """
-        if partition is not None:
-            self._partition = partition
-
-        return self._partition
-
-    def topic(self, topic: str = None) -> str:
-        """
-        Get or set the topic name.
-
-        Parameters
-        ----------
-        topic : str, optional
-            If not None, set the topic name, by default None
-
-        Returns
-        -------
-        str
-            The topic name.
-        """
-        if topic is not None:
-            self._topic = topic
-
-        return self._topic
-
-    def value(self, value: object = None) -> bytes:
-        """
-        Get or set the value of the message.
-
-        Parameters
-        ----------
-        value : object, optional
-            The value to set the message to if not None, by default None
-
-        Returns
-        -------
-        bytes
-            The value of the message.
-        """
-        if value is not None:
-            if type(value) is str:
-                self._value = value.encode('utf-8')
-            else:
-                self._value = value
-
-        return self._value
-
-
 scenarios('../features/kafka-router-rule.feature')
 
 
@@ -157,12 +19,46 @@ def _(rule: str):
     return router.KafkaRouterRule('test', rule)
 
 
+@given('no rules in the OS environment')
+def _(monkeypatch: pytest.MonkeyPatch):
+    """no rules in the OS environment."""
+    for key in os.environ:
+        if key.startswith('KAFKA_ROUTER_RULE_'):
+            monkeypatch.delenv(key)
+
+
+@given(parsers.parse('OS environment {key} is {value}'))
+def _(key: str, value: str, monkeypatch: pytest.MonkeyPatch):
+    """OS environment <key> is <value>."""
+    monkeypatch.setenv(key, value)
+
+
+@given('the rule schema has not been loaded')
+def _(monkeypatch: pytest.MonkeyPatch):
+    """the rule schema has not been loaded."""
+    monkeypatch.setattr(router.KafkaRouterRule, 'validator', None)
+
+
+@given('the working directory is not the root of the repository')
+def _(tmp_path, monkeypatch: pytest.MonkeyPatch):
+    """the working directory is not the root of the repository."""
+    monkeypatch.chdir(tmp_path)
+
+
 @given('a KafkaRouter with DLQ topic "dlq_topic"', target_fixture='kafka_router')
 def _():
     """a KafkaRouter with DLQ topic "dlq_topic"."""
     return router.KafkaRouter('dlq_topic')
 
 
+@given(parsers.parse('a message with a Latin-1 value of {message_value}'), target_fixture='mock_confluent_message')
+def _(message_value: str):
+    """a message with a Latin-1 value of <message_value>."""
+    message = MockConfluentKafkaMessage(message_value.encode('latin-1'))
+    message.topic('input')
+    return message
+
+
 @given(parsers.parse('a message with a value of {message_value}'), target_fixture='mock_confluent_message')
 def _(message_value: str):
     """a message with a value of <message_value>."""
@@ -189,12 +85,68 @@ def _(key: str, value: str, mock_confluent_message: MockConfluentKafkaMessage):
     mock_confluent_message.append_header(key, value)
 
 
+@when(parsers.parse('OS environment {key} is {value}'))
+def _(key: str, value: str):
+    """OS environment <key> is <value>."""
+    os.environ[key] = value
+
+
+@when('the KafkaRouter is in dry run mode')
+def _(kafka_router: router.KafkaRouter):
+    """the KafkaRouter is in dry run mode."""
+    kafka_router.dry_run_mode(True)
+
+
+@when(parsers.parse('the KafkaRouter has a rule of {rule}'))
+def _(rule: str, kafka_router: router.KafkaRouter):
+    """the KafkaRouter has a rule of <rule>."""
+    kafka_router.add_rule(router.KafkaRouterRule('KAFKA_ROUTER_RULE_TEST', rule))
+
+
+@when('the JMESPath evaluations are counted', target_fixture='jmespath_searches')
+def _(monkeypatch: pytest.MonkeyPatch):
+    """the JMESPath evaluations are counted."""
+    searches = []
+    search = jmespath.parser.ParsedResult.search
+
+    def counted_search(self, value, options=None):
+        searches.append(self.expression)
+        return search(self, value, options)
+
+    monkeypatch.setattr(jmespath.parser.ParsedResult, 'search', counted_search)
+    return searches
+
+
+@when(parsers.parse('the KafkaRouter has a rule named {name} of {rule}'))
+def _(name: str, rule: str, kafka_router: router.KafkaRouter):
+    """the KafkaRouter has a rule named <name> of <rule>."""
+    kafka_router.add_rule(router.KafkaRouterRule(f'KAFKA_ROUTER_RULE_{name}', rule))
+
+
+@when('the message is matched by the KafkaRouter')
+def _(kafka_router: router.KafkaRouter, mock_confluent_message: MockConfluentKafkaMessage):
+    """the message is matched by the KafkaRouter."""
+    kafka_router.match_message_to_rule(mock_confluent_message)
+
+
 @when('the message is checked')
 def _():
     """the message is checked."""
     pass
 
 
+@when(parsers.parse('{count:d} rules are initialised'), target_fixture='validators')
+def _(count: int):
+    """<count> rules are initialised."""
+    validators = []
+
+    for index in range(count):
+        router.KafkaRouterRule(f'RULE_{index}', f'{{"destination_topics":"output","source_topic":"input.{index}"}}')
+        validators.append(router.KafkaRouterRule.validator)
+
+    return validators
+
+
 @when('the rule is initialised')
 def _():
     """the rule is initialised."""
@@ -210,6 +162,78 @@ def _(expected_outcome: str, mock_confluent_message: MockConfluentKafkaMessage,
     assert actual_outcome == expected_outcome
 
 
+@then(parsers.parse('{count:d} rules are candidates for the message'))
+def _(count: int, kafka_router: router.KafkaRouter, mock_confluent_message: MockConfluentKafkaMessage):
+    """<count> rules are candidates for the message."""
+    rule_set = kafka_router.rules_by_topic[mock_confluent_message.topic()]
+    context = router.MessageContext(mock_confluent_message)
+    assert len(rule_set.get_candidates(context)) == count
+
+
+@then(parsers.parse('the first matching candidate is {destination_topics}'))
+def _(destination_topics: str, kafka_router: router.KafkaRouter, mock_confluent_message: MockConfluentKafkaMessage):
+    """the first matching candidate is <destination_topics>."""
+    rule_set = kafka_router.rules_by_topic[mock_confluent_message.topic()]
+    context = router.MessageContext(mock_confluent_message)
+
+    def first_match(rules: list) -> str:
+        for rule in rules:
+            try:
+                if rule.is_match(mock_confluent_message, context):
+                    return rule.destination_topics
+            except (TypeError, json.decoder.JSONDecodeError):
+                pass
+
+        return 'None'
+
+    assert first_match(rule_set.get_candidates(context)) == destination_topics
+    assert first_match(rule_set.rules) == destination_topics
+
+
+@then(parsers.parse('the JMESPath expressions were evaluated {count:d} times'))
+def _(count: int, jmespath_searches: list):
+    """the JMESPath expressions were evaluated <count> times."""
+    assert len(jmespath_searches) == count
+
+
+@then(parsers.parse('the KafkaRouter has {count:d} distinct JMESPath expressions'))
+def _(count: int, kafka_router: router.KafkaRouter):
+    """the KafkaRouter has <count> distinct JMESPath expressions."""
+    expressions = {id(rule.expression) for rule in kafka_router.rules if rule.expression}
+    assert len(expressions) == count
+
+
+@then(parsers.parse('the {metric:w} metric for rule {rule:w} and stage {stage:w} is {value:g}'))
+def _(metric: str, rule: str, stage: str, value: float):
+    """the <metric> metric for rule <rule> and stage <stage> is <value>."""
+    assert (REGISTRY.get_sample_value(metric, {'rule': rule, 'stage': stage}) or 0.0) == value
+
+
+@then(parsers.parse('the {metric:w} metric for rule {rule:w} is {value:g}'))
+def _(metric: str, rule: str, value: float):
+    """the <metric> metric for rule <rule> is <value>."""
+    assert (REGISTRY.get_sample_value(metric, {'rule': rule}) or 0.0) == value
+
+
+@then(parsers.parse('the KafkaRouter header {key} is {value}'))
+def _(key: str, value: str, kafka_router: router.KafkaRouter):
+    """the KafkaRouter header <key> is <value>."""
+    assert (key, value) in kafka_router.headers()
+
+
+@then(parsers.parse('the message value was read {reads:d} times'))
+def _(reads: int, mock_confluent_message: MockConfluentKafkaMessage):
+    """the message value was read <reads> times."""
+    assert mock_confluent_message.value_reads == reads
+
+
+@then('the rule schema validator was created once')
+def _(validators: list):
+    """the rule schema validator was created once."""
+    assert validators[0] is not None
+    assert all(validator is validators[0] for validator in validators)
+
+
 @then('the SystemExit is 2')
 def _(invalid_rule: str):
     """the SystemExit is 2."""
@@ -0,0 +1,140 @@
+"""Offline Router feature tests."""
+import glob
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+from pytest_bdd import given, parsers, scenarios, then, when
+
+from router import MessageFile, OfflineRouter
+
+scenarios('../features/offline-router.feature')
+
+
+def read_output(output_dir: str, topic: str) -> list:
+    """
+    Read the messages written to the output directory for a topic.
+
+    Parameters
+    ----------
+    output_dir : str
+        The output directory.
+    topic : str
+        The topic name.
+
+    Returns
+    -------
+    list
+        The messages (in the order of the chunks that they were routed from).
+    """
+    paths = sorted(glob.glob(os.path.join(output_dir, topic, '*')))
+    return [message for path in paths for message in MessageFile(path).read()]
+
+
+@given(parsers.parse('a rule {rule}'))
+def _(rule: str, monkeypatch: pytest.MonkeyPatch):
+    """a rule <rule>."""
+    for key in os.environ:
+        if key.startswith('KAFKA_ROUTER_RULE'):
+            monkeypatch.delenv(key)
+
+    monkeypatch.setenv('KAFKA_ROUTER_DLQ_ID', 'router')
+    monkeypatch.setenv('KAFKA_ROUTER_RULE_GB', rule)
+
+
+@given(parsers.parse('a {file_format:w} file of {count:d} messages on topic {topic} with every third country IE'),
+       target_fixture='message_path')
+def _(file_format: str, count: int, topic: str, tmp_path):
+    """a <file_format> file of <count> messages on topic <topic> with every third country IE."""
+    path = str(tmp_path / f'messages.{file_format}')
+    message_file = MessageFile(path)
+
+    with open(path, 'wb') as stream:
+        for index in range(count):
+            country = 'IE' if index % 3 == 2 else 'GB'
+
+            if message_file.json_lines:
+                record = {'topic': topic, 'key': str(index), 'headers': {'index': str(index)},
+                          'value': {'country': country}}
+                stream.write(json.dumps(record).encode() + b'\n')
+            else:
+                value = json.dumps({'country': country}).encode()
+                stream.write(message_file.encode(topic, str(index).encode(), [('index', str(index).encode())], value))
+
+    return path
+
+
+@given(parsers.parse('the environment variable {name} is set to {value}'))
+def _(name: str, value: str, monkeypatch: pytest.MonkeyPatch):
+    """the environment variable <name> is set to <value>."""
+    monkeypatch.setenv(name, value)
+
+
+@when(parsers.parse('the file is routed offline with {processes:d} processes and chunks of {chunk_size:d} bytes'),
+      target_fixture='counts')
+def _(processes: int, chunk_size: int, message_path: str):
+    """the file is routed offline with <processes> processes and chunks of <chunk_size> bytes."""
+    return OfflineRouter([message_path], processes=processes, chunk_size=chunk_size).route()
+
+
+@when('the file is routed offline to an output directory', target_fixture='output_dir')
+def _(message_path: str, tmp_path):
+    """the file is routed offline to an output directory."""
+    output_dir = str(tmp_path / 'output')
+    OfflineRouter([message_path], output_dir, processes=1, chunk_size=1000).route()
+    return output_dir
+
+
+@when('router.py offline is run on the file', target_fixture='result')
+def _(message_path: str):
+    """router.py offline is run on the file."""
+    command = [sys.executable, 'router.py', 'offline', '--processes', '2', '--chunk-size-mb', '1', message_path]
+    return subprocess.run(command, capture_output=True, check=True, text=True)
+
+
+@then(parsers.parse('{count:d} messages have been routed to {topic}'))
+def _(count: int, topic: str, counts: dict):
+    """<count> messages have been routed to <topic>."""
+    assert counts.get(topic) == count
+
+
+@then('the offline worker router is in the default mode with nothing in flight')
+def _():
+    """the offline worker router is in the default mode with nothing in flight."""
+    worker_router = OfflineRouter.worker_router
+    assert not worker_router.batch_mode()
+    assert not worker_router.dlq_batching()
+    assert not worker_router.tracking_offsets()
+    assert worker_router._in_flight_bytes == 0
+
+
+@then('no signal was caught by the workers')
+def _(result: subprocess.CompletedProcess):
+    """no signal was caught by the workers."""
+    assert 'Caught signal' not in result.stderr
+
+
+@then(parsers.parse('the output directory has {count:d} messages on topic {topic}'))
+def _(count: int, topic: str, output_dir: str):
+    """the output directory has <count> messages on topic <topic>."""
+    messages = read_output(output_dir, topic)
+    assert len(messages) == count
+    assert [json.loads(message.value())['country'] for message in messages] == [topic] * count
+    assert all(message.topic() == topic for message in messages)
+
+
+@then(parsers.parse('the output directory has {count:d} messages on topic {topic} with the header {header}'))
+def _(count: int, topic: str, header: str, output_dir: str):
+    """the output directory has <count> messages on topic <topic> with the header <header>."""
+    messages = read_output(output_dir, topic)
+    assert len(messages) == count
+    assert all(header in dict(message.headers()) for message in messages)
+    assert [message.key() for message in messages] == [str(index).encode() for index in range(2, 300, 3)]
+
+
+@then(parsers.parse('the output is GB {gb_count:d} and dlq {dlq_count:d}'))
+def _(gb_count: int, dlq_count: int, result: subprocess.CompletedProcess):
+    """the output is GB <gb_count> and dlq <dlq_count>."""
+    assert result.stdout.splitlines() == [f'GB\t{gb_count}', f'dlq\t{dlq_count}']
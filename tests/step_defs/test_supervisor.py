@@ -0,0 +1,160 @@
+"""Supervisor feature tests."""
+import os
+import time
+
+import pytest
+from pytest_bdd import given, parsers, scenarios, then, when
+
+from router import Supervisor
+
+scenarios('../features/supervisor.feature')
+
+
+class MockProcess:
+    """
+    Provide an API that is compatible with multiprocessing.Process.
+
+    Parameters
+    ----------
+    target : callable
+        The function to be run in the process.
+    args : tuple
+        The arguments to target.
+    name : str
+        The name of the process.
+    """
+
+    pid = 1000
+
+    def __init__(self, target: callable, args: tuple, name: str) -> None:
+        self.args = args
+        self.exitcode = None
+        self.name = name
+        self.target = target
+        self.terminated = False
+        MockProcess.pid += 1
+        self.pid = MockProcess.pid
+
+    def is_alive(self) -> bool:
+        """Check if the process is alive."""
+        return self.exitcode is None
+
+    def join(self, timeout: float = None) -> None:
+        """Wait for the process to exit."""
+        pass
+
+    def start(self) -> None:
+        """Start the process."""
+        pass
+
+    def terminate(self) -> None:
+        """Terminate the process."""
+        self.terminated = True
+        self.exitcode = 0
+
+
+class MockContext:
+    """Provide an API that is compatible with a multiprocessing context."""
+
+    Process = MockProcess
+
+
+@given(parsers.parse('a metrics directory with the files {first} and {second}'))
+def _(first: str, second: str, tmp_path):
+    """a metrics directory with the files <first> and <second>."""
+    for name in (first, second):
+        (tmp_path / name).write_bytes(b'')
+
+
+@given(parsers.parse('a Supervisor with {workers:d} worker and its own metrics directory'),
+       target_fixture='supervisor')
+def _(workers: int, monkeypatch: pytest.MonkeyPatch):
+    """a Supervisor with <workers> worker and its own metrics directory."""
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', '')
+    supervisor = Supervisor(workers)
+    supervisor.context = MockContext()
+    return supervisor
+
+
+@given(parsers.parse('a Supervisor with {workers:d} worker and a backoff of {backoff_ms:d}ms'),
+       target_fixture='supervisor')
+def _(workers: int, backoff_ms: int, monkeypatch: pytest.MonkeyPatch, tmp_path):
+    """a Supervisor with <workers> worker and a backoff of <backoff_ms>ms."""
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+    monkeypatch.setenv('KAFKA_ROUTER_WORKER_BACKOFF_MS', str(backoff_ms))
+    supervisor = Supervisor(workers)
+    supervisor.context = MockContext()
+    return supervisor
+
+
+@when('the workers are checked')
+def _(supervisor: Supervisor):
+    """the workers are checked."""
+    for worker_id in range(supervisor.workers):
+        supervisor.check_worker(worker_id)
+
+
+@when(parsers.parse('worker {worker_id:d} exits with {exitcode:d}'))
+def _(worker_id: int, exitcode: int, supervisor: Supervisor):
+    """worker <worker_id> exits with <exitcode>."""
+    supervisor.processes[worker_id].exitcode = exitcode
+
+
+@when(parsers.parse('the backoff of worker {worker_id:d} has passed'))
+def _(worker_id: int, supervisor: Supervisor):
+    """the backoff of worker <worker_id> has passed."""
+    supervisor.start_times[worker_id] = time.time()
+
+
+@when('the workers are stopped', target_fixture='stopped_processes')
+def _(supervisor: Supervisor):
+    """the workers are stopped."""
+    processes = list(supervisor.processes.values())
+    supervisor.stop_workers()
+    return processes
+
+
+@then(parsers.parse('worker {worker_id:d} is running'))
+def _(worker_id: int, supervisor: Supervisor):
+    """worker <worker_id> is running."""
+    assert supervisor.processes[worker_id].is_alive()
+
+
+@then(parsers.parse('worker {worker_id:d} is not running'))
+def _(worker_id: int, supervisor: Supervisor):
+    """worker <worker_id> is not running."""
+    assert worker_id not in supervisor.processes
+
+
+@then(parsers.parse('worker {worker_id:d} is restarted in {backoff_ms:d}ms'))
+def _(worker_id: int, backoff_ms: int, supervisor: Supervisor):
+    """worker <worker_id> is restarted in <backoff_ms>ms."""
+    delay_ms = (supervisor.start_times[worker_id] - time.time()) * 1000
+    assert backoff_ms - 100 < delay_ms <= backoff_ms
+
+
+@then(parsers.parse('{count:d} worker has finished'))
+def _(count: int, supervisor: Supervisor):
+    """<count> worker has finished."""
+    assert len(supervisor.finished) == count
+
+
+@then('all workers have been terminated')
+def _(stopped_processes: list):
+    """all workers have been terminated."""
+    assert len(stopped_processes) == 2
+    assert all(process.terminated for process in stopped_processes)
+
+
+@then('the metrics directory of the Supervisor has been removed')
+def _(supervisor: Supervisor):
+    """the metrics directory of the Supervisor has been removed."""
+    assert supervisor.owns_metrics_dir
+    assert not os.path.exists(supervisor.metrics_dir)
+
+
+@then(parsers.parse('the metrics directory only has the file {name}'))
+def _(name: str, supervisor: Supervisor, tmp_path):
+    """the metrics directory only has the file <name>."""
+    assert not supervisor.owns_metrics_dir
+    assert os.listdir(tmp_path) == [name]